@@ -0,0 +1,64 @@
+# Compares capture throughput of one gphoto2 process per picture against
+# the persistent gphoto2 session, sequentially and with triggers queued
+# ahead of downloads
+# Usage: python3 examples/pixcam_benchmark.py --frames 20 --depth 2
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from src.pixcam import PixCam  # noqa: E402
+
+
+def run(name, capture, frames):
+    failures = 0
+    start = time.time()
+    for _ in range(frames):
+        if capture() is None:
+            failures += 1
+    elapsed = time.time() - start
+    print(f'{name}: {frames - failures} images in {elapsed:.2f}s, '
+          f'{(frames - failures) / elapsed:.2f} fps, {failures} failed')
+
+
+def pipelined(cam, frames, depth):
+    # Keep depth captures queued on the session while collecting images
+    for _ in range(min(depth, frames)):
+        cam.trigger()
+    triggered = min(depth, frames)
+
+    def capture():
+        nonlocal triggered
+        image = cam.next_image()
+        if triggered < frames:
+            cam.trigger()
+            triggered += 1
+        return image
+    return capture
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PixCam captures')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=2,
+                        help='Captures queued ahead in pipelined mode')
+    parser.add_argument('--output', default=tempfile.mkdtemp(),
+                        help='Absolute directory for captured images')
+    args = parser.parse_args()
+
+    # Constructing the camera checks the connection with one-off commands,
+    # so do it before any session holds the camera
+    cam = PixCam(args.output, persistent=False)
+    run('subprocess per picture', lambda: cam.take_pic()[0], args.frames)
+
+    cam.persistent = True
+    run('persistent session', lambda: cam.take_pic()[0], args.frames)
+    run(f'persistent session, {args.depth} queued',
+        pipelined(cam, args.frames, args.depth), args.frames)
+    cam.stop_session()
+
+
+if __name__ == '__main__':
+    main()
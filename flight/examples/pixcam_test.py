@@ -0,0 +1,49 @@
+# Test script for the gphoto2 session's output parsing
+import os
+import queue
+import unittest
+from collections import deque
+from types import SimpleNamespace
+from pixcam import GPhotoSession
+
+
+class TestGPhotoSession(unittest.TestCase):
+
+    # Runs read_output over output as if the gphoto2 shell printed it
+    def read(self, output, triggers):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, output.encode())
+        os.close(write_fd)
+        images = queue.Queue()
+        triggers = deque(triggers)
+        with os.fdopen(read_fd, 'rb') as stdout:
+            GPhotoSession([]).read_output(SimpleNamespace(stdout=stdout),
+                                          images, triggers)
+        return list(images.queue), triggers
+
+    def test_one_failure_per_capture(self):
+        output = ("gphoto2: {/tmp} /> *** Error ***\n"
+                  "*** Error (-110: 'I/O in progress') ***\n"
+                  "gphoto2: {/tmp} /> New file is in location /capt0001.jpg\n"
+                  "Saving file as ./image-001.jpg\n"
+                  "gphoto2: {/tmp} /> ")
+        images, triggers = self.read(output, [1.0, 2.0])
+        self.assertEqual(len(images), 2)
+        self.assertIsNone(images[0])
+        self.assertEqual(images[1]['path'], './image-001.jpg')
+        self.assertEqual(images[1]['trigger'], 2.0)
+        self.assertFalse(triggers)
+
+    def test_consecutive_failures(self):
+        output = ("gphoto2: {/tmp} /> *** Error ***\n"
+                  "*** Error (-7: 'I/O problem') ***\n"
+                  "gphoto2: {/tmp} /> *** Error ***\n"
+                  "*** Error (-7: 'I/O problem') ***\n"
+                  "gphoto2: {/tmp} /> ")
+        images, triggers = self.read(output, [1.0, 2.0, 3.0])
+        self.assertEqual(images, [None, None])
+        self.assertEqual(list(triggers), [3.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
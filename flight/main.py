@@ -1,17 +1,20 @@
 import argparse
-from dronekit import connect
 from src.mission import \
     generate_waypoint_list, mission_add_waypoints, \
     start_mission, mission_reset, \
     mode_switch
 from src.fences import set_geofence, enable_fence, generate_fence
+from src.parameters import connect_vehicle
 from src.pixcam import PixCam
 import src.image_wrapper as iw
+from src.telemetry import TelemetryPublisher
+from src.camera_trigger import CaptureFeedback, set_trigger_distance
 import random
 import time
 import os
 import shutil
 import multiprocessing
+import threading
 import traceback
 from src.errors import RetryException
 
@@ -24,6 +27,10 @@ RTL_POINT = [34.17563223420202, -118.48213260580246]  # Apollo RTL
 # MANUAL_MODES = ["MANUAL", "FBWA"]
 
 OUTPUT_IMAGE_FOLDER_RELATIVE = './img'
+# Default metres between autopilot camera triggers during the scan (see
+# --trigger_distance). 0 has the companion computer take pictures itself,
+# geotagged from telemetry
+TRIGGER_DISTANCE = 0
 
 
 def main(args):
@@ -40,11 +47,16 @@ def main(args):
     waypoint_file = args.waypoint_file if args.waypoint_file \
         else WAYPOINT_FILENAME
     fence_file = args.fence_file if args.fence_file else FENCE_FILENAME
+    trigger_distance = args.trigger_distance
 
     # Connect to the Vehicle
     print('Connecting to vehicle on: %s' % connection_string)
-    vehicle = connect(connection_string, wait_ready=True,
-                      timeout=3600, baud=115200)
+    vehicle = connect_vehicle(connection_string, timeout=3600, baud=115200)
+
+    # Stream telemetry to vision, which geotags frames without their own
+    # capture telemetry with the latest sample
+    telemetry_publisher = TelemetryPublisher(vehicle)
+    telemetry_publisher.start()
 
     # send_status(vehicle, "Resetting mission")
     mission_reset(vehicle)
@@ -84,14 +96,34 @@ def main(args):
     # CRITICAL: MUST POST TELEMETRY BEFORE QUEUEING IMAGES
 
     # Start image detection
-    proc = multiprocessing.Process(target = iw.update_images, args=(cam, ))
-    proc.start()
+    if trigger_distance:
+        # Listening for the autopilot's trigger feedback needs the vehicle
+        # connection, so this runs in a thread rather than a process
+        feedback = CaptureFeedback(vehicle)
+        feedback.start()
+        stop_images = threading.Event()
+        image_thread = threading.Thread(
+            target=iw.update_triggered_images,
+            args=(cam, feedback, stop_images))
+        image_thread.start()
+        set_trigger_distance(vehicle, trigger_distance)
+    else:
+        # The capture process has no vehicle connection to sample a pose
+        # from, so vision geotags these images with the streamed telemetry
+        proc = multiprocessing.Process(target = iw.update_images, args=(cam, ))
+        proc.start()
 
     # End airdrop scan
 
 
     # End image detection
-    proc.terminate()
+    if trigger_distance:
+        set_trigger_distance(vehicle, 0)
+        stop_images.set()
+        image_thread.join()
+        feedback.stop()
+    else:
+        proc.terminate()
     best_detections = iw.get_best_object_detections()
 
     # Airdrop
@@ -99,6 +131,9 @@ def main(args):
 
     # Switch to manual
     mode_switch(vehicle, "LOITER")
+
+    telemetry_publisher.stop()
+    print(f"Telemetry publisher: {telemetry_publisher.stats()}")
     
     print("Finished flight software")
 
@@ -114,6 +149,11 @@ if __name__ == '__main__':
                         help="File name of the waypoints to be flown through.")
     parser.add_argument('--fence_file',
                         help="File name of the waypoints to be flown through.")
+    parser.add_argument('--trigger_distance', type=float,
+                        default=TRIGGER_DISTANCE,
+                        help="Metres between autopilot camera triggers \
+                        during the scan. 0 (the default) has the companion \
+                        computer take pictures itself.")
     args = parser.parse_args()
 
 
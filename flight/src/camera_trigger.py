@@ -0,0 +1,158 @@
+import math
+import threading
+import time
+from collections import deque
+
+from pymavlink import mavutil
+
+from src.errors import retry
+
+# Feedback kept for images that haven't been downloaded yet
+FEEDBACK_HISTORY = 200
+# Seconds to wait for a trigger's feedback after its image arrived
+FEEDBACK_TIMEOUT = 2
+FEET_PER_METER = 3.28084
+
+
+# Has the autopilot trigger the camera every distance_m metres flown, 0 to
+# stop
+@retry(5)
+def set_trigger_distance(vehicle, distance_m):
+    msg = vehicle.message_factory.command_long_encode(
+        0, 0,  # target system, target component
+        mavutil.mavlink.MAV_CMD_DO_SET_CAM_TRIGG_DIST,  # command
+        0,  # confirmation
+        distance_m,  # param1 (distance in metres)
+        0,  # param2 (shutter integration time)
+        1,  # param3 (trigger once immediately)
+        0, 0, 0, 0)
+    vehicle.send_mavlink(msg)
+
+
+# Has the autopilot trigger the camera once
+@retry(5)
+def trigger_camera(vehicle):
+    msg = vehicle.message_factory.command_long_encode(
+        0, 0,  # target system, target component
+        mavutil.mavlink.MAV_CMD_DO_DIGICAM_CONTROL,  # command
+        0,  # confirmation
+        0, 0, 0, 0,
+        1,  # param5 (1 = take picture)
+        0, 0)
+    vehicle.send_mavlink(msg)
+
+
+# Records the pose the autopilot reports for every camera trigger and hands
+# it to the image downloaded for that trigger. ArduPilot reports the pose in
+# CAMERA_FEEDBACK; for CAMERA_TRIGGER (PX4), which only carries a sequence
+# number, the vehicle's pose when the message arrives is used instead.
+# Images arrive in trigger order, so the n-th downloaded image belongs to the
+# n-th trigger since start(); failed downloads must be passed to skip_image
+# to keep the count. An image the autopilot didn't trigger would shift every
+# later pairing, so an image whose paired trigger was reported after it was
+# downloaded is re-paired with the latest trigger before its download
+class CaptureFeedback:
+    def __init__(self, vehicle, history=FEEDBACK_HISTORY):
+        self.vehicle = vehicle
+        self.feedback = deque(maxlen=history)   # (sequence, received, pose)
+        self.condition = threading.Condition()
+        self.first_sequence = None
+        self.next_image = 0
+        self.matched = 0
+        self.resynced = 0
+        self.missing = 0
+
+    def start(self):
+        self.vehicle.add_message_listener('CAMERA_FEEDBACK',
+                                          self.on_feedback)
+        self.vehicle.add_message_listener('CAMERA_TRIGGER', self.on_trigger)
+
+    def stop(self):
+        self.vehicle.remove_message_listener('CAMERA_FEEDBACK',
+                                             self.on_feedback)
+        self.vehicle.remove_message_listener('CAMERA_TRIGGER',
+                                             self.on_trigger)
+
+    # Pose in the units of PixCam.capture_metadata: lat/long in DD, alt in
+    # ft, angles in degrees
+    def on_feedback(self, vehicle, name, msg):
+        self.record(msg.img_idx, {'latitude': msg.lat / 1e7,
+                                  'longitude': msg.lng / 1e7,
+                                  'altitude': msg.alt_rel * FEET_PER_METER,
+                                  'heading': msg.yaw % 360,
+                                  'roll': msg.roll,
+                                  'pitch': msg.pitch})
+
+    def on_trigger(self, vehicle, name, msg):
+        location = vehicle.location.global_relative_frame
+        attitude = vehicle.attitude
+        self.record(msg.seq, {'latitude': location.lat,
+                              'longitude': location.lon,
+                              'altitude': location.alt * FEET_PER_METER,
+                              'heading': vehicle.heading,
+                              'roll': math.degrees(attitude.roll),
+                              'pitch': math.degrees(attitude.pitch)})
+
+    def record(self, sequence, pose):
+        with self.condition:
+            if self.first_sequence is None:
+                self.first_sequence = sequence
+            pose['timestamp'] = time.time()
+            pose['sequence'] = sequence
+            self.feedback.append((sequence, time.monotonic(), pose))
+            self.condition.notify_all()
+
+    def find(self, sequence):
+        for feedback in self.feedback:
+            if feedback[0] == sequence:
+                return feedback
+        return None
+
+    # Trigger sequence number and pose for the next downloaded image, given
+    # when (monotonic) its download finished. The pose is None if the
+    # autopilot didn't report one, the sequence if no trigger has been
+    # reported since start()
+    def pose_for_next_image(self, downloaded, timeout=FEEDBACK_TIMEOUT):
+        with self.condition:
+            index = self.next_image
+            self.next_image += 1
+            deadline = time.monotonic() + timeout
+            while True:
+                feedback = None
+                if self.first_sequence is not None:
+                    feedback = self.find(self.first_sequence + index)
+                if feedback is not None or \
+                        not self.condition.wait(deadline - time.monotonic()):
+                    break
+
+            if feedback is None:
+                self.missing += 1
+                if self.first_sequence is None:
+                    return None, None
+                return self.first_sequence + index, None
+            if feedback[1] <= downloaded:
+                self.matched += 1
+                return feedback[0], feedback[2]
+
+            # Out of step: use the last trigger before the download and
+            # carry on counting from it
+            earlier = [f for f in self.feedback if f[1] <= downloaded]
+            if not earlier:
+                self.missing += 1
+                return None, None
+            feedback = earlier[-1]
+            self.next_image = feedback[0] - self.first_sequence + 1
+            self.resynced += 1
+            return feedback[0], feedback[2]
+
+    # A triggered capture failed to download
+    def skip_image(self):
+        with self.condition:
+            self.next_image += 1
+
+    def stats(self):
+        with self.condition:
+            return {'feedback': len(self.feedback),
+                    'matched': self.matched,
+                    'resynced': self.resynced,
+                    'missing': self.missing}
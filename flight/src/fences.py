@@ -1,31 +1,35 @@
 from pymavlink import mavutil
 import pymavlink.dialects.v20.all as dialect
 from src.errors import retry
-import time
+from src.parameters import get_parameters, set_parameters
+from src.transfer import MissionTransfer
+
+# FENCE_ACTION value for no action; newer pymavlink dropped the enum
+FENCE_ACTION_NONE = 0
 
 
 def get_fence_action(vehicle):
-    return vehicle.parameters["FENCE_ACTION"]
+    return get_parameters(vehicle)["FENCE_ACTION"]
 
 
 def set_fence_action(vehicle, val):
-    while vehicle.parameters["FENCE_ACTION"] != val:
-        vehicle.parameters["FENCE_ACTION"] = val
-        time.sleep(0.1)
+    set_parameters(vehicle, {"FENCE_ACTION": val})
 
 
 def set_fence_total(vehicle, val: int):
-    while vehicle.parameters["FENCE_TOTAL"] != val:
-        vehicle.parameters["FENCE_TOTAL"] = val
-        time.sleep(0.1)
+    set_parameters(vehicle, {"FENCE_TOTAL": val})
 
 
-def create_mission_geofence(vehicle, seq, total, point):
+def create_mission_geofence(vehicle, seq, total, point, inclusion=True):
+    if inclusion:
+        command = dialect.MAV_CMD_NAV_FENCE_POLYGON_VERTEX_INCLUSION
+    else:
+        command = dialect.MAV_CMD_NAV_FENCE_POLYGON_VERTEX_EXCLUSION
     return vehicle.message_factory.mission_item_int_encode(
         target_system=0, target_component=0,
         seq=seq,
         frame=dialect.MAV_FRAME_GLOBAL_RELATIVE_ALT,
-        command=dialect.MAV_CMD_NAV_FENCE_POLYGON_VERTEX_INCLUSION,
+        command=command,
         current=0, autocontinue=0,
         param1=total, param2=0, param3=0, param4=0,
         x=int(point[0] * 1e7),
@@ -35,51 +39,34 @@ def create_mission_geofence(vehicle, seq, total, point):
     )
 
 
+# Replaces the vehicle's fence with inclusion and exclusion polygons, each a
+# list of (lat, lon) vertices, in one fence upload. The fence action is off
+# while it uploads. Returns the upload's timing and retry stats
 @retry(5)
-def set_geofence(vehicle, points):
+def upload_fences(vehicle, inclusions, exclusions=()):
+    items = []
+    for polygons, inclusion in ((inclusions, True), (exclusions, False)):
+        for polygon in polygons:
+            for point in polygon:
+                items.append(create_mission_geofence(
+                    vehicle, len(items), len(polygon), point, inclusion))
+
     curr_fence_action = get_fence_action(vehicle)
-    set_fence_action(vehicle, dialect.FENCE_ACTION_NONE)
-    set_fence_total(vehicle, len(points))
-    set_fence_action(vehicle, curr_fence_action)
-    
-    count = len(points)
-    init_message = vehicle.message_factory.mission_count_encode(
-        target_system=0, target_component=0,
-        count=count,
-        mission_type=dialect.MAV_MISSION_TYPE_FENCE
-    )
-    vehicle.send_mavlink(init_message)
-    print("Sent MISSION_COUNT")
+    set_parameters(vehicle, {"FENCE_ACTION": FENCE_ACTION_NONE,
+                             "FENCE_TOTAL": len(items)})
+    try:
+        stats = MissionTransfer(
+            vehicle, dialect.MAV_MISSION_TYPE_FENCE).upload(items)
+    finally:
+        set_fence_action(vehicle, curr_fence_action)
+    print(f"Uploaded {len(inclusions)} inclusion and {len(exclusions)} "
+          f"exclusion fences in {stats['seconds']:.2f}s with "
+          f"{stats['resends']} resends")
+    return stats
 
-    ready = False
 
-    # TODO: add timeouts
-    def ack_listener(vehicle, name, msg):
-        print("Received MISSION_ACK")
-        if msg.mission_type != dialect.MAV_MISSION_TYPE_FENCE:
-            return
-        nonlocal ready
-        ready = msg.type == dialect.MAV_MISSION_ACCEPTED
-
-    def mission_request_listener(vehicle, name, msg):
-        print("Received MISSION_REQUEST_INT")
-        if msg.mission_type != dialect.MAV_MISSION_TYPE_FENCE:
-            return
-        geofence_point = create_mission_geofence(
-            vehicle, msg.seq, len(points), points[msg.seq])
-        vehicle.send_mavlink(geofence_point)
-        print("Sent MISSION_ITEM_INT")
-
-    vehicle.add_message_listener("MISSION_ACK", ack_listener)
-    vehicle.add_message_listener("MISSION_REQUEST", mission_request_listener)
-
-    while not ready:
-        pass
-
-    print("Done Uploading")
-    vehicle.remove_message_listener("MISSION_ACK", ack_listener)
-    vehicle.remove_message_listener("MISSION_REQUEST",
-                                    mission_request_listener)
+def set_geofence(vehicle, points):
+    return upload_fences(vehicle, [points])
 
 
 @retry(5)
@@ -110,7 +97,7 @@ def generate_fence(filename):
 
 
 if __name__ == "__main__":
-    from dronekit import connect
+    from src.parameters import connect_vehicle
 
     # create mission item list
     target_locations = [(38.31729702009844, -76.55617670782419),
@@ -128,7 +115,7 @@ if __name__ == "__main__":
                         (38.31674255749409, -76.55294546866578),
                         (38.31729702009844, -76.55617670782419)]
 
-    vehicle = connect("/dev/ttyACM1", baud=115200, wait_ready=True)
+    vehicle = connect_vehicle("/dev/ttyACM1", baud=115200)
     print("Connected to vehicle")
 
     set_geofence(vehicle, target_locations)
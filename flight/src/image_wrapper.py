@@ -1,11 +1,50 @@
 import requests
 import json
+import math
 import time
 import os
 import multiprocessing
+import queue
+import threading
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+VISION_URL = 'http://localhost:8003'
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 10)
+# Captured images waiting to be uploaded before the oldest gets dropped
+SPOOL_SIZE = 32
+UPLOAD_WORKERS = 2
+STATS_INTERVAL = 10
+# Frames kept for the latency statistics
+LATENCY_HISTORY = 500
+# Header carrying a frame's capture telemetry, in the form of a /telemetry
+# update
+TELEMETRY_HEADER = 'X-Capture-Telemetry'
+# Header carrying the autopilot's camera trigger sequence number for a frame
+CAPTURE_INDEX_HEADER = 'X-Capture-Index'
+
+
+# Session with keep-alive connections, retrying connection errors with
+# backoff. Read errors and server errors are only retried for idempotent
+# requests (urllib3's default allowed_methods), since the server may have
+# queued a POSTed frame already and a retry would process it twice
+def make_session(workers=1):
+    retries = Retry(total=3, backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers,
+                          max_retries=retries)
+    new_session = requests.Session()
+    new_session.mount('http://', adapter)
+    return new_session
+
+
+session = make_session()
+
 
 def index():
-    response = requests.get('http://localhost:8003/index')
+    response = session.get(f'{VISION_URL}/index', timeout=TIMEOUT)
     if response.status_code == 200:
         index = response.json()
         print("Got index")
@@ -13,50 +52,225 @@ def index():
 
 
 def get_best_object_detections():
-    response = requests.get('http://localhost:8003/odlc')
+    response = session.get(f'{VISION_URL}/odlc', timeout=TIMEOUT)
     if response.status_code == 200:
         detections = response.json()
         print("Got object detections")
     return detections
 
 
-def queue_image_for_odlc(data):
-    response = requests.post("http://localhost:8003/odlc",
-                             data=data,
-                             headers={'Content-Type':
-                                      'application/octet-stream'})
+# Vision geotags the frame with metadata (from PixCam.capture_metadata)
+# when given, otherwise with the pose its MAVLink listener got for trigger
+# capture_index, otherwise with the latest telemetry update
+def queue_image_for_odlc(data, http=None, metadata=None, capture_index=None):
+    headers = {'Content-Type': 'application/octet-stream'}
+    if metadata is not None:
+        headers[TELEMETRY_HEADER] = json.dumps(capture_telemetry(metadata))
+    if capture_index is not None:
+        headers[CAPTURE_INDEX_HEADER] = str(capture_index)
+    response = (http or session).post(f'{VISION_URL}/odlc',
+                                      data=data,
+                                      headers=headers,
+                                      timeout=TIMEOUT)
     if response.status_code == 200:
         print('Image queued')
+    return response.status_code == 200
+
+
+# Vision expects altitude in inches and heading in radians. Timing holds
+# time.monotonic() times, which vision (on the same machine) compares with
+# its own clock
+def capture_telemetry(metadata):
+    telemetry = {'altitude': metadata['altitude'] * 12,
+                 'latitude': metadata['latitude'],
+                 'longitude': metadata['longitude'],
+                 'heading': math.radians(metadata['heading']),
+                 'roll': math.radians(metadata.get('roll', 0)),
+                 'pitch': math.radians(metadata.get('pitch', 0)),
+                 'timestamp': metadata['timestamp']}
+    if metadata.get('timing') is not None:
+        telemetry['timing'] = metadata['timing']
+    return telemetry
+
+
+# Mean, median, 90th percentile and max of a list of seconds
+def latency_stats(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {'mean': sum(samples) / len(samples),
+            'p50': samples[len(samples) // 2],
+            'p90': samples[int(len(samples) * 0.9)],
+            'max': samples[-1]}
+
 
 def update_telemetry(altitude, latitude, longitude, heading):
-    response = requests.post('http://localhost:8003/telemetry',
-                             json={'altitude': altitude, 'latitude': latitude,
-                                   'longitude': longitude, 'heading': heading})
+    response = session.post(f'{VISION_URL}/telemetry',
+                            json={'altitude': altitude, 'latitude': latitude,
+                                  'longitude': longitude, 'heading': heading},
+                            timeout=TIMEOUT)
     if response.status_code == 200:
         print("Telemetry updated")
 
 
+def update_search_area(points):
+    response = session.post(f'{VISION_URL}/search_area',
+                            json=points, timeout=TIMEOUT)
+    if response.status_code == 200:
+        print("Search area updated")
+
+
 def update_targets(root_dir):
     with open(os.path.join(root_dir, 'targets.json'), 'r') as tjf:
         target_json = json.loads(tjf.read())
-    response = requests.post('http://localhost:8003/targets',
-                             json=target_json)
+    response = session.post(f'{VISION_URL}/targets',
+                            json=target_json, timeout=TIMEOUT)
     if response.status_code == 200:
         print("Targets updated")
 
 
 def get_status():
-    response = requests.get('http://localhost:8003/status')
+    response = session.get(f'{VISION_URL}/status', timeout=TIMEOUT)
     if response.status_code == 200:
         status = response.json()
         print("Got status")
     return status
 
-def update_images(cam):
+
+# Uploads captured images from a bounded spool with a pool of threads, so
+# a slow upload never holds up the next capture. When the spool is full the
+# oldest image is dropped, since newer imagery is worth more
+class UploadPipeline:
+    def __init__(self, spool_size=SPOOL_SIZE, workers=UPLOAD_WORKERS):
+        self.spool = queue.Queue(maxsize=spool_size)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.captured = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.start_time = time.time()
+        self.threads = []
+        # Seconds from each stage of recent frames to upload complete
+        self.latencies = {stage: deque(maxlen=LATENCY_HISTORY)
+                          for stage in ('trigger', 'capture', 'download')}
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.upload_loop, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # metadata is the capture pose sent to vision, timing the stage times
+    # from PixCam.take_pic_timed for the latency statistics (taken from
+    # metadata if not given) and capture_index the autopilot's trigger
+    # sequence number, if it triggered the image
+    def add(self, path, metadata=None, timing=None, capture_index=None):
+        if timing is None:
+            timing = (metadata or {}).get('timing')
+        with self.lock:
+            self.captured += 1
+        while True:
+            try:
+                self.spool.put_nowait((path, metadata, timing, capture_index))
+                return
+            except queue.Full:
+                pass
+            try:
+                old_path, _, _, _ = self.spool.get_nowait()
+            except queue.Empty:
+                continue
+            os.remove(old_path)
+            self.spool.task_done()
+            with self.lock:
+                self.dropped += 1
+
+    def upload_loop(self):
+        # Sessions aren't thread safe, so every uploader gets its own
+        http = make_session()
+        while True:
+            path, metadata, timing, capture_index = self.spool.get()
+            try:
+                with open(path, 'rb') as im:
+                    data = im.read()
+                ok = queue_image_for_odlc(data, http, metadata,
+                                          capture_index)
+            except (OSError, requests.RequestException) as e:
+                print(f'Upload of {path} failed: {e!r}')
+                ok = False
+            uploaded_time = time.monotonic()
+            timing = timing or {}
+            with self.lock:
+                if ok:
+                    self.uploaded += 1
+                    for stage, samples in self.latencies.items():
+                        if timing.get(stage) is not None:
+                            samples.append(uploaded_time - timing[stage])
+                else:
+                    self.failed += 1
+            if os.path.exists(path):
+                os.remove(path)
+            self.spool.task_done()
+
+    def stats(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        with self.lock:
+            return {
+                'captured': self.captured,
+                'uploaded': self.uploaded,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'spool_depth': self.spool.qsize(),
+                'capture_rate': self.captured / elapsed,
+                'upload_rate': self.uploaded / elapsed,
+                'to_upload_latency': {
+                    stage: latency_stats(list(samples))
+                    for stage, samples in self.latencies.items()},
+            }
+
+
+# pose is passed on to PixCam.take_picture; without it images go up
+# without capture telemetry and vision uses its latest telemetry sample
+def update_images(cam, pose=None):
+    pipeline = UploadPipeline()
+    pipeline.start()
+    last_report = time.time()
     while True:
-        fp = cam.take_picture()
+        fp, metadata, timing = cam.take_picture(pose)
         if fp != None:
-            with open(fp, 'rb') as im:
-                data = im.read()
-                queue_image_for_odlc(data)
-            os.remove(fp)
+            pipeline.add(fp, metadata, timing)
+        if time.time() - last_report >= STATS_INTERVAL:
+            print(f'Image pipeline: {pipeline.stats()}')
+            last_report = time.time()
+
+
+# Uploads pictures the autopilot triggers, each tagged with the pose the
+# autopilot reported for its trigger (a camera_trigger.CaptureFeedback), so
+# vision doesn't need telemetry in lockstep with the images. Every frame
+# also carries its trigger sequence number, so vision can use the pose its
+# own MAVLink listener got when the flight computer missed the feedback
+def update_triggered_images(cam, feedback, stop_event):
+    pipeline = UploadPipeline()
+    pipeline.start()
+    cam.start_tethered()
+    last_report = time.time()
+    while not stop_event.is_set():
+        try:
+            record = cam.next_image()
+        except queue.Empty:
+            record = False
+        if record is None:
+            feedback.skip_image()
+        elif record:
+            path = record.pop('path')
+            sequence, pose = feedback.pose_for_next_image(
+                record['download'])
+            metadata = None
+            if pose is not None:
+                metadata = dict(pose, timing=record)
+            pipeline.add(path, metadata, record, sequence)
+        if time.time() - last_report >= STATS_INTERVAL:
+            print(f'Image pipeline: {pipeline.stats()}, '
+                  f'feedback: {feedback.stats()}')
+            last_report = time.time()
+    cam.stop_session()
@@ -1,9 +1,11 @@
+import struct
 import time
 
 from dronekit import Command, VehicleMode
 from pymavlink import mavutil
 
 from src.errors import retry
+from src.transfer import MissionTransfer
 
 # TODO: move constants
 METERS_PER_FEET = 0.3048
@@ -34,50 +36,135 @@ def start_mission(vehicle):
     mode_switch(vehicle, "AUTO")
 
 
+# Local copy of the vehicle's mission, downloaded once and kept in step with
+# every upload, so adding commands doesn't re-download the mission first.
+# sync() diffs the wanted items against what the vehicle holds and sends
+# only the changed span with MISSION_WRITE_PARTIAL_LIST when the length is
+# unchanged; the protocol can't change the item count that way, so other
+# edits are a full upload. Call download() again if a ground station may
+# have changed the mission
+class Mission:
+    def __init__(self, vehicle):
+        self.vehicle = vehicle
+        self.transfer = MissionTransfer(vehicle)
+        self.home = None
+        self.synced = []    # items on the vehicle, home first
+        self.items = []     # items after home
+        self.last_upload = None
+
+    def download(self):
+        items = [mission_item(msg) for msg in self.transfer.download()]
+        # Item 0 is the home position on ArduPilot, and ignored on upload
+        self.home = items[0] if items else HOME_ITEM
+        self.synced = [self.home] + items[1:]
+        self.items = items[1:]
+
+    # Upload items (all but home) and make them the mission, within timeout
+    # seconds if given. Returns the transfer's stats, or None when the
+    # vehicle already has them
+    def sync(self, items=None, timeout=None):
+        items = list(self.items if items is None else items)
+        wanted = [self.home] + items
+        if wanted == self.synced:
+            self.items = items
+            return None
+
+        messages = [self.encode(seq, item) for seq, item in enumerate(wanted)]
+        try:
+            if len(wanted) == len(self.synced):
+                changed = [seq for seq, item in enumerate(wanted)
+                           if item != self.synced[seq]]
+                stats = self.transfer.upload(messages, changed[0],
+                                             changed[-1], partial=True,
+                                             timeout=timeout)
+            else:
+                stats = self.transfer.upload(messages, timeout=timeout)
+        except Exception:
+            # The vehicle may hold part of the upload, so send it all next
+            self.synced = []
+            raise
+        self.synced = wanted
+        self.items = items
+        self.last_upload = stats
+        return stats
+
+    def encode(self, seq, item):
+        frame, command, params, x, y, z = item
+        return self.vehicle.message_factory.mission_item_int_encode(
+            0, 0,  # target system, target component
+            seq, frame, command,
+            0,  # current
+            1,  # autocontinue
+            *params, x, y, z,
+            mission_type=mavutil.mavlink.MAV_MISSION_TYPE_MISSION)
+
+
+# Missions by vehicle, downloaded on first use
+missions = {}
+
+
+def get_mission(vehicle):
+    if id(vehicle) not in missions:
+        mission = Mission(vehicle)
+        mission.download()
+        missions[id(vehicle)] = mission
+    return missions[id(vehicle)]
+
+
+# Mission item in the form Mission compares, with values rounded to what a
+# MISSION_ITEM_INT carries so downloaded and local items compare equal
+def make_item(frame, command, params, lat, lon, alt):
+    return (frame, command, tuple(float32(p) for p in params),
+            int(round(lat * 1e7)), int(round(lon * 1e7)), float32(alt))
+
+
+def mission_item(msg):
+    return (msg.frame, msg.command,
+            tuple(float32(p) for p in
+                  (msg.param1, msg.param2, msg.param3, msg.param4)),
+            msg.x, msg.y, float32(msg.z))
+
+
+def float32(value):
+    return struct.unpack('<f', struct.pack('<f', value))[0]
+
+
+HOME_ITEM = make_item(mavutil.mavlink.MAV_FRAME_GLOBAL,
+                      mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
+                      (0, 0, 0, 0), 0, 0, 0)
+
+
+def waypoint_item(waypoint):
+    return make_item(mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
+                     mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
+                     (0, ACC_RADIUS, 0, 0), *waypoint)
+
+
 @retry(5)
 def mission_reset(vehicle, timeout=30):
-    cmds = vehicle.commands
-    cmds.download()
-    cmds.wait_ready()
-    cmds.clear()
-    cmds.upload(timeout=timeout)
+    get_mission(vehicle).sync([], timeout)
 
 
 @retry(5)
 def mission_add_takeoff(vehicle, timeout=30):
-    cmds = vehicle.commands
-    cmds.download()
-    cmds.wait_ready()
-    takeoff_command = Command(
-        0, 0, 0,
+    mission = get_mission(vehicle)
+    takeoff_item = make_item(
         mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
         mavutil.mavlink.MAV_CMD_NAV_TAKEOFF,
-        0, 0,
-        CLIMB_ANGLE,
-        0, 0, 0, 0, 0,
-        MIN_RELATIVE_ALT
-    )
-    cmds.add(takeoff_command)
-    cmds.upload(timeout=timeout)
+        (CLIMB_ANGLE, 0, 0, 0),
+        0, 0, MIN_RELATIVE_ALT)
+    mission.sync(mission.items + [takeoff_item], timeout)
 
 
 @retry(5)
 def mission_add_land(vehicle, landing_point, timeout=30):
-    cmds = vehicle.commands
-    cmds.download()
-    cmds.wait_ready()
-    land_command = Command(
-        0, 0, 0,
+    mission = get_mission(vehicle)
+    land_item = make_item(
         mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
         mavutil.mavlink.MAV_CMD_NAV_LAND,
-        0, 0,
-        0, 0, 0, 0,
-        landing_point[0],
-        landing_point[1],
-        0
-    )
-    cmds.add(land_command)
-    cmds.upload(timeout=timeout)
+        (0, 0, 0, 0),
+        landing_point[0], landing_point[1], 0)
+    mission.sync(mission.items + [land_item], timeout)
 
 
 # Generate waypoints from waypoints given during competition.
@@ -99,11 +186,23 @@ def generate_waypoint_list(filename):
 
 @retry(5)
 def mission_add_waypoints(vehicle, waypoint_list, add_dummy=False, timeout=30):
-    cmds = vehicle.commands
-    cmds.download()
-    cmds.wait_ready()
-    for waypoint in waypoint_list:
-        waypoint_command = Command(
+    mission = get_mission(vehicle)
+    items = [waypoint_item(waypoint) for waypoint in waypoint_list]
+    if add_dummy:
+        items.append(waypoint_item(waypoint_list[-1]))
+    mission.sync(mission.items + items, timeout)
+
+
+# Adds a waypoint to cmds, the vehicle's Mission by default, uploading it
+# only if upload is set so several can go in one transfer. A dronekit
+# CommandSequence (vehicle.commands) is still accepted as cmds
+@retry(5)
+def mission_add_waypoint(vehicle, waypoint, cmds=None, upload=False,
+                         timeout=30):
+    if cmds is None:
+        cmds = get_mission(vehicle)
+    if not isinstance(cmds, Mission):
+        cmds.add(Command(
             0, 0, 0,
             mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
             mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
@@ -113,40 +212,10 @@ def mission_add_waypoints(vehicle, waypoint_list, add_dummy=False, timeout=30):
             waypoint[0],
             waypoint[1],
             waypoint[2]
-        )
-        cmds.add(waypoint_command)
-    if add_dummy:
-        cmds.add(Command(
-            0, 0, 0,
-            mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
-            mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
-            0, 0, 0,
-            ACC_RADIUS,
-            0, 0,
-            waypoint_list[-1][0],
-            waypoint_list[-1][1],
-            waypoint_list[-1][2]
         ))
-    cmds.upload(timeout=timeout)
-
-
-@retry(5)
-def mission_add_waypoint(vehicle, waypoint, cmds=None, upload=False, timeout=30):
-    if cmds is None:
-        cmds = vehicle.commands
-        cmds.download()
-        cmds.wait_ready()
-    waypoint_command = Command(
-        0, 0, 0,
-        mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
-        mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
-        0, 0, 0,
-        ACC_RADIUS,
-        0, 0,
-        waypoint[0],
-        waypoint[1],
-        waypoint[2]
-    )
-    cmds.add(waypoint_command)
+        if upload:
+            cmds.upload(timeout=timeout)
+        return
+    cmds.items.append(waypoint_item(waypoint))
     if upload:
-        cmds.upload(timeout=timeout)
+        cmds.sync(timeout=timeout)
@@ -0,0 +1,230 @@
+import json
+import os
+import threading
+import time
+
+from dronekit import connect
+from pymavlink import mavutil
+
+from src.transfer import MAX_RESENDS, TransferError
+
+# Parameter tables saved by firmware and board, relative to the working
+# directory
+PARAM_CACHE_DIR = "param_cache"
+# Seconds to wait for the vehicle to identify itself before asking again
+VERSION_TIMEOUT = 1
+# Seconds to wait for a batch of writes to be acknowledged before resending
+# the unacknowledged ones
+PARAM_TIMEOUT = 1
+# Attributes dronekit's connect(wait_ready=True) waits for, less parameters
+READY_ATTRIBUTES = ['gps_0', 'armed', 'mode', 'attitude']
+
+
+# The vehicle's parameters, kept up to date from PARAM_VALUE messages. On a
+# new connection the table is loaded from the cache when the vehicle's
+# firmware, board and parameter count match it, so startup doesn't wait for
+# dronekit's full parameter download; the download carries on in the
+# background and re-saves the cache when done. Otherwise load() waits for
+# the download and caches the result
+class ParameterTable:
+    def __init__(self, vehicle, cache_dir=PARAM_CACHE_DIR):
+        self.vehicle = vehicle
+        self.cache_dir = cache_dir
+        self.values = {}
+        self.received = {}  # name: monotonic time of its last PARAM_VALUE
+        self.count = None
+        self.key = None
+        self.cached = False
+        self.condition = threading.Condition()
+        self.vehicle.add_message_listener('PARAM_VALUE', self.on_param_value)
+        # Whatever dronekit has downloaded so far, for vehicles connected
+        # without connect_vehicle
+        self.values.update(vehicle.parameters.items())
+
+    def on_param_value(self, vehicle, name, msg):
+        with self.condition:
+            self.values[msg.param_id] = msg.param_value
+            self.received[msg.param_id] = time.monotonic()
+            self.count = msg.param_count
+            self.condition.notify_all()
+
+    # Falls back on dronekit's table for parameters it received before the
+    # PARAM_VALUE listener was added
+    def __getitem__(self, name):
+        with self.condition:
+            if name in self.values:
+                return self.values[name]
+        return self.vehicle.parameters[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def cache_path(self):
+        return os.path.join(self.cache_dir, f"{self.key}.json")
+
+    # Firmware and board of the vehicle from AUTOPILOT_VERSION, or None if
+    # it doesn't answer
+    def identify(self, timeout=VERSION_TIMEOUT, max_resends=MAX_RESENDS):
+        received = threading.Event()
+        version = None
+
+        def on_version(vehicle, name, msg):
+            nonlocal version
+            version = msg
+            received.set()
+
+        self.vehicle.add_message_listener('AUTOPILOT_VERSION', on_version)
+        request = self.vehicle.message_factory.command_long_encode(
+            0, 0,  # target system, target component
+            mavutil.mavlink.MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES,
+            0,  # confirmation
+            1,  # param1 (request version)
+            0, 0, 0, 0, 0, 0)
+        try:
+            for _ in range(max_resends + 1):
+                self.vehicle.send_mavlink(request)
+                if received.wait(timeout):
+                    break
+        finally:
+            self.vehicle.remove_message_listener('AUTOPILOT_VERSION',
+                                                 on_version)
+        if version is None:
+            return None
+        return (f"{version.flight_sw_version:08x}-"
+                f"{version.board_version:08x}-{version.uid:016x}")
+
+    # Number of parameters on the vehicle, asking for one if none has been
+    # received yet
+    def parameter_count(self, timeout=PARAM_TIMEOUT,
+                        max_resends=MAX_RESENDS):
+        request = self.vehicle.message_factory.param_request_read_encode(
+            0, 0, b"", 0)
+        with self.condition:
+            for _ in range(max_resends + 1):
+                if self.count is not None:
+                    break
+                self.vehicle.send_mavlink(request)
+                self.condition.wait_for(lambda: self.count is not None,
+                                        timeout)
+            return self.count
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path()) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if len(values) != self.parameter_count():
+            return False
+        with self.condition:
+            # Values already received are newer than the cache
+            values.update(self.values)
+            self.values = values
+        return True
+
+    def save_cache(self):
+        with self.condition:
+            values = dict(self.values)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path()
+        with open(path + ".tmp", "w") as f:
+            json.dump(values, f)
+        os.replace(path + ".tmp", path)
+
+    # Snapshot of dronekit's finished download, saved to the cache
+    def take_download(self):
+        with self.condition:
+            self.values.update(self.vehicle.parameters.items())
+        if self.key is not None:
+            self.save_cache()
+            print(f"Cached {len(self.values)} parameters for {self.key}")
+
+    def wait_for_download(self, timeout):
+        self.vehicle.wait_ready('parameters', timeout=timeout)
+        self.take_download()
+
+    def load(self, timeout=3600):
+        self.key = self.identify()
+        self.cached = self.key is not None and self.load_cache()
+        if self.cached:
+            print(f"Loaded {len(self.values)} parameters from cache")
+            threading.Thread(target=self.wait_for_download, args=(timeout,),
+                             daemon=True).start()
+        else:
+            self.wait_for_download(timeout)
+
+    # Writes all of values ({name: value}) at once and waits for each to be
+    # acknowledged by a PARAM_VALUE with the new value, resending the ones
+    # that aren't. Returns timing and retry stats
+    def set_many(self, values, timeout=PARAM_TIMEOUT,
+                 max_resends=MAX_RESENDS):
+        factory = self.vehicle.message_factory
+        start = time.monotonic()
+        resends = 0
+
+        # Cached values may be stale, so every write needs a PARAM_VALUE
+        # received after it was first sent
+        def pending():
+            return [name for name, value in values.items()
+                    if self.received.get(name, 0) < start or
+                    abs(self.values[name] - value) > 1e-6]
+
+        for attempt in range(max_resends + 1):
+            with self.condition:
+                unacked = pending()
+            if not unacked:
+                break
+            if attempt:
+                resends += len(unacked)
+            for name in unacked:
+                self.vehicle.send_mavlink(factory.param_set_encode(
+                    0, 0, name.encode(), values[name],
+                    mavutil.mavlink.MAV_PARAM_TYPE_REAL32))
+            with self.condition:
+                self.condition.wait_for(lambda: not pending(), timeout)
+        else:
+            with self.condition:
+                unacked = pending()
+            if unacked:
+                raise TransferError(f"Parameters not acknowledged after "
+                                    f"{max_resends} resends: {unacked}")
+
+        stats = {'params': len(values), 'resends': resends,
+                 'seconds': time.monotonic() - start}
+        print(f"Set {len(values)} parameters in {stats['seconds']:.2f}s "
+              f"with {resends} resends")
+        return stats
+
+
+# Parameter tables by vehicle
+tables = {}
+
+
+def get_parameters(vehicle):
+    if id(vehicle) not in tables:
+        tables[id(vehicle)] = ParameterTable(vehicle)
+    return tables[id(vehicle)]
+
+
+def set_parameters(vehicle, values):
+    return get_parameters(vehicle).set_many(values)
+
+
+# Connects like dronekit's connect(wait_ready=True), but takes parameters
+# from the cache when it matches the vehicle and reports the time to ready
+def connect_vehicle(connection_string, timeout=3600, **kwargs):
+    start = time.monotonic()
+    vehicle = connect(connection_string, wait_ready=False, timeout=timeout,
+                      **kwargs)
+    connected = time.monotonic()
+    params = get_parameters(vehicle)
+    params.load(timeout)
+    vehicle.wait_ready(*READY_ATTRIBUTES, timeout=timeout)
+    ready = time.monotonic()
+    print(f"Vehicle ready in {ready - start:.1f}s (connected in "
+          f"{connected - start:.1f}s, parameters "
+          f"{'cached' if params.cached else 'downloaded'})")
+    return vehicle
@@ -9,6 +9,11 @@ import geopy
 import geopy.distance
 import signal
 import psutil
+import queue
+import shutil
+import threading
+import time
+from collections import deque
 # from PIL import Image
 # from PIL.ExifTags import TAGS, GPSTAGS
 # from exif import Image
@@ -16,13 +21,153 @@ import psutil
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
+# Seconds to wait for a capture to be downloaded
+CAPTURE_TIMEOUT = 5
+# Start of the `gphoto2 --shell` prompt, which precedes each command's output
+PROMPT = "gphoto2: {"
+
+
+# Long-lived `gphoto2 --shell` process that keeps the camera open between
+# captures. Each trigger() queues one capture; a reader thread parses the
+# shell's output and puts a capture record (or None if the capture failed)
+# on the images queue, one item per trigger. Records hold the image path and
+# time.monotonic() times of the trigger, of the camera reporting the new
+# file and of the download completing
+# A tethered session (`gphoto2 --capture-tethered`) instead downloads every
+# picture the camera takes on its own, e.g. when the autopilot triggers it,
+# so its records have no trigger time
+class GPhotoSession:
+    def __init__(self, args, tethered=False):
+        self.args = args
+        self.tethered = tethered
+        self.images = queue.Queue()
+        self.triggers = deque()
+        self.process = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        command_str = ' '.join(
+            self.args + ["--capture-tethered" if self.tethered else "--shell"])
+        # gphoto2 block-buffers its output when it isn't a terminal, which
+        # would hold back "Saving file as" lines until the buffer fills
+        if shutil.which("stdbuf"):
+            command_str = "stdbuf -oL " + command_str
+        log.info("Starting gphoto2 session: %s", command_str)
+        self.process = subprocess.Popen(["exec " + command_str], shell=True,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        # A fresh queue per process, so a dead session's late output can't
+        # be mistaken for a new capture
+        self.images = queue.Queue()
+        self.triggers = deque()
+        self.reader = threading.Thread(target=self.read_output,
+                                       args=(self.process, self.images,
+                                             self.triggers),
+                                       daemon=True)
+        self.reader.start()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    # The shell prompt isn't newline terminated, so read raw chunks and only
+    # look at complete lines. gphoto2 prints several "*** Error" lines for
+    # one failed capture; only the first is reported, until the next prompt
+    # or new file starts another capture
+    def read_output(self, process, images, triggers):
+        buffer = b""
+        capture_time = None
+        failed = False
+        while True:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            now = time.monotonic()
+            if not chunk:
+                break
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                line = line.decode("ascii", "replace").strip()
+                match = re.search("Saving file as (.*)", line)
+                if PROMPT in line:
+                    failed = False
+                # Output follows the shell prompt on the same line
+                if "New file is in location" in line:
+                    capture_time = now
+                    failed = False
+                elif match:
+                    images.put({"path": match.group(1),
+                                "trigger": triggers.popleft()
+                                if triggers else None,
+                                "capture": capture_time,
+                                "download": now})
+                    capture_time = None
+                elif "*** Error" in line:
+                    log.error("gphoto2: %s", line)
+                    if failed:
+                        continue
+                    failed = True
+                    if triggers:
+                        triggers.popleft()
+                    capture_time = None
+                    images.put(None)
+        log.info("gphoto2 session ended")
+
+    # Ask for a capture without waiting for it
+    def trigger(self):
+        with self.lock:
+            if not self.alive():
+                self.start()
+            self.triggers.append(time.monotonic())
+            self.process.stdin.write(b"capture-image-and-download\n")
+            self.process.stdin.flush()
+
+    # Capture record of the next downloaded image, None if the capture
+    # failed or timed out
+    # Tethered sessions can't know a picture is due, so they raise
+    # queue.Empty on timeout instead, restarting only if gphoto2 has exited
+    def next_image(self, timeout=CAPTURE_TIMEOUT):
+        try:
+            return self.images.get(timeout=timeout)
+        except queue.Empty:
+            if self.tethered:
+                with self.lock:
+                    if not self.alive():
+                        log.error("gphoto2 exited, restarting session")
+                        self.start()
+                raise
+            log.error("Capture timed out, restarting gphoto2 session")
+            self.stop()
+            return None
+
+    def stop(self):
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                if self.tethered:
+                    self.process.send_signal(signal.SIGINT)
+                else:
+                    self.process.stdin.write(b"exit\n")
+                    self.process.stdin.flush()
+                self.process.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
 
 class PixCam:
     # Constructor: initializes array of command-line args, checks working
     # directory and gphoto2 installation
     # Can accept optional camera argument (currently unused)
-    def __init__(self, working_dir, camera="Sony Alpha-A5000 (Control)"):
+    # With persistent set, captures go through one gphoto2 session that is
+    # started on the first capture (so in the process that takes pictures)
+    def __init__(self, working_dir, camera="Sony Alpha-A5000 (Control)",
+                 persistent=True):
         self.args = ["gphoto2"]
+        self.persistent = persistent
+        self.session = None
 
         # Check working directory
         if not os.path.isdir(working_dir) or not os.path.isabs(working_dir):
@@ -30,8 +175,9 @@ class PixCam:
         self.working_dir = working_dir
         log.info('Working directory: %s', working_dir)
         # set an arg flag to create a custom, time-based naming system for
-        # images
-        self.set_flag("--filename", r"'{0}{1}%Y-%m-%d--%H-%M-%S.%C'"
+        # images. gphoto2 counts %n up for every file it saves, so names stay
+        # unique when a session takes several pictures a second
+        self.set_flag("--filename", r"'{0}{1}%Y-%m-%d--%H-%M-%S--%03n.%C'"
                       .format(working_dir, os.path.sep))
 
         # Crude check that gphoto2 is installed
@@ -53,13 +199,55 @@ class PixCam:
     # Take a picture and return picture path and picture name or None in case
     # of failure
     def take_pic(self):
+        image_path, _ = self.take_pic_timed()
+        if image_path is None:
+            return None, None
+        return image_path, os.path.basename(image_path)
+
+    # Take a picture and return its path and time.monotonic() times of the
+    # trigger, the camera reporting the capture (None when not known) and
+    # the download completing, or None, None in case of failure
+    def take_pic_timed(self):
         log.info("Taking a picture")
+        if self.persistent:
+            self.trigger()
+            record = self.next_image()
+            if record is None:
+                return None, None
+            image_path = record.pop("path")
+            return image_path, record
+        trigger_time = time.monotonic()
         output = self.execute_cmd("--capture-image-and-download")
-        if output == None:
+        if output is None:
             return None, None
+        download_time = time.monotonic()
         log.info("Output: %s", output)
         image_path = re.search("Saving file as (.*?)[\n]", output).group(1)
-        return image_path, os.path.basename(image_path)
+        return image_path, {"trigger": trigger_time, "capture": None,
+                            "download": download_time}
+
+    # Queue a capture on the persistent session. Triggers can run ahead of
+    # next_image to keep the camera busy
+    def trigger(self):
+        if self.session is None:
+            self.session = GPhotoSession(self.args)
+        self.session.trigger()
+
+    def next_image(self, timeout=CAPTURE_TIMEOUT):
+        return self.session.next_image(timeout)
+
+    # Download pictures the camera takes when something else triggers it,
+    # e.g. the autopilot's camera trigger. Collect them with next_image
+    def start_tethered(self):
+        self.stop_session()
+        self.session = GPhotoSession(self.args, tethered=True)
+        self.session.start()
+
+    # Close the persistent session so one-off gphoto2 commands can claim the
+    # camera again
+    def stop_session(self):
+        if self.session is not None:
+            self.session.stop()
 
     # Run any command with necessary flags prefixed and return
     # readable/writeable output
@@ -82,21 +270,27 @@ class PixCam:
                 os.kill(child.pid, signal.SIGKILL)
             return None
 
-    # Takes a picture and embeds crude gps data into metadata
+    # Takes a picture and returns its path and capture metadata (see
+    # capture_metadata), or None, None in case of failure
     # Use if drone is stationary
-    # Lat/Long in DD with sign, alt in ft ASL
+    # Lat/Long in DD with sign, alt in ft ASL, heading, roll and pitch in
+    # degrees
     # Ex. 45, -40, 400
-    def take_pic_and_record_loc(self, lat, long, alt=0):
-        image_path, image_name = self.take_pic()
+    # The metadata is sent along with the upload; write_exif also embeds the
+    # coordinates in the file, which rewrites the whole image
+    def take_pic_and_record_loc(self, lat, long, alt=0, heading=0, roll=0,
+                                pitch=0, write_exif=False):
+        image_path, timing = self.take_pic_timed()
 
-        if image_path == None:
+        if image_path is None:
             return None, None
 
         # with open(image_path, "rb") as image_file:
         #     image = Image(image_file)
         #
         # print(image_old_date)
-        image_datetime = self.get_datetime_from_img_name(image_name)
+        image_datetime = datetime.fromtimestamp(
+            self.wall_time(self.capture_time(timing)))
         # print(image_datetime)
         image_new_date = self.get_exif_date_from_datetime(image_datetime)
         # print(image.get("datetime"))
@@ -114,10 +308,33 @@ class PixCam:
         # else:
         #     long_ref = "E"
 
-        self.add_gps_metadata(image_path, lat, long, image_new_date, alt=alt)
-        log.info("Recorded gps coordinated to image metadata")
+        if write_exif:
+            self.add_gps_metadata(image_path, lat, long, image_new_date,
+                                  alt=alt)
+            log.info("Recorded gps coordinated to image metadata")
+
+        return image_path, self.capture_metadata(
+            image_datetime.timestamp(), lat, long, alt, heading, timing,
+            roll=roll, pitch=pitch)
+
+    # Pose of the camera when an image was taken. Timestamp in seconds since
+    # the epoch, Lat/Long in DD, alt in ft ASL, heading, roll and pitch in
+    # degrees, timing from take_pic_timed
+    def capture_metadata(self, timestamp, lat, long, alt, heading, timing,
+                         roll=0, pitch=0):
+        return {"timestamp": timestamp, "latitude": lat, "longitude": long,
+                "altitude": alt, "heading": heading, "roll": roll,
+                "pitch": pitch, "timing": timing}
 
-        return image_path, image_name
+    # Best known time.monotonic() time of the exposure
+    def capture_time(self, timing):
+        if timing["capture"] is not None:
+            return timing["capture"]
+        return timing["download"]
+
+    # Seconds since the epoch of a time.monotonic() time
+    def wall_time(self, monotonic_time):
+        return time.time() - (time.monotonic() - monotonic_time)
 
     def add_gps_metadata(self, image_path, lat, long, timestamp, alt=0):
         # Convert alt to m
@@ -129,7 +346,7 @@ class PixCam:
         photo.modGPSData(info, image_path)
 
     def get_datetime_from_img_name(self, image_name):
-        return datetime.strptime(image_name.split(".")[0],
+        return datetime.strptime(image_name[:len("yyyy-MM-dd--HH-mm-ss")],
                                  "%Y-%m-%d--%H-%M-%S")
         # "yyyy-MM-dd--HH-mm-ss"
 
@@ -144,22 +361,24 @@ class PixCam:
         seconds = int(3600*(dd-degrees-(minutes/float(60))))
         return degrees, minutes, seconds
 
-    # Takes a picture and embeds adjusted gps data into metadata
-    # Use if drone is moving. Inherently flawed since the precision of the
-    # filename is to the second
-    # Velocity in ft/s, heading in degrees
-    def take_pic_and_adjust_loc(self, lat, long, velocity, heading, alt=0):
+    # Takes a picture and returns its path and capture metadata with the
+    # location adjusted for the time the capture took
+    # Use if drone is moving
+    # Velocity in ft/s, heading, roll and pitch in degrees
+    def take_pic_and_adjust_loc(self, lat, long, velocity, heading, alt=0,
+                                roll=0, pitch=0, write_exif=False):
         # Find how much time passes between GPS reading and picture snap
-        init_time_sec = float(datetime.now().timestamp())
-        image_path, image_name = self.take_pic()
+        init_time = time.monotonic()
+        image_path, timing = self.take_pic_timed()
 
-        if image_path == None:
+        if image_path is None:
             return None, None
 
-        timestamp_datetime = self.get_datetime_from_img_name(image_name)
-        timestamp = self.get_exif_date_from_datetime(timestamp_datetime)
-        final_time_sec = float(timestamp_datetime.timestamp())
-        seconds_passed = final_time_sec - init_time_sec
+        capture_time = self.capture_time(timing)
+        seconds_passed = capture_time - init_time
+        final_time_sec = self.wall_time(capture_time)
+        timestamp = self.get_exif_date_from_datetime(
+            datetime.fromtimestamp(final_time_sec))
 
         distance = seconds_passed * velocity
         # Find new GPS location
@@ -169,12 +388,15 @@ class PixCam:
         new_lat = end_point.latitude
         new_long = end_point.longitude
 
-        self.add_gps_metadata(image_path,
-                              new_lat,
-                              new_long,
-                              timestamp,
-                              alt=alt)
-        return image_path, image_name
+        if write_exif:
+            self.add_gps_metadata(image_path,
+                                  new_lat,
+                                  new_long,
+                                  timestamp,
+                                  alt=alt)
+        return image_path, self.capture_metadata(
+            final_time_sec, new_lat, new_long, alt, heading, timing,
+            roll=roll, pitch=pitch)
 
     # Returns true if camera is found, false otherwise
     def check_camera_connection(self):
@@ -212,11 +434,28 @@ class PixCam:
             return None
 
     def __del__(self):
-        pass
+        self.stop_session()
+
+    # Takes a picture and returns its path, capture metadata and timing
+    # (from take_pic_timed). pose is a function returning the vehicle's
+    # current pose ({"latitude", "longitude", "altitude", "heading", "roll",
+    # "pitch", "velocity"} in DD, ft, degrees and ft/s), sampled when the
+    # picture is triggered and moved along the heading for the time the
+    # capture took. Without a pose the metadata is None, so vision geotags
+    # the image with its latest telemetry instead
+    def take_picture(self, pose=None):
+        sample = pose() if pose is not None else None
+        if sample is None:
+            image_path, timing = self.take_pic_timed()
+            return image_path, None, timing
 
-    def take_picture(self):
-        res1, _ = self.take_pic_and_adjust_loc(34.068458, -118.442819, 40, 0)
-        return res1
+        image_path, metadata = self.take_pic_and_adjust_loc(
+            sample["latitude"], sample["longitude"], sample["velocity"],
+            sample["heading"], alt=sample["altitude"], roll=sample["roll"],
+            pitch=sample["pitch"])
+        if image_path is None:
+            return None, None, None
+        return image_path, metadata, metadata["timing"]
 
 if __name__ == "__main__":
     print("Initiating testing protocol")
@@ -0,0 +1,147 @@
+import math
+import threading
+import time
+from collections import deque
+
+import requests
+
+from src.image_wrapper import (VISION_URL, TIMEOUT, make_session,
+                               latency_stats)
+
+# Samples per second, 10-50 Hz
+TELEMETRY_RATE = 20
+# Seconds between batches sent to vision
+SEND_INTERVAL = 0.1
+# Samples waiting to be sent before the oldest are dropped
+MAX_PENDING = 200
+STATS_INTERVAL = 10
+INCHES_PER_METER = 39.3701
+
+
+# Samples dronekit telemetry at a fixed rate on one thread and posts it to
+# vision in batches from another over a keep-alive connection, so a slow
+# request never delays sampling. Samples that wait too long, or whose batch
+# fails, are dropped rather than resent, since vision only wants the latest
+# pose
+class TelemetryPublisher:
+    def __init__(self, vehicle, rate=TELEMETRY_RATE,
+                 send_interval=SEND_INTERVAL, max_pending=MAX_PENDING):
+        self.vehicle = vehicle
+        self.rate = rate
+        self.send_interval = send_interval
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.sampled = 0
+        self.sent = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.late_samples = 0
+        # Seconds from sampling to vision acknowledging the batch
+        self.lag = deque(maxlen=1000)
+
+    def start(self):
+        self.stop_event.clear()
+        for target in (self.sample_loop, self.send_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    # Vision expects lat/long in degrees, altitude in inches above home and
+    # angles in radians
+    def sample(self):
+        location = self.vehicle.location.global_relative_frame
+        attitude = self.vehicle.attitude
+        return {'altitude': location.alt * INCHES_PER_METER,
+                'latitude': location.lat,
+                'longitude': location.lon,
+                'heading': math.radians(self.vehicle.heading),
+                'roll': attitude.roll,
+                'pitch': attitude.pitch,
+                'timestamp': time.time(),
+                'time': time.monotonic()}
+
+    def sample_loop(self):
+        period = 1 / self.rate
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                sample = self.sample()
+            except (AttributeError, TypeError) as e:
+                # Attributes are None until the vehicle reports them
+                print(f'Telemetry sample failed: {e!r}')
+                sample = None
+            if sample is not None:
+                with self.lock:
+                    self.sampled += 1
+                    if len(self.pending) >= self.max_pending:
+                        self.pending.popleft()
+                        self.dropped += 1
+                    self.pending.append(sample)
+
+            # Keep to the schedule, skipping ticks if sampling fell behind
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                with self.lock:
+                    self.late_samples += 1
+                next_time = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+
+    def send_loop(self):
+        http = make_session()
+        last_report = time.monotonic()
+        while True:
+            stopping = self.stop_event.wait(self.send_interval)
+            with self.lock:
+                batch = list(self.pending)
+                self.pending.clear()
+            if batch:
+                self.send(http, batch)
+            # One last send after stop() so pending samples aren't lost
+            if stopping:
+                return
+            if time.monotonic() - last_report >= STATS_INTERVAL:
+                print(f'Telemetry publisher: {self.stats()}')
+                last_report = time.monotonic()
+
+    def send(self, http, batch):
+        try:
+            response = http.post(f'{VISION_URL}/telemetry/batch',
+                                 json=batch, timeout=TIMEOUT)
+            ok = response.status_code == 200
+        except requests.RequestException as e:
+            print(f'Telemetry batch failed: {e!r}')
+            ok = False
+        acked = time.monotonic()
+        with self.lock:
+            self.batches += 1
+            if ok:
+                self.sent += len(batch)
+                self.lag.extend(acked - sample['time'] for sample in batch)
+            else:
+                self.failed_batches += 1
+                self.dropped += len(batch)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sampled': self.sampled,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'pending': len(self.pending),
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'late_samples': self.late_samples,
+                'lag': latency_stats(list(self.lag)),
+            }
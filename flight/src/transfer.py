@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from pymavlink import mavutil
+
+# Seconds to wait for the vehicle's next message before resending
+ITEM_TIMEOUT = 1.5
+# Resends in a row before a transfer is abandoned
+MAX_RESENDS = 5
+
+
+class TransferError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+# Runs the MAVLink mission protocol (missions, fences and rally points) on a
+# dronekit vehicle. Replies are collected by message listeners and waited on
+# with a condition variable, so nothing busy-waits. When the vehicle goes
+# quiet the last message is resent, up to max_resends times in a row
+class MissionTransfer:
+    def __init__(self, vehicle,
+                 mission_type=mavutil.mavlink.MAV_MISSION_TYPE_MISSION,
+                 item_timeout=ITEM_TIMEOUT, max_resends=MAX_RESENDS):
+        self.vehicle = vehicle
+        self.mission_type = mission_type
+        self.item_timeout = item_timeout
+        self.max_resends = max_resends
+        self.inbox = deque()
+        self.condition = threading.Condition()
+        self.resends = 0
+
+    def on_message(self, vehicle, name, msg):
+        if getattr(msg, 'mission_type', 0) != self.mission_type:
+            return
+        with self.condition:
+            self.inbox.append(msg)
+            self.condition.notify_all()
+
+    @contextmanager
+    def listening(self, names):
+        self.inbox.clear()
+        for name in names:
+            self.vehicle.add_message_listener(name, self.on_message)
+        try:
+            yield
+        finally:
+            for name in names:
+                self.vehicle.remove_message_listener(name, self.on_message)
+
+    # Next message of one of types, or None after the item timeout
+    def receive(self, types):
+        deadline = time.monotonic() + self.item_timeout
+        with self.condition:
+            while True:
+                while self.inbox:
+                    msg = self.inbox.popleft()
+                    if msg.get_type() in types:
+                        return msg
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    # Send msg and wait for a reply of one of types, resending if none comes
+    def request(self, msg, types, accept=lambda reply: True):
+        for attempt in range(self.max_resends + 1):
+            if attempt:
+                self.resends += 1
+            self.vehicle.send_mavlink(msg)
+            deadline = time.monotonic() + self.item_timeout
+            while time.monotonic() < deadline:
+                reply = self.receive(types)
+                if reply is not None and accept(reply):
+                    return reply
+        raise TransferError(f'No {"/".join(types)} after '
+                            f'{self.max_resends} resends')
+
+    # Items of the vehicle's list as MISSION_ITEM_INT messages
+    def download(self):
+        factory = self.vehicle.message_factory
+        start = time.monotonic()
+        self.resends = 0
+        with self.listening(['MISSION_COUNT', 'MISSION_ITEM_INT']):
+            count = self.request(
+                factory.mission_request_list_encode(
+                    0, 0, mission_type=self.mission_type),
+                ['MISSION_COUNT']).count
+            items = []
+            for seq in range(count):
+                items.append(self.request(
+                    factory.mission_request_int_encode(
+                        0, 0, seq, mission_type=self.mission_type),
+                    ['MISSION_ITEM_INT'],
+                    lambda reply, seq=seq: reply.seq == seq))
+            self.vehicle.send_mavlink(factory.mission_ack_encode(
+                0, 0, mavutil.mavlink.MAV_MISSION_ACCEPTED,
+                mission_type=self.mission_type))
+        print(f'Downloaded {count} items in {time.monotonic() - start:.2f}s '
+              f'with {self.resends} resends')
+        return items
+
+    # Upload items, a list of MISSION_ITEM_INT messages by seq. With
+    # partial, only items[start:end + 1] are written over the vehicle's
+    # (MISSION_WRITE_PARTIAL_LIST); otherwise the whole list is replaced.
+    # Gives up once timeout seconds have passed, if given. Returns timing
+    # and retry stats
+    def upload(self, items, start=0, end=None, partial=False, timeout=None):
+        factory = self.vehicle.message_factory
+        end = len(items) - 1 if end is None else end
+        if partial:
+            opener = factory.mission_write_partial_list_encode(
+                0, 0, start, end, mission_type=self.mission_type)
+        else:
+            start, end = 0, len(items) - 1
+            opener = factory.mission_count_encode(
+                0, 0, len(items), mission_type=self.mission_type)
+
+        began = time.monotonic()
+        self.resends = 0
+        sent = 0
+        expected = ['MISSION_REQUEST_INT', 'MISSION_REQUEST', 'MISSION_ACK']
+        with self.listening(expected):
+            msg = opener
+            while True:
+                # Empty lists are acknowledged straight away; otherwise the
+                # vehicle requests each item and acks after the last one
+                reply = self.request(msg, expected)
+                if reply.get_type() == 'MISSION_ACK':
+                    if reply.type != mavutil.mavlink.MAV_MISSION_ACCEPTED:
+                        raise TransferError(
+                            f'Upload rejected: {mission_result(reply.type)}')
+                    break
+                if timeout is not None and \
+                        time.monotonic() - began > timeout:
+                    raise TransferError(f'Upload took over {timeout}s')
+                if not start <= reply.seq <= end:
+                    continue
+                msg = items[reply.seq]
+                sent += 1
+        stats = {'items': end - start + 1, 'sent': sent,
+                 'resends': self.resends, 'partial': partial,
+                 'seconds': time.monotonic() - began}
+        print(f'Uploaded {stats["items"]} items in {stats["seconds"]:.2f}s '
+              f'with {self.resends} resends')
+        return stats
+
+
+def mission_result(result):
+    enum = mavutil.mavlink.enums['MAV_MISSION_RESULT']
+    return enum[result].name if result in enum else str(result)
@@ -0,0 +1,62 @@
+"""
+Benchmark batch geotagging against per-box scalar calls
+
+Example:
+    python3 bench_geotag.py --sizes 1 100 10000
+"""
+
+import argparse
+import json
+import timeit
+
+import numpy as np
+
+from odlc import gps
+
+TELEMETRY = (1200.0, 0.6687, -1.3360, 0.7)
+IMAGE_WIDTH, IMAGE_HEIGHT = 1080, 1920
+
+
+def scalar(xs, ys):
+    for x, y in zip(xs, ys):
+        gps.tag(*TELEMETRY, gps.SENSOR_WIDTH, gps.FOCAL_LENGTH,
+                IMAGE_WIDTH, IMAGE_HEIGHT, x, y)
+
+
+def batch(xs, ys):
+    gps.tag_batch(*TELEMETRY, IMAGE_WIDTH, IMAGE_HEIGHT, xs, ys)
+
+
+def time_per_call(func, xs, ys, budget=0.5):
+    timer = timeit.Timer(lambda: func(xs, ys))
+    number, _ = timer.autorange()
+    number = max(1, int(number * budget / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark geotagging')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 100, 10000])
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = []
+    print('points      scalar (s)     batch (s)   speedup')
+    for n in args.sizes:
+        xs = rng.uniform(0, IMAGE_WIDTH, n)
+        ys = rng.uniform(0, IMAGE_HEIGHT, n)
+        t_scalar = time_per_call(scalar, xs, ys)
+        t_batch = time_per_call(batch, xs, ys)
+        results.append({'points': n, 'scalar': t_scalar, 'batch': t_batch})
+        print(f'{n:6d}  {t_scalar:12.3e}  {t_batch:12.3e}  '
+              f'{t_scalar / t_batch:8.1f}x')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
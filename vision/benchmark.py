@@ -0,0 +1,241 @@
+"""
+Offline per-stage benchmark of the vision pipeline
+
+Loads the models once and runs every frame in a directory through
+detector.process_queued_image, using the in-memory state backend and
+synthetic telemetry, so no Redis, gunicorn or HTTP is involved. Prints a
+JSON report of per-stage timings, throughput and peak RSS, and compares it
+against a baseline report if one is given.
+
+Example:
+    python3 benchmark.py images/test --baseline benchmark-baseline.json
+    python3 benchmark.py images/test --write-baseline benchmark-baseline.json
+"""
+
+import argparse
+import json
+import math
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+# Run without Redis, using the docker-compose defaults for anything unset
+os.environ['STATE_BACKEND'] = 'memory'
+for key, value in {
+    'DEBUG': '0',
+    'DETECTION_TOLERANCE': '15',
+    'DILATION_ITERATIONS': '2',
+    'DILATION_KERNAL_SIZE': '5',
+    'POLAR_SHAPE_GRANULARITY': '100',
+    'CONCAVE_SHAPE_AREA_RATIO_THRESHOLD': '0.85',
+    'ALPHANUMERIC_DETECTION_PADDING': '5',
+    'ALPHANUMERIC_MODEL_THRESHOLD': '0.7',
+    'EMERGENT_MODEL_THRESHOLD': '0.85',
+    'CAMERA_SENSOR_WIDTH': '2.0',
+    'CAMERA_FOCAL_LENGTH': '1.0',
+}.items():
+    os.environ.setdefault(key, value)
+
+import cv2  # noqa: E402
+
+import util  # noqa: E402
+from odlc import gps, quality  # noqa: E402
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+SHAPES = ['circle', 'semicircle', 'quarter-circle', 'triangle', 'square',
+          'rectangle', 'trapezoid', 'pentagon', 'hexagon', 'heptagon',
+          'octagon', 'star', 'cross']
+DEFAULT_TARGETS = [{'type': 'emergent'}] + [
+    {'type': 'alphanumeric',
+     'class': {'shape': s, 'shape-color': 'white', 'text-color': 'black',
+               'text': 'A'}}
+    for s in SHAPES if s not in ('star', 'cross')
+]
+
+
+def load_frames(directory):
+    """
+    Yield (name, image, None) for every image in a directory, with None
+    meaning synthetic telemetry should be used
+    """
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            yield name, os.path.join(directory, name), None
+
+
+def synthetic_telemetry(index, altitude, latitude, longitude, spacing):
+    """
+    Level flight due north, spacing feet between consecutive frames
+    """
+    return {
+        'altitude': altitude,
+        'latitude': math.radians(latitude) +
+        index * spacing * 12 / gps.EARTH_RADIUS,
+        'longitude': math.radians(longitude),
+        'heading': 0.0,
+    }
+
+
+def summarize(samples):
+    samples = np.array(samples)
+    return {
+        'count': int(len(samples)),
+        'total': float(samples.sum()),
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'max': float(samples.max()),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(frames, args):
+    """
+    Run frames through the pipeline and return the report
+
+    frames yields (name, image or path, telemetry or None)
+    """
+    import odlc.detector as detector
+
+    targets = DEFAULT_TARGETS
+    if args.targets:
+        with open(args.targets) as fp:
+            targets = json.load(fp)
+    detector.update_targets(targets)
+
+    util.stage_times = {}
+    frame_times = []
+    start = time.perf_counter()
+    count = 0
+    for _ in range(args.repeat):
+        for name, img, telemetry in frames():
+            frame_start = time.perf_counter()
+            if isinstance(img, str):
+                with util.timed('decode'):
+                    img = cv2.imread(img, cv2.IMREAD_UNCHANGED)
+            if img is None:
+                util.error(f'Could not read {name}')
+                continue
+            if telemetry is None:
+                telemetry = synthetic_telemetry(count, args.altitude,
+                                                args.latitude,
+                                                args.longitude, args.spacing)
+            with util.timed('quality'):
+                quality.score(img)
+            with util.timed('process_queued_image'):
+                detector.process_queued_image(img, telemetry)
+            frame_times.append(time.perf_counter() - frame_start)
+            count += 1
+    elapsed = time.perf_counter() - start
+
+    if count == 0:
+        raise SystemExit('No frames were processed')
+
+    return {
+        'frames': count,
+        'elapsed': elapsed,
+        'throughput': count / elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+        'frame': summarize(frame_times),
+        'stages': {stage: summarize(samples)
+                   for stage, samples in util.stage_times.items()},
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Compare mean stage timings and throughput against a baseline report
+
+    Returns the comparison and a list of stages that regressed by more than
+    tolerance (a fraction)
+    """
+    comparison = {}
+    regressions = []
+    for stage, stats in report['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if base is None or base['mean'] == 0:
+            continue
+        ratio = stats['mean'] / base['mean']
+        comparison[stage] = {'baseline_mean': base['mean'],
+                             'mean': stats['mean'], 'ratio': ratio}
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+
+    ratio = report['throughput'] / baseline['throughput']
+    comparison['throughput'] = {'baseline': baseline['throughput'],
+                                'value': report['throughput'],
+                                'ratio': ratio}
+    if ratio < 1 - tolerance:
+        regressions.append('throughput')
+
+    return comparison, regressions
+
+
+def add_arguments(parser):
+    parser.add_argument('--targets', help='JSON list of targets')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Passes over the frames')
+    parser.add_argument('--altitude', type=float, default=1200,
+                        help='Synthetic altitude in inches')
+    parser.add_argument('--latitude', type=float, default=38.3144)
+    parser.add_argument('--longitude', type=float, default=-76.5452)
+    parser.add_argument('--spacing', type=float, default=100,
+                        help='Synthetic feet flown between frames')
+    parser.add_argument('--baseline', help='Baseline report to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed slowdown against the baseline')
+    parser.add_argument('--write-baseline',
+                        help='Save this report as a baseline')
+    parser.add_argument('--output', help='Write the report to a file')
+
+
+def report_results(report, args):
+    """
+    Compare against the baseline, print and save the report
+    Returns the process exit code (1 if anything regressed)
+    """
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        report['comparison'], regressions = compare(report, baseline,
+                                                    args.tolerance)
+        report['regressions'] = regressions
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    if args.write_baseline:
+        with open(args.write_baseline, 'w') as fp:
+            fp.write(output)
+
+    if regressions:
+        util.error(f'Regressions: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the vision pipeline over a directory of '
+                    'frames')
+    parser.add_argument('images', help='Directory of frames')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    report = run(lambda: load_frames(args.images), args)
+    report['images'] = args.images
+    sys.exit(report_results(report, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Calibration tool for the saliency cascade
+
+Scores every frame in a directory once, then reports the recall/skip-rate
+trade-off of a range of thresholds. Labels are a JSON file mapping image
+file names to lists of [x1, y1, x2, y2] target boxes; frames that are
+missing from the file (or map to an empty list) are treated as empty.
+
+Example:
+    python3 calibrate_saliency.py images/test --labels labels.json
+"""
+
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+
+from odlc import saliency
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def box_forwarded(box, region):
+    """
+    A box counts as recalled if its center lies inside the forwarded region
+    """
+    if region is None:
+        return False
+    cx = (box[0] + box[2]) / 2.0
+    cy = (box[1] + box[3]) / 2.0
+    return region[0] <= cx < region[2] and region[1] <= cy < region[3]
+
+
+def evaluate(frames, threshold, mode):
+    """
+    Compute recall and skip rates for a single threshold
+
+    frames is a list of (tile scores, image shape, boxes) tuples
+    """
+    skipped = 0
+    pixels = 0
+    forwarded_pixels = 0
+    positive_frames = 0
+    recalled_frames = 0
+    boxes = 0
+    recalled_boxes = 0
+
+    for scores, shape, frame_boxes in frames:
+        region = saliency.region_from_scores(scores, shape, threshold, mode)
+        pixels += shape[0] * shape[1]
+        if region is None:
+            skipped += 1
+        else:
+            forwarded_pixels += (region[2] - region[0]) * \
+                (region[3] - region[1])
+
+        if frame_boxes:
+            positive_frames += 1
+            hits = [box_forwarded(b, region) for b in frame_boxes]
+            recalled_boxes += sum(hits)
+            recalled_frames += any(hits)
+            boxes += len(frame_boxes)
+
+    return {
+        'threshold': threshold,
+        'frame_skip_rate': skipped / len(frames),
+        'pixel_skip_rate': 1.0 - forwarded_pixels / pixels,
+        'frame_recall': recalled_frames / positive_frames
+        if positive_frames else None,
+        'box_recall': recalled_boxes / boxes if boxes else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the recall/skip-rate trade-off of the '
+                    'saliency cascade')
+    parser.add_argument('images', help='Directory of frames')
+    parser.add_argument('--labels', help='JSON file of ground truth boxes')
+    parser.add_argument('--mode', default=saliency.MODE,
+                        choices=['frame', 'tile'])
+    parser.add_argument('--grid', type=int, default=saliency.TILE_GRID)
+    parser.add_argument('--thresholds', type=float, nargs='+',
+                        default=list(np.round(np.arange(0.05, 1.0, 0.05), 2)))
+    parser.add_argument('--output', help='Write the report as JSON')
+    args = parser.parse_args()
+
+    labels = {}
+    if args.labels:
+        with open(args.labels) as fp:
+            labels = json.load(fp)
+
+    frames = []
+    for name in sorted(os.listdir(args.images)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        # Read frames the way the server does, in whatever channel layout
+        # they were saved with
+        img = cv2.imread(os.path.join(args.images, name),
+                         cv2.IMREAD_UNCHANGED)
+        if img is None:
+            continue
+        img = saliency.to_bgr(img)
+        scores = saliency.score_tiles(img, args.grid)
+        frames.append((scores, img.shape, labels.get(name, [])))
+
+    if not frames:
+        raise SystemExit(f'No images found in {args.images}')
+
+    report = [evaluate(frames, t, args.mode) for t in args.thresholds]
+
+    print(f'{len(frames)} frames, '
+          f'{sum(1 for f in frames if f[2])} with targets')
+    print('threshold  frame-skip  pixel-skip  frame-recall  box-recall')
+    for row in report:
+        frame_recall = '-' if row['frame_recall'] is None \
+            else f"{row['frame_recall']:.3f}"
+        box_recall = '-' if row['box_recall'] is None \
+            else f"{row['box_recall']:.3f}"
+        print(f"{row['threshold']:9.2f}  {row['frame_skip_rate']:10.3f}  "
+              f"{row['pixel_skip_rate']:10.3f}  {frame_recall:>12}  "
+              f"{box_recall:>10}")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
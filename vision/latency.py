@@ -0,0 +1,91 @@
+"""
+Capture-to-result latency of frames
+
+Frames posted with capture telemetry carry time.monotonic() times of the
+capture trigger, the camera reporting the capture and the download
+completing. The server adds when the upload was received and when the frame
+finished processing, and keeps the time between consecutive stages for the
+last LATENCY_HISTORY frames, logging a summary every LATENCY_LOG_EVERY
+frames. Monotonic clocks are only comparable on the same machine, so the
+flight computer and the server have to share a host (containers included).
+"""
+
+import os
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+import util
+
+HISTORY = int(os.environ.get('LATENCY_HISTORY', '1000'))
+LOG_EVERY = int(os.environ.get('LATENCY_LOG_EVERY', '50'))
+STAGES = ['trigger', 'capture', 'download', 'received', 'processed']
+
+
+def summarize(samples):
+    if not samples:
+        return None
+    samples = np.array(samples)
+    return {
+        'count': int(len(samples)),
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p90': float(np.percentile(samples, 90)),
+        'max': float(samples.max()),
+    }
+
+
+class LatencyTracker:
+    """
+    Per-stage latency history
+    """
+
+    def __init__(self, history=HISTORY, log_every=LOG_EVERY):
+        self.history = history
+        self.log_every = log_every
+        self.intervals = {}     # 'stage->stage' -> deque of seconds
+        self.frames = 0
+        # Frames are recorded by the worker while /status reads
+        self.lock = Lock()
+
+    def record(self, timing, received, processed):
+        """
+        Record a processed frame's stage times
+
+        Stages the frame doesn't have (e.g. no camera-reported capture time)
+        are skipped, so the interval spans to the next known stage
+        """
+        times = dict(timing, received=received, processed=processed)
+        known = [(stage, times[stage]) for stage in STAGES
+                 if times.get(stage) is not None]
+        with self.lock:
+            for (start, start_time), (end, end_time) in \
+                    zip(known, known[1:]):
+                self._add(f'{start}->{end}', end_time - start_time)
+            if len(known) > 1:
+                self._add('total', known[-1][1] - known[0][1])
+            self.frames += 1
+        if self.log_every and self.frames % self.log_every == 0:
+            util.info('Frame latency (p50/p90 s): ' + ', '.join(
+                f'{name} {s["p50"]:.3f}/{s["p90"]:.3f}'
+                for name, s in self.status()['intervals'].items()))
+
+    def _add(self, name, seconds):
+        if name not in self.intervals:
+            self.intervals[name] = deque(maxlen=self.history)
+        self.intervals[name].append(seconds)
+
+    def status(self):
+        with self.lock:
+            intervals = {name: list(samples)
+                         for name, samples in self.intervals.items()}
+            frames = self.frames
+        return {
+            'frames': frames,
+            'intervals': {name: summarize(samples)
+                          for name, samples in intervals.items()},
+        }
+
+
+tracker = LatencyTracker()
@@ -0,0 +1,371 @@
+"""
+End-to-end load generator for a running vision server
+
+Replays frames and their telemetry against the HTTP API at fixed rates,
+the same way flight/src/image_wrapper does (POST /telemetry, then the raw
+image to POST /odlc), while a poller samples GET /status and GET /odlc.
+For every rate it reports queue growth, ingest-to-finished latency and,
+when ground truth is available, ingest-to-detection latency, then the
+highest rate the server sustained. A frame is finished once the server has
+processed it or left it out (a low-quality frame skipped or dropped, or one
+without a pose), since every posted frame should drain either way.
+
+Frames come either from a directory written by synthetic.py --output (its
+ground_truth.json supplies telemetry and targets) or are generated on the
+fly with --synthetic.
+
+Examples:
+    python3 loadtest.py --synthetic 300 --rates 1 2 5 --duration 60
+    python3 loadtest.py --images images/synthetic --url http://vision:8003
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+import numpy as np
+import requests
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+FEET_PER_DEGREE = 364000.0
+
+
+def load_directory(directory):
+    """
+    Returns a list of (jpeg bytes, telemetry in degrees, targets) frames
+    """
+    truth = {}
+    truth_path = os.path.join(directory, 'ground_truth.json')
+    if os.path.exists(truth_path):
+        with open(truth_path) as fp:
+            truth = json.load(fp)
+
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(directory, name), 'rb') as fp:
+            data = fp.read()
+        entry = truth.get(name, {})
+        telemetry = entry.get('telemetry')
+        if telemetry is not None:
+            telemetry = to_degrees(telemetry)
+        frames.append((data, telemetry, entry.get('targets', [])))
+    return frames
+
+
+def generate_frames(count, seed):
+    import cv2
+    import synthetic
+
+    generator = synthetic.SyntheticGenerator(seed=seed)
+    return [(cv2.imencode('.jpg', img)[1].tobytes(), to_degrees(telemetry),
+             truth)
+            for _, img, telemetry, truth in generator.frames(count)]
+
+
+def to_degrees(telemetry):
+    """
+    Ground truth telemetry is in radians, /telemetry expects degrees
+    """
+    telemetry = dict(telemetry)
+    telemetry['latitude'] = math.degrees(telemetry['latitude'])
+    telemetry['longitude'] = math.degrees(telemetry['longitude'])
+    return telemetry
+
+
+def distance_feet(a, b):
+    """
+    Flat-earth distance between two [lat, lon] points in degrees
+    """
+    dlat = (a[0] - b[0]) * FEET_PER_DEGREE
+    dlon = (a[1] - b[1]) * FEET_PER_DEGREE * math.cos(math.radians(a[0]))
+    return math.hypot(dlat, dlon)
+
+
+def finished_images(status):
+    """
+    Frames the server is done with, processed or not, from GET /status
+    """
+    quality = status['quality']
+    return status['processed_images'] + quality['skipped_images'] + \
+        quality['dropped_images'] + status['telemetry']['unposed']
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = np.array(samples)
+    return {
+        'count': int(len(samples)),
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p90': float(np.percentile(samples, 90)),
+        'p99': float(np.percentile(samples, 99)),
+        'max': float(samples.max()),
+    }
+
+
+class LoadRun:
+    """
+    Posts frames at a fixed rate and samples the server while doing so
+    """
+
+    def __init__(self, url, frames, rate, duration, concurrency,
+                 poll_interval, tolerance):
+        self.url = url
+        self.frames = frames
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.tolerance = tolerance
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=concurrency + 2)
+        self.session.mount('http://', adapter)
+        self.lock = Lock()
+        self.stop_polling = Event()
+        self.posted = []            # times uploads completed
+        self.post_errors = 0
+        self.post_times = []
+        self.status_samples = []    # (time, queued, finished, processed)
+        self.target_first_seen = {}
+        self.targets = []           # (first posted time or None, coords)
+
+    def _post_frame(self, index, data, telemetry):
+        start = time.time()
+        try:
+            if telemetry is not None:
+                self.session.post(f'{self.url}/telemetry', json=telemetry,
+                                  timeout=5).raise_for_status()
+            self.session.post(
+                f'{self.url}/odlc', data=data, timeout=10,
+                headers={'Content-Type': 'application/octet-stream'}
+            ).raise_for_status()
+        except requests.RequestException as exc:
+            print(f'[ERROR] | Frame {index}: {exc!r}', file=sys.stderr)
+            with self.lock:
+                self.post_errors += 1
+            return
+        end = time.time()
+        with self.lock:
+            self.posted.append(end)
+            self.post_times.append(end - start)
+
+    def _poll(self, baseline, processed_baseline):
+        while not self.stop_polling.is_set():
+            now = time.time()
+            try:
+                status = self.session.get(f'{self.url}/status',
+                                          timeout=5).json()
+                self.status_samples.append(
+                    (now, status['queued_images'],
+                     finished_images(status) - baseline,
+                     status['processed_images'] - processed_baseline))
+                if self.targets:
+                    detections = self.session.get(f'{self.url}/odlc',
+                                                  timeout=5).json()
+                    self._match_detections(now, detections)
+            except (requests.RequestException, ValueError) as exc:
+                print(f'[ERROR] | Poll: {exc!r}', file=sys.stderr)
+            self.stop_polling.wait(self.poll_interval)
+
+    def _match_detections(self, now, detections):
+        for i, (posted, coords) in enumerate(self.targets):
+            if posted is None or i in self.target_first_seen:
+                continue
+            if any('coords' in d and
+                   distance_feet(d['coords'], coords) <= self.tolerance
+                   for d in detections):
+                self.target_first_seen[i] = now
+
+    def register_targets(self):
+        """
+        Tell the server what to look for, which also clears any detections
+        left over from a previous run
+        """
+        targets = [{'type': 'emergent'}]
+        seen = set()
+        for _, _, truth in self.frames:
+            for target in truth:
+                key = json.dumps(target['class'], sort_keys=True)
+                if key not in seen:
+                    seen.add(key)
+                    targets.append({'type': 'alphanumeric',
+                                    'class': target['class']})
+                self.targets.append([None, target['coords']])
+        self.session.post(f'{self.url}/targets', json=targets,
+                          timeout=10).raise_for_status()
+
+    def run(self, drain_timeout):
+        status = self.session.get(f'{self.url}/status', timeout=5).json()
+        poller = Thread(target=self._poll,
+                        args=(finished_images(status),
+                              status['processed_images']),
+                        daemon=True)
+        poller.start()
+
+        # The target list is flattened in frame order, so find each frame's
+        # slice of it to stamp when its targets were first posted
+        offsets = np.cumsum([0] + [len(t) for _, _, t in self.frames])
+        total = int(self.rate * self.duration)
+        start = time.time()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for i in range(total):
+                # Open-loop schedule, so a slow server doesn't lower the rate
+                delay = start + i / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                frame = i % len(self.frames)
+                data, telemetry, _ = self.frames[frame]
+                for j in range(offsets[frame], offsets[frame + 1]):
+                    if self.targets[j][0] is None:
+                        self.targets[j][0] = time.time()
+                pool.submit(self._post_frame, i, data, telemetry)
+        send_end = time.time()
+
+        # Let the queue drain so every posted frame gets a latency, whether
+        # it was processed or skipped
+        deadline = send_end + drain_timeout
+        while time.time() < deadline:
+            if self.status_samples and \
+               self.status_samples[-1][2] >= len(self.posted) and \
+               self.status_samples[-1][1] == 0:
+                break
+            time.sleep(self.poll_interval)
+        self.stop_polling.set()
+        poller.join()
+        return self.report(start, send_end)
+
+    def report(self, start, send_end):
+        # Frames are taken off the queue in arrival order, so the n-th
+        # finished image is the n-th accepted POST. Deferred frames finish
+        # out of order, which only shuffles latencies between frames
+        posted = sorted(self.posted)
+        latencies = []
+        samples = iter(self.status_samples)
+        sample = next(samples, None)
+        for n, posted_time in enumerate(posted, 1):
+            while sample is not None and sample[2] < n:
+                sample = next(samples, None)
+            if sample is None:
+                break
+            latencies.append(sample[0] - posted_time)
+
+        # Queue growth while sending, in frames per second
+        sending = [(t - start, q) for t, q, _, _ in self.status_samples
+                   if t <= send_end]
+        growth = 0.0
+        if len(sending) >= 2:
+            times, queued = zip(*sending)
+            growth = float(np.polyfit(times, queued, 1)[0])
+
+        achieved = 0.0
+        if len(posted) > 1:
+            achieved = (len(posted) - 1) / (posted[-1] - posted[0])
+
+        detection_latencies = [self.target_first_seen[i] - posted_time
+                               for i, (posted_time, _) in
+                               enumerate(self.targets)
+                               if i in self.target_first_seen]
+
+        return {
+            'rate': self.rate,
+            'sent': len(posted) + self.post_errors,
+            'post_errors': self.post_errors,
+            'achieved_rate': achieved,
+            'post_time': percentiles(self.post_times),
+            'finished': len(latencies),
+            'processed': self.status_samples[-1][3]
+            if self.status_samples else 0,
+            'queue_growth': growth,
+            'max_queued': max((q for _, q, _, _ in self.status_samples),
+                              default=0),
+            'finished_latency': percentiles(latencies),
+            'targets_posted': sum(p is not None for p, _ in self.targets),
+            'targets_detected': len(detection_latencies),
+            'detection_latency': percentiles(detection_latencies),
+        }
+
+
+def sustainable(result, max_growth, max_latency):
+    latency = result['finished_latency']
+    return result['post_errors'] == 0 and \
+        result['finished'] >= result['sent'] and \
+        result['queue_growth'] <= max_growth and \
+        latency is not None and latency['p90'] <= max_latency
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure ingest-to-result latency of a vision server')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images',
+                        help='Directory of frames, optionally with '
+                             'ground_truth.json from synthetic.py')
+    source.add_argument('--synthetic', type=int, metavar='N',
+                        help='Generate N synthetic frames')
+    parser.add_argument('--url', default='http://localhost:8003')
+    parser.add_argument('--rates', type=float, nargs='+', default=[1, 2, 5],
+                        help='Frames per second to test')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Seconds to send at each rate')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Concurrent uploads. Above 1 the server may '
+                             'pair a frame with a neighbour\'s telemetry')
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    parser.add_argument('--drain-timeout', type=float, default=120,
+                        help='Seconds to wait for the queue to empty')
+    parser.add_argument('--tolerance', type=float, default=15,
+                        help='Feet between a detection and its target')
+    parser.add_argument('--max-growth', type=float, default=0.05,
+                        help='Queue growth (frames/s) still sustainable')
+    parser.add_argument('--max-latency', type=float, default=5,
+                        help='p90 finished latency (s) still sustainable')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the report to a file')
+    args = parser.parse_args()
+
+    if args.images:
+        frames = load_directory(args.images)
+    else:
+        frames = generate_frames(args.synthetic, args.seed)
+    if not frames:
+        raise SystemExit('No frames to send')
+
+    results = []
+    for rate in args.rates:
+        print(f'[INFO] | Sending {rate} frames/s for {args.duration}s',
+              file=sys.stderr)
+        load_run = LoadRun(args.url, frames, rate, args.duration,
+                           args.concurrency, args.poll_interval,
+                           args.tolerance)
+        load_run.register_targets()
+        result = load_run.run(args.drain_timeout)
+        result['sustainable'] = sustainable(result, args.max_growth,
+                                            args.max_latency)
+        results.append(result)
+
+    sustained = [r['rate'] for r in results if r['sustainable']]
+    report = {
+        'url': args.url,
+        'frames': len(frames),
+        'results': results,
+        'max_sustainable_rate': max(sustained) if sustained else None,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+
+
+if __name__ == '__main__':
+    main()
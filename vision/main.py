@@ -2,26 +2,43 @@
 Driver file for SUAS Vision subsystem server
 """
 
+from collections import deque
 from queue import Queue
 from threading import Thread
 import os
 import time
 import traceback
 import math
+import json
 
 from flask import Flask, Response, request, jsonify, send_from_directory
 import cv2
-import redis
 
+import latency
+from mavlink_listener import listener as mavlink
+import memory
 import model.drone as drone
+import model.store as store
 import odlc.detector as detector
+import odlc.quality as quality
+import odlc.search_area as search_area
+from profiler import profiler
 import util as util
 
 
 app = Flask(__name__)             # pylint: disable=invalid-name
 image_queue = Queue()
+# Low-quality frames put aside by the 'deprioritize' quality policy
+deferred_images = deque()
+MAX_DEFERRED_IMAGES = int(os.environ.get('QUALITY_MAX_DEFERRED', '50'))
 FILE_PATH = './images/'
-r = redis.Redis(host='redis', port=6379, db=0)
+# Optional /odlc header with the frame's capture telemetry, as JSON in the
+# same form as a /telemetry update
+TELEMETRY_HEADER = 'X-Capture-Telemetry'
+# Optional /odlc header with the autopilot's camera trigger sequence number
+# for the frame, matching the image index of its CAMERA_FEEDBACK
+CAPTURE_INDEX_HEADER = 'X-Capture-Index'
+r = store.connect()
 
 
 @app.route('/')
@@ -46,39 +63,195 @@ def queue_image_for_odlc():
     """
     Queue image POST request
     """
+    # Telemetry sent with the frame was sampled when it was captured, so
+    # prefer it over the latest /telemetry update
+    if TELEMETRY_HEADER in request.headers:
+        try:
+            telemetry = parse_telemetry(
+                json.loads(request.headers[TELEMETRY_HEADER]))
+        except Exception as exc:
+            util.error(repr(exc))
+            return 'Badly formed capture telemetry', 400
+    else:
+        telemetry = drone.get_telemetry()
+    try:
+        capture_index = int(request.headers[CAPTURE_INDEX_HEADER]) \
+            if CAPTURE_INDEX_HEADER in request.headers else None
+    except ValueError as exc:
+        util.error(repr(exc))
+        return 'Badly formed capture index', 400
+    # A frame with a capture index is geotagged with its trigger's pose
+    # when it is processed, so it doesn't need telemetry yet
+    if telemetry is None and capture_index is None:
+        return 'No telemetry to geotag the frame with', 400
+
     # Save file locally, so we can process it using OpenCV
     raw_data = request.get_data()
     file_location = f'{FILE_PATH}/{time.time_ns()}-'
     with open(file_location, 'wb') as file:
         file.write(raw_data)
         image_queue.put({"file_location": file_location,
-                         "telemetry": drone.get_telemetry()})
+                         "telemetry": telemetry,
+                         "capture_telemetry":
+                         TELEMETRY_HEADER in request.headers,
+                         "capture_index": capture_index,
+                         "received": time.monotonic()})
 
     return Response(status=200)
 
 
+def task_telemetry(task):
+    """
+    Telemetry to geotag a queued frame with: its capture telemetry if it
+    came with some, else the CAMERA_FEEDBACK pose of its trigger if the
+    MAVLink listener has it by now, else the telemetry when it was queued,
+    else the latest telemetry. None if there is none of these
+    """
+    if not task.get('capture_telemetry') and \
+            task.get('capture_index') is not None:
+        pose = drone.get_capture_pose(task['capture_index'])
+        if pose is not None:
+            r.incr('vision/telemetry/capture_poses')
+            return pose
+    if task['telemetry'] is not None:
+        return task['telemetry']
+    return drone.get_telemetry()
+
+
+def record_quality(scores, low_quality):
+    r.incr('vision/quality/frames')
+    r.incrbyfloat('vision/quality/sharpness', scores['sharpness'])
+    r.incrbyfloat('vision/quality/clipped',
+                  scores['highlights'] + scores['shadows'])
+    if low_quality:
+        r.incr('vision/quality/low_quality')
+
+
+def defer_image(task):
+    """
+    Put a low-quality frame aside until the queue is empty, dropping the
+    oldest deferred frame if there are too many
+    """
+    task['deferred'] = True
+    deferred_images.append(task)
+    if len(deferred_images) > MAX_DEFERRED_IMAGES:
+        os.remove(deferred_images.popleft()['file_location'])
+        r.incr('vision/quality/dropped')
+
+
+def queued_bytes(tasks):
+    """
+    Disk space taken up by queued frames
+    """
+    total = 0
+    for task in tasks:
+        try:
+            total += os.path.getsize(task['file_location'])
+        except OSError:
+            pass
+    return total
+
+
+def shed_memory():
+    """
+    Free what we can once over the memory soft limit: interpreter and torch
+    caches, debug images waiting to be written and deferred frames
+    """
+    memory.release_caches()
+    cleared = util.debug_writer.clear()
+    dropped = len(deferred_images)
+    while deferred_images:
+        os.remove(deferred_images.popleft()['file_location'])
+        r.incr('vision/quality/dropped')
+    util.info(f'Shed {cleared} debug images and {dropped} deferred images')
+
+
 def process_image_queue(queue):
     util.info('Queue processing thread starting')
     while True:
-        task = queue.get()
+        # Deferred low-quality frames are only processed when idle
+        from_queue = not (queue.empty() and deferred_images)
+        task = queue.get() if from_queue else deferred_images.popleft()
         file_location = task['file_location']
-        telemetry = task['telemetry']
+        telemetry = task_telemetry(task)
         print('Processing queued image')
         start_time = time.time()
+        processed = True
+        profiling = profiler.active
+        if profiling:
+            profiler.begin_image()
 
         # Load file and process
         try:
             img = cv2.imread(file_location, cv2.IMREAD_UNCHANGED)
-            detector.process_queued_image(img, telemetry)
+
+            scores = quality.score(img)
+            low_quality = quality.is_low_quality(scores)
+            if not task.get('deferred'):
+                record_quality(scores, low_quality)
+            weight = 1.0
+            if low_quality and quality.POLICY == 'skip':
+                util.info(f'Skipping low-quality image: {scores}')
+                r.incr('vision/quality/skipped')
+                processed = False
+            elif low_quality and quality.POLICY == 'deprioritize' and \
+                    not task.get('deferred'):
+                util.info(f'Deferring low-quality image: {scores}')
+                defer_image(task)
+                processed = False
+            elif low_quality and quality.POLICY == 'weight':
+                weight = quality.weight(scores)
+
+            if processed and telemetry is None:
+                util.error('No pose for capture '
+                           f'{task["capture_index"]}, dropping the frame')
+                r.incr('vision/telemetry/unposed')
+                processed = False
+
+            if processed:
+                detector.process_queued_image(img, telemetry, weight)
         except Exception:  # pylint: disable=broad-except
             traceback.print_exc()
+        # Don't hold on to the frame while waiting for the next one
+        img = None
+        if profiling:
+            profiler.end_image()
 
         # Delete file and return
-        os.remove(file_location)
-        queue.task_done()
-        util.info('Queued image processed')
-        r.incr('vision/images_processed')
-        r.incrbyfloat('vision/active_time', time.time() - start_time)
+        if not task.get('deferred') or processed:
+            os.remove(file_location)
+        if from_queue:
+            queue.task_done()
+        if processed:
+            util.info('Queued image processed')
+            r.incr('vision/images_processed')
+            if 'timing' in telemetry:
+                latency.tracker.record(telemetry['timing'], task['received'],
+                                       time.monotonic())
+            if memory.monitor.record_image():
+                shed_memory()
+            util.debug_writer.paused = memory.monitor.shedding
+            # Skipped and deferred frames are left out of time_per_image
+            # along with images_processed
+            r.incrbyfloat('vision/active_time', time.time() - start_time)
+
+
+def parse_telemetry(req):
+    """
+    Check a telemetry update and convert its coordinates to radians
+    """
+    assert 'altitude' in req
+    assert 'latitude' in req
+    assert 'longitude' in req
+    assert 'heading' in req
+    # Roll and pitch (radians) are optional, assumed level if missing
+    assert type(req.get('roll', 0.0)) in (int, float)
+    assert type(req.get('pitch', 0.0)) in (int, float)
+    # Capture timing (time.monotonic() seconds per stage) is optional
+    assert isinstance(req.get('timing', {}), dict)
+    req['latitude'] = math.radians(req['latitude'])
+    req['longitude'] = math.radians(req['longitude'])
+    return req
 
 
 @app.route('/telemetry', methods=['POST'])
@@ -90,14 +263,7 @@ def update_telemetry():
     # Push updates to drone telemetry
     # If any info is missing, throw an error
     try:
-        req = request.json
-        assert 'altitude' in req
-        assert 'latitude' in req
-        assert 'longitude' in req
-        assert 'heading' in req
-        req['latitude'] = math.radians(req['latitude'])
-        req['longitude'] = math.radians(req['longitude'])
-        drone.update_telemetry(req)
+        drone.update_telemetry(parse_telemetry(request.json))
     except Exception as exc:
         util.error(repr(exc))
         return 'Badly formed telemetry update', 400
@@ -106,6 +272,31 @@ def update_telemetry():
     return Response(status=200)
 
 
+@app.route('/telemetry/batch', methods=['POST'])
+def update_telemetry_batch():
+    """
+    Update telemetry with a batch of timestamped samples POST request
+    """
+    try:
+        samples = [parse_telemetry(sample) for sample in request.json]
+        assert all(type(sample['timestamp']) in (int, float)
+                   for sample in samples)
+    except Exception as exc:
+        util.error(repr(exc))
+        return 'Badly formed telemetry batch', 400
+
+    # Only the newest sample matters, and only if it's newer than what we
+    # have (batches can arrive out of order when the sender retries)
+    r.incr('vision/telemetry/batches')
+    r.incr('vision/telemetry/samples', len(samples))
+    if samples:
+        latest = max(samples, key=lambda sample: sample['timestamp'])
+        if not drone.update_telemetry_if_newer(latest):
+            r.incr('vision/telemetry/stale')
+
+    return Response(status=200)
+
+
 @app.route('/targets', methods=['POST'])
 def update_targets():
     """
@@ -141,6 +332,115 @@ def update_targets():
     return Response(status=200)
 
 
+@app.route('/recluster', methods=['POST'])
+def recluster_detections():
+    """
+    Rebuild detections from the observation log POST request
+    """
+    return jsonify({'detections': detector.recluster()})
+
+
+@app.route('/search_area', methods=['POST'])
+def update_search_area():
+    """
+    Update search area POST request
+    Expects a list of [latitude, longitude] points in degrees
+    """
+    try:
+        points = request.get_json()
+        assert len(points) >= 3
+        for point in points:
+            assert len(point) == 2
+            assert all(type(c) in (int, float) for c in point)
+        search_area.set_area(points)
+    except Exception as exc:
+        util.error(repr(exc))
+        return 'Badly formed search area update', 400
+
+    # Return empty response for success (check status code for semantics)
+    return Response(status=200)
+
+
+@app.route('/profile', methods=['POST'])
+def start_profile():
+    """
+    Start profiling the worker POST request
+    Expects {"images": N} and/or {"seconds": S}, optionally with
+    "mode": "cprofile" or "sample" (PROFILE_MODE by default)
+    """
+    try:
+        req = request.json
+        profiler.start(req.get('mode'), req.get('images'),
+                       req.get('seconds'))
+    except Exception as exc:
+        util.error(repr(exc))
+        return 'Badly formed profiling request', 400
+
+    # Return empty response for success (check status code for semantics)
+    return Response(status=200)
+
+
+@app.route('/profile', methods=['GET'])
+def get_profile():
+    """
+    Get profiling session status GET request
+    """
+    return jsonify(profiler.status())
+
+
+@app.route('/memory', methods=['GET'])
+def get_memory():
+    """
+    Get memory usage GET request
+    """
+    try:
+        limit = int(request.args.get('limit', 20))
+        if limit < 0:
+            raise ValueError(f'Negative allocation limit {limit}')
+    except ValueError as exc:
+        util.error(repr(exc))
+        return 'Badly formed allocation limit', 400
+
+    with image_queue.mutex:
+        queued = list(image_queue.queue)
+    detections = r.get('detector/detections') or b''
+    status = memory.monitor.status()
+    status.update({
+        'detection_store_bytes': len(detections),
+        'observation_log_bytes': r.strlen('detector/observations'),
+        'queued_images': len(queued),
+        'queued_bytes': queued_bytes(queued),
+        'deferred_images': len(deferred_images),
+        'deferred_bytes': queued_bytes(list(deferred_images)),
+        'debug_images': util.debug_writer.status(),
+        'tracemalloc': memory.top_allocators(limit),
+    })
+    return jsonify(status)
+
+
+@app.route('/memory', methods=['POST'])
+def update_memory():
+    """
+    Start or stop tracemalloc POST request
+    Expects {"tracemalloc": true or false}, optionally with "frames", the
+    traceback depth to record
+    """
+    try:
+        req = request.json
+        assert isinstance(req['tracemalloc'], bool)
+        if req['tracemalloc']:
+            memory.start_tracing(int(req.get('frames',
+                                             memory.TRACEMALLOC_FRAMES)))
+        else:
+            memory.stop_tracing()
+    except Exception as exc:
+        util.error(repr(exc))
+        return 'Badly formed memory request', 400
+
+    # Return empty response for success (check status code for semantics)
+    return Response(status=200)
+
+
 @app.route('/status', methods=['GET'])
 def get_status():
     """
@@ -152,11 +452,42 @@ def get_status():
                     decode('utf-8')) / num_processed
     else:
         tpi = 0.0
+    num_scored = int(r.get('vision/quality/frames').decode('utf-8'))
+    quality_status = {
+        'low_quality_images':
+            int(r.get('vision/quality/low_quality').decode('utf-8')),
+        'skipped_images':
+            int(r.get('vision/quality/skipped').decode('utf-8')),
+        'deferred_images': len(deferred_images),
+        'dropped_images':
+            int(r.get('vision/quality/dropped').decode('utf-8')),
+        'mean_sharpness': 0.0,
+        'mean_clipped': 0.0,
+    }
+    if num_scored > 0:
+        quality_status['mean_sharpness'] = float(
+            r.get('vision/quality/sharpness').decode('utf-8')) / num_scored
+        quality_status['mean_clipped'] = float(
+            r.get('vision/quality/clipped').decode('utf-8')) / num_scored
     status = {
         'processed_images': num_processed,
         'queued_images': image_queue.qsize(),
-        'time_per_image': tpi
+        'time_per_image': tpi,
+        'quality': quality_status,
+        'debug_images': util.debug_writer.status(),
+        'memory': {
+            'rss': memory.rss_bytes(),
+            'peak_rss': memory.peak_rss_bytes(),
+            'shedding': memory.monitor.shedding,
+        },
+        'latency': latency.tracker.status(),
+        'telemetry': {key: int(r.get(f'vision/telemetry/{key}').
+                               decode('utf-8'))
+                      for key in ['batches', 'samples', 'stale',
+                                  'capture_poses', 'unposed']},
     }
+    if mavlink.url:
+        status['mavlink'] = mavlink.status()
 
     return jsonify(status)
 
@@ -167,3 +498,10 @@ worker.start()
 
 r.set('vision/images_processed', 0)
 r.set('vision/active_time', 0.0)
+for key in ['frames', 'low_quality', 'skipped', 'dropped']:
+    r.set(f'vision/quality/{key}', 0)
+for key in ['batches', 'samples', 'stale', 'capture_poses',
+            'unposed']:
+    r.set(f'vision/telemetry/{key}', 0)
+for key in ['sharpness', 'clipped']:
+    r.set(f'vision/quality/{key}', 0.0)
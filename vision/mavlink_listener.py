@@ -0,0 +1,154 @@
+"""
+Direct MAVLink telemetry for the vision server
+
+When MAVLINK_URL is set (e.g. udpin:0.0.0.0:14550), a background thread
+subscribes to the autopilot's MAVLink stream with pymavlink and writes
+telemetry straight into the store drone.get_telemetry reads from, instead
+of waiting for the flight computer to relay it over HTTP:
+    GLOBAL_POSITION_INT - latitude, longitude, altitude above home, heading
+    ATTITUDE            - roll and pitch (and yaw when heading is unknown)
+    CAMERA_FEEDBACK     - the pose at each camera trigger, stored by image
+                          index (see drone.get_capture_pose) for frames
+                          posted to /odlc with that X-Capture-Index
+Values are converted to the units of a /telemetry update after its degree
+to radian conversion: radians and inches.
+
+mavlink_replay.py can stand in for a vehicle.
+"""
+
+import math
+import os
+import time
+from threading import Thread
+
+import model.drone as drone
+import util
+
+MAVLINK_URL = os.environ.get('MAVLINK_URL', '')
+# Seconds to wait for a message, and before reconnecting after an error
+MAVLINK_TIMEOUT = float(os.environ.get('MAVLINK_TIMEOUT', '5'))
+MESSAGES = ['GLOBAL_POSITION_INT', 'ATTITUDE', 'CAMERA_FEEDBACK']
+INCHES_PER_METER = 39.3701
+UNKNOWN_HEADING = 65535
+
+
+class MavlinkListener:
+    """
+    Folds MAVLink messages into drone telemetry
+    """
+
+    def __init__(self, url=MAVLINK_URL, timeout=MAVLINK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.attitude = None
+        self.running = False
+        self.connection = None
+        self.counts = {name: 0 for name in MESSAGES}
+        self.last_message = None
+
+    def handle(self, msg):
+        """
+        Update telemetry from one message
+        """
+        name = msg.get_type()
+        if name not in self.counts:
+            return
+        self.counts[name] += 1
+        self.last_message = time.time()
+
+        if name == 'ATTITUDE':
+            self.attitude = msg
+        elif name == 'GLOBAL_POSITION_INT':
+            # HTTP and batch updates may carry later samples
+            drone.update_telemetry_if_newer(self.position_telemetry(msg))
+        elif name == 'CAMERA_FEEDBACK':
+            drone.record_capture_pose(msg.img_idx,
+                                      feedback_telemetry(msg))
+
+    def position_telemetry(self, msg):
+        if msg.hdg != UNKNOWN_HEADING:
+            heading = math.radians(msg.hdg / 100)
+        elif self.attitude is not None:
+            heading = self.attitude.yaw
+        else:
+            heading = 0.0
+        telemetry = {
+            'altitude': msg.relative_alt / 1000 * INCHES_PER_METER,
+            'latitude': math.radians(msg.lat / 1e7),
+            'longitude': math.radians(msg.lon / 1e7),
+            'heading': heading,
+            'timestamp': time.time(),
+            'source': 'mavlink',
+        }
+        if self.attitude is not None:
+            telemetry['roll'] = self.attitude.roll
+            telemetry['pitch'] = self.attitude.pitch
+        return telemetry
+
+    def connect(self):
+        # Only needed when the listener is enabled
+        from pymavlink import mavutil
+
+        util.info(f'Listening for MAVLink on {self.url}')
+        self.connection = mavutil.mavlink_connection(
+            self.url, source_system=255, dialect='ardupilotmega')
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                if self.connection is None:
+                    self.connect()
+                msg = self.connection.recv_match(type=MESSAGES, blocking=True,
+                                                 timeout=self.timeout)
+            except Exception as exc:  # pylint: disable=broad-except
+                util.error(f'MAVLink connection failed: {exc!r}')
+                self.close()
+                time.sleep(self.timeout)
+                continue
+            if msg is not None:
+                self.handle(msg)
+        self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def status(self):
+        return {
+            'url': self.url,
+            'connected': self.connection is not None,
+            'messages': dict(self.counts),
+            'seconds_since_message': time.time() - self.last_message
+            if self.last_message is not None else None,
+        }
+
+
+def feedback_telemetry(msg):
+    """
+    Pose of a CAMERA_FEEDBACK message, in /telemetry units after conversion
+    """
+    return {
+        'altitude': msg.alt_rel * INCHES_PER_METER,
+        'latitude': math.radians(msg.lat / 1e7),
+        'longitude': math.radians(msg.lng / 1e7),
+        'heading': math.radians(msg.yaw),
+        'roll': math.radians(msg.roll),
+        'pitch': math.radians(msg.pitch),
+        'time_usec': msg.time_usec,
+        'image_index': msg.img_idx,
+        'timestamp': time.time(),
+        'source': 'camera_feedback',
+    }
+
+
+listener = MavlinkListener()
+if MAVLINK_URL:
+    listener.start()
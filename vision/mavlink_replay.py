@@ -0,0 +1,135 @@
+"""
+Stand-in vehicle for the MAVLink listener
+
+Sends a MAVLink stream to a vision server's MAVLINK_URL, either replaying a
+telemetry log (.tlog, as saved by MAVProxy or Mission Planner) with its
+original timing, or simulating a plane flying a circle that sends
+HEARTBEAT, GLOBAL_POSITION_INT and ATTITUDE at --rate Hz and a
+CAMERA_FEEDBACK every --trigger-interval seconds.
+
+Examples:
+    python3 mavlink_replay.py --url udpout:localhost:14550
+    python3 mavlink_replay.py --tlog flight.tlog --speed 2
+"""
+
+import argparse
+import math
+import time
+
+from pymavlink import mavutil
+
+FEET_PER_DEGREE = 364000.0
+FEET_PER_METER = 3.28084
+
+
+def simulated_messages(mav, latitude, longitude, altitude, radius, speed,
+                       rate, trigger_interval, duration):
+    """
+    Yields (seconds from start, message) for a plane circling
+    latitude, longitude at altitude (m) and speed (m/s)
+    """
+    period = 1 / rate
+    bank = math.atan(speed ** 2 / (9.81 * radius))
+    next_trigger = trigger_interval
+    image = 0
+    for i in range(int(duration * rate)):
+        t = i * period
+        angle = speed * t / radius
+        north = radius * math.sin(angle) * FEET_PER_METER
+        east = radius * (1 - math.cos(angle)) * FEET_PER_METER
+        lat = latitude + north / FEET_PER_DEGREE
+        lon = longitude + east / FEET_PER_DEGREE / \
+            math.cos(math.radians(latitude))
+        yaw = angle % (2 * math.pi)
+        lat_e7, lon_e7 = int(lat * 1e7), int(lon * 1e7)
+        boot_ms = int(t * 1000)
+
+        if i % rate == 0:
+            yield t, mav.heartbeat_encode(
+                mavutil.mavlink.MAV_TYPE_FIXED_WING,
+                mavutil.mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA, 0, 0, 0)
+        yield t, mav.attitude_encode(boot_ms, bank, 0.0, yaw, 0.0, 0.0, 0.0)
+        yield t, mav.global_position_int_encode(
+            boot_ms, lat_e7, lon_e7, int(altitude * 1000),
+            int(altitude * 1000), int(speed * math.cos(yaw) * 100),
+            int(speed * math.sin(yaw) * 100), 0,
+            int(math.degrees(yaw) * 100))
+        if trigger_interval and t >= next_trigger:
+            yield t, mav.camera_feedback_encode(
+                int(time.time() * 1e6), 1, 0, image, lat_e7, lon_e7,
+                altitude, altitude, math.degrees(bank), 0.0,
+                math.degrees(yaw), 0.0, 0)
+            image += 1
+            next_trigger += trigger_interval
+
+
+def tlog_messages(path):
+    """
+    Yields (seconds from the first message, message) from a telemetry log
+    """
+    log = mavutil.mavlink_connection(path)
+    start = None
+    while True:
+        msg = log.recv_match()
+        if msg is None:
+            return
+        if msg.get_type() == 'BAD_DATA':
+            continue
+        stamp = getattr(msg, '_timestamp', 0.0)
+        if start is None:
+            start = stamp
+        yield stamp - start, msg
+
+
+def replay(connection, messages, speed):
+    start = time.time()
+    sent = 0
+    for offset, msg in messages:
+        delay = start + offset / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        connection.mav.send(msg)
+        sent += 1
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Send MAVLink telemetry to the vision server')
+    parser.add_argument('--url', default='udpout:localhost:14550',
+                        help='pymavlink connection string to send to')
+    parser.add_argument('--tlog', help='Replay this telemetry log instead '
+                                       'of simulating a flight')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed multiplier')
+    parser.add_argument('--latitude', type=float, default=38.3143)
+    parser.add_argument('--longitude', type=float, default=-76.544)
+    parser.add_argument('--altitude', type=float, default=30.5,
+                        help='Metres above home')
+    parser.add_argument('--radius', type=float, default=150,
+                        help='Circle radius in metres')
+    parser.add_argument('--airspeed', type=float, default=18,
+                        help='Metres per second')
+    parser.add_argument('--rate', type=int, default=20,
+                        help='Position and attitude messages per second')
+    parser.add_argument('--trigger-interval', type=float, default=1.0,
+                        help='Seconds between CAMERA_FEEDBACK messages, '
+                             '0 for none')
+    parser.add_argument('--duration', type=float, default=60)
+    args = parser.parse_args()
+
+    connection = mavutil.mavlink_connection(args.url, source_system=1,
+                                            dialect='ardupilotmega')
+    if args.tlog:
+        messages = tlog_messages(args.tlog)
+    else:
+        messages = simulated_messages(
+            connection.mav, args.latitude, args.longitude, args.altitude,
+            args.radius, args.airspeed, args.rate, args.trigger_interval,
+            args.duration)
+    sent = replay(connection, messages, args.speed)
+    print(f'Sent {sent} messages')
+
+
+if __name__ == '__main__':
+    main()
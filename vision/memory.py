@@ -0,0 +1,149 @@
+"""
+Memory accounting for long-running servers
+
+Records resident set size after every processed image, can trace Python
+allocations with tracemalloc on demand, and reports when RSS goes over
+MEMORY_SOFT_LIMIT_MB so the server can shed memory. Shedding stays on
+until RSS falls back under MEMORY_SOFT_LIMIT_RESUME of the limit.
+"""
+
+import gc
+import os
+import resource
+import sys
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+import util
+
+SOFT_LIMIT = float(os.environ.get('MEMORY_SOFT_LIMIT_MB', '0')) * 2**20
+SOFT_LIMIT_RESUME = float(os.environ.get('MEMORY_SOFT_LIMIT_RESUME', '0.9'))
+HISTORY = int(os.environ.get('MEMORY_HISTORY', '1000'))
+TRACEMALLOC = int(os.environ.get('MEMORY_TRACEMALLOC', '0')) == 1
+TRACEMALLOC_FRAMES = int(os.environ.get('MEMORY_TRACEMALLOC_FRAMES', '10'))
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_bytes():
+    """
+    Current resident set size, or the peak where /proc isn't available
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def release_caches():
+    """
+    Hand back memory held by the garbage collector and torch's allocator
+    """
+    collected = gc.collect()
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return collected
+
+
+class MemoryMonitor:
+    """
+    Per-image RSS history and soft limit state
+    """
+
+    def __init__(self, soft_limit=SOFT_LIMIT, resume=SOFT_LIMIT_RESUME,
+                 history=HISTORY):
+        self.soft_limit = soft_limit
+        self.resume = resume
+        self.samples = deque(maxlen=history)    # (image number, rss)
+        self.images = 0
+        self.shedding = False
+        self.shed_events = 0
+
+    def record_image(self):
+        """
+        Record RSS after an image has been processed
+        Returns True when memory has just gone over the soft limit
+        """
+        rss = rss_bytes()
+        self.images += 1
+        self.samples.append((self.images, rss))
+        if not self.soft_limit:
+            return False
+
+        if self.shedding:
+            if rss < self.soft_limit * self.resume:
+                util.info(f'Memory back under the soft limit: {rss} bytes')
+                self.shedding = False
+            return False
+        if rss > self.soft_limit:
+            util.error(f'Memory over the soft limit: {rss} bytes')
+            self.shedding = True
+            self.shed_events += 1
+            return True
+        return False
+
+    def growth(self):
+        """
+        Least-squares RSS growth in bytes per image over the history
+        """
+        if len(self.samples) < 2:
+            return 0.0
+        images, rss = zip(*self.samples)
+        if images[0] == images[-1]:
+            return 0.0
+        return float(np.polyfit(images, rss, 1)[0])
+
+    def status(self):
+        return {
+            'rss': rss_bytes(),
+            'peak_rss': peak_rss_bytes(),
+            'last_image_rss': self.samples[-1][1] if self.samples else None,
+            'images': self.images,
+            'growth_per_image': self.growth(),
+            'soft_limit': self.soft_limit,
+            'shedding': self.shedding,
+            'shed_events': self.shed_events,
+        }
+
+
+def start_tracing(frames=TRACEMALLOC_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def stop_tracing():
+    tracemalloc.stop()
+
+
+def top_allocators(limit=20, group_by='lineno'):
+    """
+    Largest live Python allocations since tracing started, or None if
+    tracemalloc isn't running
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'traced': current,
+        'traced_peak': peak,
+        'top': [{'location': str(stat.traceback[0]), 'size': stat.size,
+                 'count': stat.count}
+                for stat in snapshot.statistics(group_by)[:limit]],
+    }
+
+
+monitor = MemoryMonitor()
+if TRACEMALLOC:
+    start_tracing()
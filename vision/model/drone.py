@@ -2,10 +2,13 @@
 Minimal wrapper class for Drone telemetry model and closely related methods
 """
 import json
+import os
 
-import redis
+from model import store
 
-r = redis.Redis(host='redis', port=6379, db=0)
+r = store.connect()
+# Camera trigger poses kept, by image index
+CAPTURE_HISTORY = int(os.environ.get('CAPTURE_HISTORY', '1000'))
 
 
 def update_telemetry(telemetry):
@@ -13,5 +16,43 @@ def update_telemetry(telemetry):
     r.set('drone/telemetry', json.dumps(telemetry))
 
 
+def update_telemetry_if_newer(telemetry):
+    """
+    Update telemetry unless the stored telemetry has a later timestamp
+    Returns whether it was updated
+    """
+    current = r.get('drone/telemetry')
+    if current is not None:
+        stored = json.loads(current.decode('utf-8')).get('timestamp')
+        if stored is not None and stored >= telemetry['timestamp']:
+            return False
+    update_telemetry(telemetry)
+    return True
+
+
 def get_telemetry():
-    return json.loads(r.get('drone/telemetry').decode('utf-8'))
+    """
+    Latest telemetry, or None if none has been received
+    """
+    telemetry = r.get('drone/telemetry')
+    if telemetry is None:
+        return None
+    return json.loads(telemetry.decode('utf-8'))
+
+
+def record_capture_pose(index, telemetry):
+    """
+    Store the pose the autopilot reported for camera trigger index
+    """
+    r.set(f'drone/capture/{index}', json.dumps(telemetry))
+    r.delete(f'drone/capture/{index - CAPTURE_HISTORY}')
+
+
+def get_capture_pose(index):
+    """
+    Pose of camera trigger index, or None if it hasn't been reported
+    """
+    telemetry = r.get(f'drone/capture/{index}')
+    if telemetry is None:
+        return None
+    return json.loads(telemetry.decode('utf-8'))
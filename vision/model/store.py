@@ -0,0 +1,67 @@
+"""
+Shared key-value store for vision subsystem state
+
+Redis by default. STATE_BACKEND=memory swaps in an in-process store with
+the same (small) subset of the Redis API, for offline tools that run the
+pipeline without a Redis server.
+"""
+import os
+from threading import Lock
+
+import redis
+
+
+class MemoryStore:
+    """In-process stand-in for the Redis commands the server uses"""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def _encode(value):
+        # Store values as bytes, the way Redis returns them
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return repr(value).encode('utf-8')
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = self._encode(value)
+        return True
+
+    def append(self, key, value):
+        with self.lock:
+            self.data[key] = self.data.get(key, b'') + self._encode(value)
+            return len(self.data[key])
+
+    def strlen(self, key):
+        return len(self.data.get(key, b''))
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = int(self.data.get(key, b'0')) + amount
+            self.data[key] = self._encode(value)
+        return value
+
+    def incrbyfloat(self, key, amount=1.0):
+        with self.lock:
+            value = float(self.data.get(key, b'0')) + amount
+            self.data[key] = self._encode(value)
+        return value
+
+
+_memory_store = MemoryStore()
+
+
+def connect():
+    if os.environ.get('STATE_BACKEND', 'redis') == 'memory':
+        return _memory_store
+    return redis.Redis(host='redis', port=6379, db=0)
@@ -0,0 +1,153 @@
+"""
+Full-attitude, distortion-corrected camera projection model
+
+Pixels are undistorted once per camera configuration into a table of
+normalized ray directions sampled on a coarse grid. Geotagging a pixel is
+then a bilinear table lookup, a rotation by the drone's attitude and a
+ground plane intersection, followed by the same great-circle step gps.tag
+uses.
+
+Frames follow the gps.tag convention: image +y points along the heading
+and image +x to its right, with the camera looking straight down when roll
+and pitch are zero. Attitude is applied as yaw (heading), then pitch, then
+roll, all in radians.
+"""
+
+import functools
+import os
+
+import cv2
+import numpy as np
+
+from odlc import gps
+
+# Brown-Conrady coefficients: k1, k2, p1, p2, k3
+DISTORTION = tuple(float(c) for c in os.environ.get(
+    'CAMERA_DISTORTION', '0,0,0,0,0').split(','))
+# Spacing in pixels between entries of the ray table
+GRID_STEP = int(os.environ.get('CAMERA_RAY_GRID_STEP', '16'))
+
+
+class CameraModel:
+    """
+    Precomputed ray table for one camera configuration
+    """
+
+    def __init__(self, sensor_width, focal_length, image_width,
+                 image_height, distortion=DISTORTION, grid_step=GRID_STEP):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.grid_step = grid_step
+
+        # Focal length in pixels, principal point at the image center
+        f = focal_length * image_width / sensor_width
+        matrix = np.array([[f, 0, image_width / 2],
+                           [0, f, image_height / 2],
+                           [0, 0, 1]], dtype=np.float64)
+
+        # Sample the grid up to and including the far image edges
+        xs = np.append(np.arange(0, image_width, grid_step), image_width)
+        ys = np.append(np.arange(0, image_height, grid_step), image_height)
+        self.grid_x = xs.astype(np.float64)
+        self.grid_y = ys.astype(np.float64)
+        grid = np.stack(np.meshgrid(self.grid_x, self.grid_y), axis=2)
+
+        # Undistorted, normalized (x / z, y / z) ray for each grid point
+        undistorted = cv2.undistortPoints(grid.reshape(-1, 1, 2), matrix,
+                                          np.array(distortion))
+        self.rays = undistorted.reshape(len(ys), len(xs), 2)
+
+    def normalized_rays(self, target_x, target_y):
+        """
+        Bilinearly interpolate the ray table at the given pixels
+
+        Returns an (n, 2) array of normalized (x, y) ray directions
+        """
+        target_x = np.clip(np.asarray(target_x, dtype=np.float64),
+                           0, self.image_width)
+        target_y = np.clip(np.asarray(target_y, dtype=np.float64),
+                           0, self.image_height)
+
+        col = np.searchsorted(self.grid_x, target_x, side='right') - 1
+        row = np.searchsorted(self.grid_y, target_y, side='right') - 1
+        col = np.clip(col, 0, len(self.grid_x) - 2)
+        row = np.clip(row, 0, len(self.grid_y) - 2)
+
+        tx = (target_x - self.grid_x[col]) / \
+            (self.grid_x[col + 1] - self.grid_x[col])
+        ty = (target_y - self.grid_y[row]) / \
+            (self.grid_y[row + 1] - self.grid_y[row])
+        tx, ty = tx[:, None], ty[:, None]
+
+        top = self.rays[row, col] * (1 - tx) + self.rays[row, col + 1] * tx
+        bottom = self.rays[row + 1, col] * (1 - tx) + \
+            self.rays[row + 1, col + 1] * tx
+        return top * (1 - ty) + bottom * ty
+
+    def ground_offsets(self, altitude, roll, pitch, yaw, target_x, target_y):
+        """
+        Intersect pixel rays with flat ground
+
+        Returns the north and east offsets of each pixel from the drone, in
+        the units of altitude. Rays that don't hit the ground are NaN.
+        """
+        rays = self.normalized_rays(target_x, target_y)
+        # Body frame (forward, right, down)
+        body = np.stack([rays[:, 1], rays[:, 0], np.ones(len(rays))])
+
+        rotation = rotation_matrix(roll, pitch, yaw)
+        north, east, down = rotation @ body
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(down > 1e-9, altitude / down, np.nan)
+        return north * scale, east * scale
+
+    def geotag(self, altitude, latitude, longitude, roll, pitch, yaw,
+               target_x, target_y):
+        """
+        Geotag pixels, with the same units as gps.tag
+
+        Returns arrays of latitudes and longitudes in radians, NaN for
+        pixels whose ray doesn't hit the ground
+        """
+        north, east = self.ground_offsets(altitude, roll, pitch, yaw,
+                                          target_x, target_y)
+        return gps.destination(latitude, longitude, np.arctan2(east, north),
+                               np.hypot(north, east))
+
+
+def rotation_matrix(roll, pitch, yaw):
+    """
+    Body (forward, right, down) to local (north, east, down) rotation
+    """
+    cr, sr = np.cos(roll), np.sin(roll)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    return np.array([
+        [cp * cy, sr * sp * cy - cr * sy, cr * sp * cy + sr * sy],
+        [cp * sy, sr * sp * sy + cr * cy, cr * sp * sy - sr * cy],
+        [-sp, sr * cp, cr * cp],
+    ])
+
+
+@functools.lru_cache(maxsize=8)
+def get_camera(image_width, image_height, sensor_width=gps.SENSOR_WIDTH,
+               focal_length=gps.FOCAL_LENGTH, distortion=DISTORTION,
+               grid_step=GRID_STEP):
+    """
+    Cached camera model, built once per camera configuration
+    """
+    return CameraModel(sensor_width, focal_length, image_width,
+                       image_height, distortion, grid_step)
+
+
+def geotag_pixels(telemetry, image_width, image_height, target_x, target_y):
+    """
+    Geotag pixels of a frame using its telemetry
+    Roll and pitch default to 0 when the telemetry doesn't include them
+    """
+    model = get_camera(image_width, image_height)
+    return model.geotag(telemetry['altitude'], telemetry['latitude'],
+                        telemetry['longitude'], telemetry.get('roll', 0.0),
+                        telemetry.get('pitch', 0.0), telemetry['heading'],
+                        target_x, target_y)
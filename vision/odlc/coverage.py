@@ -0,0 +1,116 @@
+"""
+Ground footprint computation and coverage tracking
+
+Each frame's footprint is the quadrilateral formed by geotagging its four
+corners. Processed footprints are accumulated into a raster of visit counts
+in a local frame (feet north/east of the first footprint), so frames that
+only cover ground that has already been processed often enough can be
+skipped.
+"""
+
+import math
+import os
+
+import cv2
+import numpy as np
+
+from odlc import camera
+
+# Minimum fraction of new ground a frame must add; 0 disables skipping
+MIN_NEW_COVERAGE = float(os.environ.get('COVERAGE_MIN_NEW', '0'))
+# Number of times ground has to be processed before it counts as covered
+MIN_REVISITS = int(os.environ.get('COVERAGE_MIN_REVISITS', '1'))
+CELL_SIZE = float(os.environ.get('COVERAGE_CELL_SIZE', '5'))  # feet
+EXTENT = float(os.environ.get('COVERAGE_EXTENT', '6000'))  # feet
+
+FEET_PER_DEGREE = 364000.0
+
+
+def footprint(telemetry, image_width, image_height):
+    """
+    Returns the frame's footprint as a list of four [lat, lon] corners in
+    degrees, ordered around the frame, or None if part of the frame is
+    above the horizon
+    """
+    lats, lons = camera.geotag_pixels(telemetry, image_width, image_height,
+                                      [0, image_width, image_width, 0],
+                                      [0, 0, image_height, image_height])
+    if np.isnan(lats).any() or np.isnan(lons).any():
+        return None
+    return np.stack([np.degrees(lats), np.degrees(lons)], axis=1).tolist()
+
+
+class CoverageRaster:
+    """
+    Raster of how many times each ground cell has been processed
+    """
+
+    def __init__(self, cell_size=CELL_SIZE, extent=EXTENT):
+        self.cell_size = cell_size
+        self.size = int(math.ceil(extent / cell_size))
+        self.counts = np.zeros((self.size, self.size), np.uint8)
+        self.origin = None
+
+    def reset(self):
+        self.counts[:] = 0
+        self.origin = None
+
+    def _cells(self, polygon):
+        """
+        Rasterize a lat/lon polygon into a mask over the grid, returning the
+        mask and the bounding (row, col) slices it covers
+        """
+        if self.origin is None:
+            self.origin = np.mean(polygon, axis=0)
+        lat0, lon0 = self.origin
+
+        points = np.asarray(polygon, dtype=np.float64)
+        north = (points[:, 0] - lat0) * FEET_PER_DEGREE
+        east = (points[:, 1] - lon0) * FEET_PER_DEGREE * \
+            math.cos(math.radians(lat0))
+
+        # Grid rows grow southwards, columns eastwards, origin centered
+        rows = self.size / 2 - north / self.cell_size
+        cols = self.size / 2 + east / self.cell_size
+
+        r1 = max(0, int(math.floor(rows.min())))
+        r2 = min(self.size, int(math.ceil(rows.max())) + 1)
+        c1 = max(0, int(math.floor(cols.min())))
+        c2 = min(self.size, int(math.ceil(cols.max())) + 1)
+        if r1 >= r2 or c1 >= c2:
+            return None, None
+
+        mask = np.zeros((r2 - r1, c2 - c1), np.uint8)
+        vertices = np.stack([cols - c1, rows - r1], axis=1)
+        cv2.fillPoly(mask, [np.int32(np.round(vertices))], 1)
+        return mask.astype(bool), (slice(r1, r2), slice(c1, c2))
+
+    def new_fraction(self, polygon, min_revisits=MIN_REVISITS):
+        """
+        Fraction of the footprint processed fewer than min_revisits times
+        Footprints outside the raster are treated as entirely new
+        """
+        mask, window = self._cells(polygon)
+        if mask is None or not mask.any():
+            return 1.0
+        counts = self.counts[window][mask]
+        return float(np.count_nonzero(counts < min_revisits)) / counts.size
+
+    def add(self, polygon):
+        mask, window = self._cells(polygon)
+        if mask is None:
+            return
+        view = self.counts[window]
+        view[mask & (view < 255)] += 1
+
+
+raster = CoverageRaster()
+
+
+def should_process(polygon):
+    """
+    Whether a frame's footprint adds enough new (or unconfirmed) coverage
+    """
+    if MIN_NEW_COVERAGE <= 0:
+        return True
+    return raster.new_fraction(polygon) >= MIN_NEW_COVERAGE
@@ -0,0 +1,326 @@
+"""
+Compact detection records
+
+Classification votes are kept in one fixed-index vector per detection,
+laid out as [text-color | shape-color | shape | text] over the known
+vocabularies, so merging an observation is a single vector add and target
+similarity is computed for every target/detection pair at once. The
+detection list is stored as packed arrays rather than JSON.
+
+Each detection's location is the running (Welford) mean of its
+observations, with their covariance kept in feet in a local north/east
+frame, so the spread of a detection is known without storing every
+observation.
+
+Every raw observation is also appended to a fixed-size record log, so the
+detection set can be rebuilt by clustering all observations at once
+instead of depending on the order greedy merging saw them in.
+"""
+
+import math
+import struct
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from odlc.color_detection import COLOR_RANGES
+from odlc.coverage import FEET_PER_DEGREE
+from odlc.MobilenetWrapper import POSSIBLE_TEXTS
+
+COLORS = list(dict.fromkeys(name for name, _, _ in COLOR_RANGES)) + \
+    ['white', 'black', 'gray', 'brown']
+SHAPES = ['circle', 'semicircle', 'quarter-circle', 'triangle', 'square',
+          'rectangle', 'trapezoid', 'pentagon', 'hexagon', 'heptagon',
+          'octagon', 'star', 'cross']
+TEXTS = list(POSSIBLE_TEXTS)
+CATEGORIES = [('text-color', COLORS), ('shape-color', COLORS),
+              ('shape', SHAPES), ('text', TEXTS)]
+TYPES = ['emergent', 'alphanumeric']
+
+# Slice of the vote vector and label -> index for each category
+SLICES = {}
+INDEX = {}
+_offset = 0
+for _category, _labels in CATEGORIES:
+    SLICES[_category] = slice(_offset, _offset + len(_labels))
+    INDEX[_category] = {label: _offset + i for i, label in enumerate(_labels)}
+    _offset += len(_labels)
+VOTE_LENGTH = _offset
+
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<HII')  # format version, count, vote vector length
+
+# One raw observation in the append-only log
+OBSERVATION = np.dtype([('type', np.uint8), ('frame', np.uint32),
+                        ('coords', np.float64, 2),
+                        ('votes', np.float32, VOTE_LENGTH)])
+
+
+def local_offsets(origin, coords):
+    """
+    Feet north and east of origin for [lat, lon] points in degrees
+    """
+    coords = np.asarray(coords, np.float64).reshape(-1, 2)
+    north = (coords[:, 0] - origin[0]) * FEET_PER_DEGREE
+    east = (coords[:, 1] - origin[1]) * FEET_PER_DEGREE * \
+        math.cos(math.radians(origin[0]))
+    return np.stack([north, east], axis=1)
+
+
+class Detection:
+    """
+    A merged detection: its type, mean coords in degrees, number of
+    observations, sum of squared deviations from the mean (north-north,
+    north-east and east-east, in square feet) and classification votes
+    """
+    __slots__ = ('type', 'coords', 'count', 'm2', 'votes')
+
+    def __init__(self, type_, coords, count=1, votes=None, m2=None):
+        self.type = type_
+        self.coords = coords
+        self.count = count
+        self.m2 = [0.0, 0.0, 0.0] if m2 is None else m2
+        self.votes = np.zeros(VOTE_LENGTH, np.float32) if votes is None \
+            else votes
+
+    def observe(self, coords):
+        """
+        Welford update of the mean and covariance with a [lat, lon]
+        observation in degrees
+        """
+        dn, de = local_offsets(self.coords, coords)[0]
+        self.count += 1
+        scale = FEET_PER_DEGREE * self.count
+        self.coords = [self.coords[0] + dn / scale,
+                       self.coords[1] + de / scale /
+                       math.cos(math.radians(self.coords[0]))]
+        # Deviation from the new mean is (n - 1) / n of the old one
+        ratio = (self.count - 1) / self.count
+        self.m2 = [self.m2[0] + dn * dn * ratio,
+                   self.m2[1] + dn * de * ratio,
+                   self.m2[2] + de * de * ratio]
+
+    def covariance(self):
+        """
+        Sample covariance of the observations in square feet
+        """
+        if self.count < 2:
+            return np.zeros((2, 2))
+        nn, ne, ee = self.m2
+        return np.array([[nn, ne], [ne, ee]]) / (self.count - 1)
+
+    def stdev(self):
+        """
+        Standard deviation of the observations north and east, in feet
+        """
+        return np.sqrt(np.diag(self.covariance())).tolist()
+
+    def class_votes(self):
+        """
+        Non-zero votes of each category, keyed by label
+        """
+        return {category: {labels[i]: float(v) for i, v in
+                           enumerate(self.votes[SLICES[category]]) if v}
+                for category, labels in CATEGORIES}
+
+    def to_dict(self):
+        d = {'type': self.type, 'coords': list(self.coords),
+             'count': self.count, 'stdev': self.stdev()}
+        if self.type == 'alphanumeric':
+            d['class'] = self.class_votes()
+        return d
+
+
+def observation_votes(text_color, shape_color, shapes, text, weight=1.0):
+    """
+    Vote vector for one classified crop
+
+    Colors get weight each, shapes their confidence and characters their
+    (integer) percentage confidence, all scaled by weight. Labels outside
+    of the vocabularies (e.g. 'none' when color detection fails) are
+    ignored
+    """
+    votes = np.zeros(VOTE_LENGTH, np.float32)
+    for category, label, amount in [('text-color', text_color, 1.0),
+                                    ('shape-color', shape_color, 1.0)] + \
+            [('shape', s, conf) for s, conf in shapes] + \
+            [('text', str(t), int(conf)) for t, conf in text]:
+        index = INDEX[category].get(label)
+        if index is not None:
+            votes[index] += amount
+    return votes * weight
+
+
+def match(detections, type_, coords, tolerance, sigmas):
+    """
+    Index of the detection of the same type an observation belongs to, or
+    None if it's a new detection
+
+    Each detection's gate is its observation covariance plus a circular
+    term of (tolerance / sigmas)^2, and the observation matches if its
+    Mahalanobis distance is at most sigmas. For a single observation this
+    is just being within tolerance feet; detections whose observations
+    have been spread out accept matches further along that spread
+    """
+    candidates = [i for i, d in enumerate(detections) if d.type == type_]
+    if not candidates:
+        return None
+
+    offsets = local_offsets(
+        coords, [detections[i].coords for i in candidates])
+    floor = (tolerance / sigmas) ** 2 * np.eye(2)
+    gates = np.stack([detections[i].covariance() for i in candidates]) + \
+        floor
+    distances = np.einsum('ni,nij,nj->n', offsets, np.linalg.inv(gates),
+                          offsets)
+    best = int(np.argmin(distances))
+    if distances[best] > sigmas ** 2:
+        return None
+    return candidates[best]
+
+
+def similarity_matrix(targets, detections):
+    """
+    Similarity of every alphanumeric target (rows) to every detection
+    (columns)
+
+    For each category, a target's label contributes
+    0.25 * exp(-0.7 * rank) * confidence, where rank is how many labels have
+    more votes and confidence is the shape vote, the character vote / 100
+    or the color vote / count. Labels without votes contribute nothing
+    """
+    similarity = np.zeros((len(targets), len(detections)))
+    if len(targets) == 0 or len(detections) == 0:
+        return similarity
+
+    votes = np.stack([d.votes for d in detections])     # (D, V)
+    counts = np.array([d.count for d in detections], np.float64)
+
+    for category, _ in CATEGORIES:
+        indices = np.array([INDEX[category].get(t['class'][category], -1)
+                            for t in targets])
+        known = indices >= 0
+        category_votes = votes[:, SLICES[category]]     # (D, L)
+        target_votes = votes[:, np.where(known, indices, 0)].T  # (T, D)
+        ranks = (category_votes[None, :, :] >
+                 target_votes[:, :, None]).sum(axis=2)  # (T, D)
+
+        if category == 'shape':
+            confidence = target_votes
+        elif category == 'text':
+            confidence = target_votes / 100.0
+        else:
+            confidence = target_votes / counts[None, :]
+
+        present = known[:, None] & (target_votes > 0)
+        similarity += np.where(present,
+                               0.25 * np.exp(-0.7 * ranks) * confidence, 0)
+    return similarity
+
+
+def dumps(detections):
+    """
+    Pack detections into bytes
+    """
+    n = len(detections)
+    types = np.array([TYPES.index(d.type) for d in detections], np.uint8)
+    coords = np.array([d.coords for d in detections],
+                      np.float64).reshape(n, 2)
+    counts = np.array([d.count for d in detections], np.int64)
+    m2 = np.array([d.m2 for d in detections], np.float64).reshape(n, 3)
+    votes = np.stack([d.votes for d in detections]).astype(np.float32) \
+        if n else np.zeros((0, VOTE_LENGTH), np.float32)
+    return b''.join([HEADER.pack(FORMAT_VERSION, n, VOTE_LENGTH),
+                     types.tobytes(), coords.tobytes(), counts.tobytes(),
+                     m2.tobytes(), votes.tobytes()])
+
+
+def loads(data):
+    """
+    Unpack detections packed by dumps
+    """
+    if not data:
+        return []
+    version, n, length = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION or length != VOTE_LENGTH:
+        raise ValueError('Detections were stored in another format')
+
+    offset = HEADER.size
+    types = np.frombuffer(data, np.uint8, n, offset)
+    offset += types.nbytes
+    coords = np.frombuffer(data, np.float64, n * 2, offset).reshape(n, 2)
+    offset += coords.nbytes
+    counts = np.frombuffer(data, np.int64, n, offset)
+    offset += counts.nbytes
+    m2 = np.frombuffer(data, np.float64, n * 3, offset).reshape(n, 3)
+    offset += m2.nbytes
+    # Copy the votes so records can be updated in place
+    votes = np.frombuffer(data, np.float32, n * length,
+                          offset).reshape(n, length).copy()
+
+    return [Detection(TYPES[t], c, k, v, m) for t, c, k, m, v in
+            zip(types.tolist(), coords.tolist(), counts.tolist(),
+                m2.tolist(), votes)]
+
+
+def pack_observations(frame, observations):
+    """
+    Log records for a frame's (detection, coords) observations, with
+    coords in degrees
+    """
+    records = np.zeros(len(observations), OBSERVATION)
+    if observations:
+        records['type'] = [TYPES.index(d.type) for d, _ in observations]
+        records['frame'] = frame
+        records['coords'] = [coords for _, coords in observations]
+        records['votes'] = np.stack([d.votes for d, _ in observations])
+    return records.tobytes()
+
+
+def unpack_observations(data):
+    if not data:
+        return np.zeros(0, OBSERVATION)
+    return np.frombuffer(data, OBSERVATION)
+
+
+def cluster(observations, eps, min_samples=1):
+    """
+    Rebuild detections by running DBSCAN over each type's observations in
+    a local frame (feet), with eps as the neighbourhood radius
+
+    Points DBSCAN leaves as noise become detections of their own, so a
+    target that was only seen once isn't lost
+    """
+    clustered = []
+    for code, type_ in enumerate(TYPES):
+        obs = observations[observations['type'] == code]
+        if len(obs) == 0:
+            continue
+        origin = obs['coords'][0]
+        offsets = local_offsets(origin, obs['coords'])
+        labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(
+            offsets)
+        noise = labels < 0
+        labels[noise] = labels.max() + 1 + np.arange(np.count_nonzero(noise))
+
+        k = labels.max() + 1
+        counts = np.bincount(labels, minlength=k)
+        mean = np.stack([np.bincount(labels, offsets[:, i], k)
+                         for i in range(2)], axis=1) / counts[:, None]
+        deviations = offsets - mean[labels]
+        m2 = np.stack([
+            np.bincount(labels, deviations[:, 0] * deviations[:, 0], k),
+            np.bincount(labels, deviations[:, 0] * deviations[:, 1], k),
+            np.bincount(labels, deviations[:, 1] * deviations[:, 1], k),
+        ], axis=1)
+        votes = np.zeros((k, VOTE_LENGTH), np.float32)
+        np.add.at(votes, labels, obs['votes'])
+
+        lats = origin[0] + mean[:, 0] / FEET_PER_DEGREE
+        lons = origin[1] + mean[:, 1] / FEET_PER_DEGREE / \
+            math.cos(math.radians(origin[0]))
+        clustered += [Detection(type_, [lat, lon], count, v, m)
+                      for lat, lon, count, v, m in
+                      zip(lats.tolist(), lons.tolist(), counts.tolist(),
+                          votes, m2.tolist())]
+    return clustered
@@ -7,79 +7,90 @@ import os
 import math
 import json
 import time
+from threading import Lock
 
 from scipy.optimize import linear_sum_assignment
-import redis
 import numpy as np
 
 import util as util
-from odlc import inference, color_detection, gps, shape_detection
+from model import store
+from odlc import inference, color_detection, shape_detection, saliency
+from odlc import camera, coverage, detections as records, search_area
 from odlc import MobilenetWrapper
 
-r = redis.Redis(host='redis', port=6379, db=0)
+r = store.connect()
 tolerance = float(os.environ.get('DETECTION_TOLERANCE'))
+# How many standard deviations of a detection's spread (on top of the
+# tolerance) an observation may be from it and still be merged into it
+MERGE_SIGMAS = float(os.environ.get('DETECTION_MERGE_SIGMAS', '3'))
+# Rebuild detections by clustering the observation log: 'read' clusters on
+# every /odlc read instead of using the greedy merges
+RECLUSTER = os.environ.get('DETECTION_RECLUSTER', 'off')
+# Replace the greedy merges with the clustered set every N frames, 0 never
+RECLUSTER_EVERY = int(os.environ.get('DETECTION_RECLUSTER_EVERY', '0'))
+RECLUSTER_MIN_SAMPLES = int(os.environ.get('DETECTION_RECLUSTER_MIN_SAMPLES',
+                                           '1'))
 alphanumeric_model = inference.Model('/app/odlc/models/alphanumeric_model.pth')
 emergent_model = inference.Model('/app/odlc/models/emergent_model.pth')
 debugging = (int(os.environ.get('DEBUG')) == 1)
 AP = int(os.environ.get('ALPHANUMERIC_DETECTION_PADDING'))
 net = MobilenetWrapper.MobilenetWrapper()
+# Held while the detection set is being read, modified and saved
+state_lock = Lock()
 
 
 def get_detection_confidence(detection):
     """
     Assign numerical value to the confidence we have in a detection
-    Currently only considers the number of times it has been detected
-    Potential ideas: location stdev
+    The number of times it has been detected, discounted when those
+    detections are spread out relative to our tolerance
     """
-    return detection['count']
+    spread = np.trace(detection.covariance())
+    return detection.count * tolerance ** 2 / (tolerance ** 2 + spread)
 
 
-def get_detection_diff(d_1, d_2):
+def offset_boxes(boxes, x, y):
     """
-    Determine if two detections are different
-    Currently considers detection type and whether the distance between
-    coordinates is within our allowed tolerance
+    Shift boxes detected in a cropped region back into frame coordinates
     """
-    if d_1['type'] != d_2['type']:
-        return float('inf')
+    return [[b[0] + x, b[1] + y, b[2] + x, b[3] + y] for b in boxes]
 
-    # Calculate difference using Haversine formula
-    # Difference returned in feet
-    la1, lo1 = d_1['coords']
-    la2, lo2 = d_2['coords']
-    dla = math.radians(abs(la1 - la2))
-    dlo = math.radians(abs(lo1 - lo2))
 
-    a = math.sin(dla / 2.0)**2 + math.cos(math.radians(la1)) * \
-        math.radians(la2) * math.sin(dlo / 2.0) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
-
-    return c * 2.093e7
-
-
-def compute_alphanumeric_similarity(target, detection):
-    if target['type'] == 'dummy' or detection['type'] == 'dummy':
-        return 0
-
-    similarity = 0
-
-    for c in ['shape', 'text', 'shape-color', 'text-color']:
-        if target['class'][c] in detection['class'][c].keys():
-            items = [(s, c) for s, c in detection['class'][c].items()]
-            items.sort(key=lambda x: x[1], reverse=True)
-            ind = [i for i in range(len(items)) if items[i][0] ==
-                   target['class'][c]][0]
-            conf = 1
-            if c == 'shape':
-                conf = items[ind][1]
-            elif c == 'text':
-                conf = items[ind][1] / 100.0
-            else:
-                conf = items[ind][1] / detection['count']
-            if ind != -1:
-                similarity += 0.25 * np.exp(-0.7 * ind) * conf
+def geotag_boxes(boxes, img, telemetry):
+    """
+    Geotag the center of each [x1, y1, x2, y2] box in a single vectorized
+    camera model lookup, returning a list of (lat, lon) in radians
+    Boxes that could not be geotagged are given coords (0, 0)
+    """
+    if len(boxes) == 0:
+        return []
+    centers = np.array([[float(b[j]) for j in range(4)] for b in boxes])
+    lats, lons = util.safe_function_call(
+        camera.geotag_pixels, (np.zeros(len(boxes)), np.zeros(len(boxes))),
+        telemetry, img.shape[1], img.shape[0],
+        (centers[:, 0] + centers[:, 2]) / 2.0,
+        (centers[:, 1] + centers[:, 3]) / 2.0)
+    # Rays that miss the ground can't be geotagged
+    missed = np.isnan(lats) | np.isnan(lons)
+    lats, lons = np.where(missed, 0, lats), np.where(missed, 0, lons)
+    return list(zip(lats.tolist(), lons.tolist()))
+
+
+def filter_search_area(boxes, coords, area):
+    """
+    Drop boxes whose geotag falls outside of the search area polygon
+    """
+    if area is None or len(boxes) == 0:
+        return boxes, coords
 
-    return similarity
+    inside = search_area.points_in_polygon(
+        [math.degrees(c[0]) for c in coords],
+        [math.degrees(c[1]) for c in coords], area)
+    if not inside.all():
+        util.info(f'Dropping {len(boxes) - inside.sum()} detections '
+                  'outside of the search area')
+    return [b for b, i in zip(boxes, inside) if i], \
+        [c for c, i in zip(coords, inside) if i]
 
 
 def update_targets(targets):
@@ -89,82 +100,132 @@ def update_targets(targets):
     num_emergent = sum(t['type'] == 'emergent' for t in targets)
     r.set('detector/num_emergent', num_emergent)
     shape_detection.initialize(alphanumeric_targets)
+    coverage.raster.reset()
     r.set('detector/targets', target_json)
-    detection_json = json.dumps([])
-    r.set('detector/detections', detection_json)
+    r.set('detector/detections', records.dumps([]))
+    r.set('detector/observations', b'')
+    r.set('detector/frames', 0)
+
+
+def cluster_observations():
+    """
+    Detections rebuilt by clustering every logged observation
+    """
+    observations = records.unpack_observations(
+        r.get('detector/observations'))
+    return records.cluster(observations, tolerance, RECLUSTER_MIN_SAMPLES)
+
+
+def recluster():
+    """
+    Replace the greedily merged detections with clustered ones
+    Returns the number of detections
+    """
+    with state_lock:
+        detections = cluster_observations()
+        r.set('detector/detections', records.dumps(detections))
+    return len(detections)
 
 
-def process_queued_image(img, telemetry):
+def process_queued_image(img, telemetry, weight=1.0):
     """
     Main routine for image processing
+    Classification votes from this image are scaled by weight
     """
+    with state_lock:
+        _process_queued_image(img, telemetry, weight)
+
+
+def _process_queued_image(img, telemetry, weight):
     global alphanumeric_model
 
-    detections = json.loads(r.get('detector/detections'))
+    with util.timed('load_state'):
+        detections = records.loads(r.get('detector/detections'))
+        area = search_area.get_area()
+
+    # Skip frames that only cover ground that has already been processed
+    with util.timed('footprint'):
+        polygon = util.safe_function_call(coverage.footprint, None,
+                                          telemetry, img.shape[1],
+                                          img.shape[0])
+    if polygon is not None:
+        # Skip frames that don't overlap the search area at all
+        if area is not None and \
+           not search_area.polygons_intersect(polygon, area):
+            util.info('Frame outside of search area, skipping frame')
+            return
+        if not coverage.should_process(polygon):
+            util.info('No new coverage, skipping frame')
+            return
+        coverage.raster.add(polygon)
+
+    # Only forward frames (or regions) the saliency cascade flags
+    with util.timed('saliency'):
+        region = saliency.salient_region(img)
+    if region is None:
+        util.info('No salient regions, skipping frame')
+        return
+    rx1, ry1, rx2, ry2 = region
+    salient_img = img[ry1:ry2, rx1:rx2]
+    frame = r.incr('detector/frames')
+    # (detection, coords) for every observation, for the observation log
+    observations = []
 
     # Get emergent detections
-    emergent_detections = emergent_model.detect_boxes(img)
+    with util.timed('emergent_model'):
+        emergent_detections = offset_boxes(
+            emergent_model.detect_boxes(salient_img), rx1, ry1)
     util.info(f"Emergent detections: {len(emergent_detections)}")
-    for i in range(len(emergent_detections)):
-        dbox = emergent_detections[i]
-        lat, lon = util.safe_function_call(gps.tag, (0, 0),
-                                           telemetry['altitude'],
-                                           telemetry['latitude'],
-                                           telemetry['longitude'],
-                                           telemetry['heading'],
-                                           float(os.environ.get
-                                                 ('CAMERA_SENSOR_WIDTH')),
-                                           float(os.environ.get
-                                                 ('CAMERA_FOCAL_LENGTH')),
-                                           img.shape[0], img.shape[1],
-                                           int(dbox[0]) + int(dbox[2]) / 2.0,
-                                           int(dbox[1]) + int(dbox[3]) / 2.0,
-                                           False)
-
+    with util.timed('geotag'):
+        emergent_detections, emergent_coords = filter_search_area(
+            emergent_detections,
+            geotag_boxes(emergent_detections, img, telemetry), area)
+    for dbox, (lat, lon) in zip(emergent_detections, emergent_coords):
         # Ignore a detection with bad coords
         if lat == 0 and lon == 0:
             continue
 
-        detection = {
-            'type': 'emergent',
-            'coords': [math.degrees(lat), math.degrees(lon)],
-        }
+        detection = records.Detection(
+            'emergent', [math.degrees(lat), math.degrees(lon)])
+        observations.append((detection, list(detection.coords)))
 
-        # Find most similar existing detection
-        min_diff = float('inf')
-        min_comp = {}
-        for comp in detections:
-            diff = get_detection_diff(comp, detection)
-            if diff < min_diff:
-                min_diff = diff
-                min_comp = comp
+        # Find the existing detection this is a duplicate of, if any
+        match = records.match(detections, detection.type, detection.coords,
+                              tolerance, MERGE_SIGMAS)
 
         # Duplicate found
-        if min_diff < tolerance:
+        if match is not None:
             util.info('Duplicate detected, updating duplicate')
-            ccount = min_comp['count']
-            min_comp['coords'][0] = (lat + min_comp['coords'][0] * ccount) \
-                / (1 + ccount)
-            min_comp['coords'][1] = (lon + min_comp['coords'][1] * ccount) \
-                / (1 + ccount)
+            min_comp = detections[match]
+            min_comp.observe(detection.coords)
 
             if debugging:
-                util.info(min_comp)
+                util.info(min_comp.to_dict())
         else:
             print('New detection found')
-            detection['count'] = 1
             if debugging:
-                util.info(detection)
+                util.info(detection.to_dict())
             detections.append(detection)
 
     # Get alphanumeric detections
-    alphanumeric_detections = alphanumeric_model.detect_boxes(img)
+    with util.timed('alphanumeric_model'):
+        alphanumeric_detections = offset_boxes(
+            alphanumeric_model.detect_boxes(salient_img), rx1, ry1)
     util.info(f"Alphanumeric detections: {len(alphanumeric_detections)}")
-    for i in range(len(alphanumeric_detections)):
+    with util.timed('geotag'):
+        alphanumeric_detections, alphanumeric_coords = filter_search_area(
+            alphanumeric_detections,
+            geotag_boxes(alphanumeric_detections, img, telemetry), area)
+    for abox, (lat, lon) in zip(alphanumeric_detections,
+                                alphanumeric_coords):
+        # Ignore a detection with bad coords
+        if lat == 0 and lon == 0:
+            continue
+
         # Crop image and write out image to debug output
         # Resize the cropped image with interpolation to hopefully give
         # better results for classification
-        dbox = [int(alphanumeric_detections[i][j]) for j in range(4)]
+        dbox = [int(abox[j]) for j in range(4)]
 
         # Ignore any detection without a buffer around it
         # We don't want to try to detect the shape of a detection that's
@@ -179,93 +240,50 @@ def process_queued_image(img, telemetry):
                            f"./images/debug/img-crop-{time.time()}.png")
 
         # Get classification info
-        fc, bc = util.safe_function_call(color_detection.
-                                         get_text_and_shape_color,
-                                         ('none', 'none'), crop_img)
-        text = util.safe_function_call(net.get_matching_text, {},
-                                       crop_img)
-        shapes = util.safe_function_call(shape_detection.detect_shape, {},
-                                         crop_img)
-        lat, lon = util.safe_function_call(gps.tag, (0, 0),
-                                           telemetry['altitude'],
-                                           telemetry['latitude'],
-                                           telemetry['longitude'],
-                                           telemetry['heading'],
-                                           float(os.environ.get
-                                                 ('CAMERA_SENSOR_WIDTH')),
-                                           float(os.environ.get
-                                                 ('CAMERA_FOCAL_LENGTH')),
-                                           img.shape[0], img.shape[1],
-                                           dbox[0] + dbox[2] / 2.0,
-                                           dbox[1] + dbox[3] / 2.0,
-                                           False)
-
-        # Ignore a detection with bad coords
-        if lat == 0 and lon == 0:
-            continue
-
-        d = {
-            'type': 'alphanumeric',
-            'coords': [math.degrees(lat), math.degrees(lon)],
-        }
-
-        # Find most similar existing detection
-        min_diff = float('inf')
-        min_comp = {}
-        for comp in detections:
-            diff = get_detection_diff(comp, d)
-            if diff < min_diff:
-                min_diff = diff
-                min_comp = comp
+        with util.timed('color'):
+            fc, bc = util.safe_function_call(color_detection.
+                                             get_text_and_shape_color,
+                                             ('none', 'none'), crop_img)
+        with util.timed('text'):
+            text = util.safe_function_call(net.get_matching_text, {},
+                                           crop_img)
+        with util.timed('shape'):
+            shapes = util.safe_function_call(shape_detection.detect_shape,
+                                             {}, crop_img)
+        d = records.Detection(
+            'alphanumeric', [math.degrees(lat), math.degrees(lon)],
+            votes=records.observation_votes(fc, bc, shapes, text, weight))
+        observations.append((d, list(d.coords)))
+
+        # Find the existing detection this is a duplicate of, if any
+        match = records.match(detections, d.type, d.coords, tolerance,
+                              MERGE_SIGMAS)
 
         # If they are similar enough, combine detections, otherwise
         # add the new detection to the detection list
-        if min_diff < tolerance:
+        if match is not None:
             util.info('Duplicate detected, updating duplicate')
-            ccount = min_comp['count']
-            min_comp['coords'][0] = (lat + min_comp['coords'][0] * ccount) \
-                / (1 + ccount)
-            min_comp['coords'][1] = (lon + min_comp['coords'][1] * ccount) \
-                / (1 + ccount)
-            min_comp['count'] = 1 + ccount
-            if fc != 'none' and bc != 'none':
-                min_comp['class']['text-color'][fc] = \
-                    min_comp['class']['text-color'].get(fc, 0) + 1
-                min_comp['class']['shape-color'][fc] = \
-                    min_comp['class']['shape-color'].get(bc, 0) + 1
-            for s, conf in shapes:
-                min_comp['class']['shape'][s] = \
-                    min_comp['class']['shape'].get(s, 0) + conf
-            for t, conf in text:
-                min_comp['class']['text'][str(t)] = \
-                    min_comp['class']['text'].get(str(t), 0) + int(conf)
+            min_comp = detections[match]
+            min_comp.observe(d.coords)
+            min_comp.votes += d.votes
 
             if debugging:
-                util.info(min_comp)
-
-            # What happens when duplicate detected
-            # Update min_comp count, weighted average, stdev, etc.
+                util.info(min_comp.to_dict())
         else:
             util.info('New detection found')
-            d['count'] = 1
-            d['class'] = {
-                'text-color': {fc: 1},
-                'shape-color': {bc: 1},
-                'shape': {},
-                'text': {},
-            }
-            for s, conf in shapes:
-                d['class']['shape'][s] = conf
-            for t, conf in text:
-                d['class']['text'][str(t)] = int(conf)
-
             if debugging:
-                util.info(d)
+                util.info(d.to_dict())
 
             detections.append(d)
 
-    json_detections = json.dumps(detections)
-    r.set('detector/detections', json_detections)
+    with util.timed('save_state'):
+        if observations:
+            r.append('detector/observations',
+                     records.pack_observations(frame, observations))
+        # Periodically replace the greedy merges with a clustering of the log
+        if RECLUSTER_EVERY and frame % RECLUSTER_EVERY == 0:
+            detections = cluster_observations()
+        r.set('detector/detections', records.dumps(detections))
 
 
 def get_top_detections():
@@ -273,47 +291,46 @@ def get_top_detections():
     Returns the top N detections we are most confident in
     """
     # Load detections and intended targets
-    detections = json.loads(r.get('detector/detections'))
+    if RECLUSTER == 'read':
+        detections = cluster_observations()
+    else:
+        detections = records.loads(r.get('detector/detections'))
 
     if debugging:
-        util.info(detections)
+        util.info([d.to_dict() for d in detections])
 
     targets = json.loads(r.get('detector/targets'))
     num_emergent = int(r.get('detector/num_emergent'))
     ret = []
 
     # Find best emergent detections
-    emergent_detections = [d for d in detections if d['type'] == 'emergent']
+    emergent_detections = [d for d in detections if d.type == 'emergent']
     emergent_detections.sort(key=lambda x: -1.0 * get_detection_confidence(x))
     for i in range(min(num_emergent, len(emergent_detections))):
-        ret.append(emergent_detections[i])
+        ret.append(emergent_detections[i].to_dict())
 
     # Find matches between targets and detections using stable matching
     # algorithm. Note that we aren't guaranteed to have the same number of
-    # alphanumeric targets and detections, so we have to pad whichever side
-    # has fewer with dummy entries that have 0 similarity with any other
+    # alphanumeric targets and detections, so the cost matrix is padded
+    # with dummy entries that have 0 similarity with any other
     # target/detection
-    alpha_detections = [d for d in detections if d['type'] == 'alphanumeric']
+    alpha_detections = [d for d in detections if d.type == 'alphanumeric']
     alpha_targets = [t for t in targets if t['type'] == 'alphanumeric']
     n = max(len(alpha_targets), len(alpha_detections))
-    if len(alpha_detections) < n:
-        for i in range(n - len(alpha_detections)):
-            alpha_detections.append({'type': 'dummy'})
-
-    if len(alpha_targets) < n:
-        for i in range(n - len(alpha_targets)):
-            alpha_targets.append({'type': 'dummy'})
 
     # Compute preferences
-    cost_matrix = [[1 - compute_alphanumeric_similarity(alpha_targets[i],
-                    alpha_detections[j]) for j in range(n)] for i in range(n)]
+    cost_matrix = np.ones((n, n))
+    cost_matrix[:len(alpha_targets), :len(alpha_detections)] -= \
+        records.similarity_matrix(alpha_targets, alpha_detections)
 
     row_ind, col_ind = linear_sum_assignment(cost_matrix)
     for i in range(n):
-        if alpha_targets[row_ind[i]]['type'] != 'dummy' and \
-           alpha_detections[col_ind[i]]['type'] != 'dummy':
-            alpha_targets[row_ind[i]]['coords'] = \
-                alpha_detections[col_ind[i]]['coords']
+        if row_ind[i] < len(alpha_targets) and \
+           col_ind[i] < len(alpha_detections):
+            detection = alpha_detections[col_ind[i]]
+            alpha_targets[row_ind[i]]['coords'] = list(detection.coords)
+            alpha_targets[row_ind[i]]['count'] = detection.count
+            alpha_targets[row_ind[i]]['stdev'] = detection.stdev()
             ret.append(alpha_targets[row_ind[i]])
 
     if debugging:
@@ -1,7 +1,86 @@
+import os
+
 import numpy as np
 import cv2
 EARTH_RADIUS = 250830000  # 2.5083 x 10^8 inches
 
+# Camera constants, parsed once
+SENSOR_WIDTH = float(os.environ.get('CAMERA_SENSOR_WIDTH', '2.0'))
+FOCAL_LENGTH = float(os.environ.get('CAMERA_FOCAL_LENGTH', '1.0'))
+
+
+def tag_batch(altitude: float, latitude: float, longitude: float,
+              heading: float, image_width: int, image_height: int,
+              target_x, target_y, sensor_width: float = SENSOR_WIDTH,
+              focal_length: float = FOCAL_LENGTH):
+    """
+    Vectorized version of tag for many targets in the same image
+
+    Parameters
+    ----------
+    altitude, latitude, longitude, heading : float
+        Drone state, in the same units as tag.
+    image_width, image_height : int
+        The dimensions of the image in pixels.
+    target_x, target_y : array_like
+        The x and y coordinates of the targets' centers in pixels.
+    sensor_width, focal_length : float
+        Camera constants in inches, defaulting to CAMERA_SENSOR_WIDTH and
+        CAMERA_FOCAL_LENGTH.
+
+    Returns
+    -------
+    ndarray, ndarray
+        The latitudes and longitudes of the targets in radians.
+    """
+    target_x = np.asarray(target_x, dtype=np.float64)
+    target_y = np.asarray(target_y, dtype=np.float64)
+
+    # Ground Sample Distance [inches/pixel]
+    GSD = (sensor_width * altitude) / (focal_length * image_width)
+    # inches from center of image to center of object in X,Y-direction
+    x_length = (target_x - image_width / 2) * GSD
+    y_length = (target_y - image_height / 2) * GSD
+    # get angle of target relative to drone
+    bearing = heading + np.arctan2(x_length, y_length)  # radians
+    # inches from center of image to center of object
+    distance = np.hypot(x_length, y_length)
+
+    return destination(latitude, longitude, bearing, distance)
+
+
+def destination(latitude, longitude, bearing, distance):
+    """
+    Great-circle destination from a point, vectorized over bearings and
+    distances
+
+    Parameters
+    ----------
+    latitude, longitude : float
+        The starting point in radians.
+    bearing : array_like
+        The bearing to each target in radians, clockwise from north.
+    distance : array_like
+        The distance to each target in inches.
+
+    Returns
+    -------
+    ndarray, ndarray
+        The latitudes and longitudes of the targets in radians.
+    """
+    delta = np.asarray(distance) / EARTH_RADIUS
+    sin_lat, cos_lat = np.sin(latitude), np.cos(latitude)
+    # calculate latitude of target
+    target_lat = np.arcsin(
+        sin_lat * np.cos(delta) + cos_lat * np.sin(delta) * np.cos(bearing)
+    )
+    # calculate longitude of target
+    target_long = longitude + np.arctan2(
+        np.sin(bearing) * np.sin(delta) * cos_lat,
+        np.cos(delta) - sin_lat * np.sin(target_lat))
+
+    return target_lat, target_long
+
 
 def tag(alititude: float, latitude: float, longitude: float, heading,
         sensor_width: float, focal_length: float,
@@ -43,25 +122,10 @@ def tag(alititude: float, latitude: float, longitude: float, heading,
         returns the latitude and longitude of the target in radians.
     """
 
-    # Ground Sample Distance [inches/pixel]
-    GSD = (sensor_width * alititude) / (focal_length * image_width)
-    # inches from center of image to center of object in X,Y-direction
-    x_length = (target_x - image_width / 2) * GSD
-    y_length = (target_y - image_height / 2) * GSD
-    # get angle of target relative to drone
-    bearing = heading + np.arctan2(x_length, y_length)  # radians
-    # inches from center of image to center of object
-    distance = np.sqrt(x_length**2 + y_length**2)
-    # calculate latitude of target
-    target_lat = np.arcsin(
-        np.sin(latitude) * np.cos(distance / EARTH_RADIUS) +
-        np.cos(latitude) * np.sin(distance / EARTH_RADIUS) * np.cos(bearing)
-    )
-    # calculate longitude of target
-    target_long = longitude + np.arctan2(
-        np.sin(bearing) * np.sin(distance / EARTH_RADIUS) * np.cos(latitude),
-        np.cos(distance / EARTH_RADIUS) -
-        np.sin(latitude) * np.sin(target_lat))
+    lats, longs = tag_batch(alititude, latitude, longitude, heading,
+                            image_width, image_height, [target_x],
+                            [target_y], sensor_width, focal_length)
+    target_lat, target_long = lats[0], longs[0]
 
     if verbose:
         img = np.zeros((image_width, image_height, 3), np.uint8)
@@ -103,6 +167,7 @@ def tag(alititude: float, latitude: float, longitude: float, heading,
         cv2.putText(img, "N", heading_vector,
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
+        GSD = (sensor_width * alititude) / (focal_length * image_width)
         name = f'''[inches/pixel]: {GSD:.2f},
         LatPerPix: {(GSD/(np.pi*EARTH_RADIUS))*90:.2E}'''
         cv2.imshow(name, img)
@@ -0,0 +1,80 @@
+"""
+Fast pre-inference image quality scoring
+
+Frames are downscaled and scored for blur (variance of the Laplacian) and
+exposure (fraction of clipped highlights and shadows). Frames that fail
+either check are handled according to QUALITY_POLICY:
+
+    off           score and record metrics only
+    skip          drop low-quality frames
+    deprioritize  process low-quality frames only once the queue is empty
+    weight        process them, but down-weight their classification votes
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+POLICY = os.environ.get('QUALITY_POLICY', 'off')
+MIN_SHARPNESS = float(os.environ.get('QUALITY_MIN_SHARPNESS', '50'))
+MAX_CLIPPED = float(os.environ.get('QUALITY_MAX_CLIPPED', '0.25'))
+
+DOWNSCALE_WIDTH = 640
+HIGHLIGHT_LEVEL = 250
+SHADOW_LEVEL = 5
+# Lowest weight a frame can be assigned under the 'weight' policy
+MIN_WEIGHT = 0.1
+
+
+def score(img):
+    """
+    Score a grayscale, BGR or BGRA frame
+
+    Returns a dict with the Laplacian variance ('sharpness') and the
+    fraction of clipped highlight and shadow pixels of the downscaled frame
+    """
+    scale = min(1.0, DOWNSCALE_WIDTH / img.shape[1])
+    gray = to_gray(img)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale,
+                          interpolation=cv2.INTER_AREA)
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    highlights = float(np.count_nonzero(gray >= HIGHLIGHT_LEVEL)) / gray.size
+    shadows = float(np.count_nonzero(gray <= SHADOW_LEVEL)) / gray.size
+
+    return {
+        'sharpness': sharpness,
+        'highlights': highlights,
+        'shadows': shadows,
+    }
+
+
+def to_gray(img):
+    """
+    Single-channel view of a frame as read with cv2.IMREAD_UNCHANGED
+    """
+    if img.ndim == 2:
+        return img
+    if img.shape[2] == 1:
+        return img[:, :, 0]
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def is_low_quality(scores):
+    return scores['sharpness'] < MIN_SHARPNESS or \
+        scores['highlights'] + scores['shadows'] > MAX_CLIPPED
+
+
+def weight(scores):
+    """
+    Vote weight in [MIN_WEIGHT, 1] for a frame, used by the 'weight' policy
+    """
+    blur = min(1.0, scores['sharpness'] / MIN_SHARPNESS)
+    clipped = scores['highlights'] + scores['shadows']
+    exposure = 1.0 if clipped <= MAX_CLIPPED else \
+        max(0.0, 1.0 - (clipped - MAX_CLIPPED) / (1.0 - MAX_CLIPPED))
+    return max(MIN_WEIGHT, blur * exposure)
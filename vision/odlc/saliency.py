@@ -0,0 +1,135 @@
+"""
+Cheap first-stage saliency cascade run before the Mask R-CNN detectors
+
+Frames are downscaled and split into a grid of tiles. Each tile is scored
+by the strongest compact color blob that stands out from the frame's
+dominant background color (grass, pavement). Frames with no tile above the
+threshold are skipped entirely, otherwise either the whole frame or only
+the salient region is forwarded to the detectors.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from odlc import image_processing
+
+# A threshold of 0 disables the cascade (every frame is forwarded)
+THRESHOLD = float(os.environ.get('SALIENCY_THRESHOLD', '0'))
+# 'frame' forwards the whole frame, 'tile' only the salient region
+MODE = os.environ.get('SALIENCY_MODE', 'frame')
+TILE_GRID = int(os.environ.get('SALIENCY_TILE_GRID', '4'))
+# Padding (in full-resolution pixels) around the salient region
+TILE_PADDING = int(os.environ.get('SALIENCY_TILE_PADDING', '64'))
+
+DOWNSCALE_WIDTH = 640
+# Lab distance from the background color for a pixel to be a candidate
+COLOR_DISTANCE = 40.0
+# Blob area bounds, as a fraction of the downscaled frame
+MIN_BLOB_AREA = 2e-5
+MAX_BLOB_AREA = 0.02
+
+
+def enabled():
+    return THRESHOLD > 0
+
+
+def _downscale(img):
+    scale = min(1.0, DOWNSCALE_WIDTH / img.shape[1])
+    if scale == 1.0:
+        return img, scale
+    small = cv2.resize(img, None, fx=scale, fy=scale,
+                       interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+def to_bgr(img):
+    """
+    Three-channel BGR view of a frame as read with cv2.IMREAD_UNCHANGED
+    """
+    if img.ndim == 2 or img.shape[2] == 1:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
+
+def score_tiles(img, grid=TILE_GRID):
+    """
+    Score each tile of a frame for target-like color blobs
+
+    Returns a (grid, grid) array of scores in [0, 1], indexed [row, col].
+    A blob's score is its mean Lab distance from the background color
+    (normalized by 100 and capped at 1) weighted by its solidity, and a
+    tile's score is the best score of any blob centered inside it.
+    """
+    small, _ = _downscale(to_bgr(img))
+    h, w = small.shape[:2]
+
+    # Model the background as the median color of the frame
+    lab = cv2.cvtColor(small, cv2.COLOR_BGR2LAB).astype(np.float32)
+    background = np.median(lab.reshape(-1, 3), axis=0)
+    distance = np.linalg.norm(lab - background, axis=2)
+
+    mask = np.uint8(distance > COLOR_DISTANCE) * 255
+    mask = image_processing.noise_removal(mask)
+
+    scores = np.zeros((grid, grid))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    frame_area = h * w
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if not MIN_BLOB_AREA * frame_area <= area <= \
+           MAX_BLOB_AREA * frame_area:
+            continue
+
+        hull_area = cv2.contourArea(cv2.convexHull(contour))
+        solidity = area / hull_area if hull_area > 0 else 0
+
+        x, y, bw, bh = cv2.boundingRect(contour)
+        blob = distance[y:y+bh, x:x+bw][mask[y:y+bh, x:x+bw] != 0]
+        contrast = min(1.0, float(blob.mean()) / 100.0) if blob.size else 0
+        score = contrast * solidity
+
+        row = min(grid - 1, int((y + bh / 2) * grid / h))
+        col = min(grid - 1, int((x + bw / 2) * grid / w))
+        scores[row, col] = max(scores[row, col], score)
+
+    return scores
+
+
+def region_from_scores(scores, image_shape, threshold=None, mode=None,
+                       padding=TILE_PADDING):
+    """
+    Turn tile scores into the region of the frame to forward
+
+    Returns (x1, y1, x2, y2) in full-resolution pixels, or None if no tile
+    reaches the threshold and the frame can be skipped.
+    """
+    threshold = THRESHOLD if threshold is None else threshold
+    mode = MODE if mode is None else mode
+    height, width = image_shape[:2]
+
+    rows, cols = np.nonzero(scores >= threshold)
+    if len(rows) == 0:
+        return None
+    if mode != 'tile':
+        return 0, 0, width, height
+
+    grid_h, grid_w = scores.shape
+    x1 = max(0, int(cols.min() * width / grid_w) - padding)
+    y1 = max(0, int(rows.min() * height / grid_h) - padding)
+    x2 = min(width, int((cols.max() + 1) * width / grid_w) + padding)
+    y2 = min(height, int((rows.max() + 1) * height / grid_h) + padding)
+    return x1, y1, x2, y2
+
+
+def salient_region(img):
+    """
+    Region of the frame to forward to the detectors, or None to skip it
+    """
+    if not enabled():
+        return 0, 0, img.shape[1], img.shape[0]
+    return region_from_scores(score_tiles(img), img.shape)
@@ -0,0 +1,77 @@
+"""
+ODLC search area polygon and vectorized point-in-polygon tests
+
+The search area is a list of [lat, lon] points in degrees, in the same
+format flight/src/fences.generate_fence produces. Frames whose footprint
+does not intersect it and detections that geotag outside of it are ignored.
+"""
+
+import json
+
+import numpy as np
+
+from model import store
+
+r = store.connect()
+
+
+def set_area(points):
+    r.set('detector/search_area', json.dumps(points))
+
+
+def get_area():
+    """
+    Returns the search area polygon, or None if no area has been set
+    """
+    area = r.get('detector/search_area')
+    if area is None:
+        return None
+    return json.loads(area)
+
+
+def points_in_polygon(lats, lons, polygon):
+    """
+    Ray-casting point-in-polygon test, vectorized over points and edges
+
+    Returns a boolean array with one entry per (lat, lon) point
+    """
+    lats = np.asarray(lats, dtype=np.float64).reshape(-1, 1)
+    lons = np.asarray(lons, dtype=np.float64).reshape(-1, 1)
+    poly = np.asarray(polygon, dtype=np.float64)
+    y1, x1 = poly[:, 0], poly[:, 1]
+    y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+
+    # Count edges crossed by a ray cast from each point towards +lon
+    straddles = (y1 > lats) != (y2 > lats)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (lats - y1) * (x2 - x1) / (y2 - y1)
+    crossings = straddles & (lons < x_cross)
+    return np.count_nonzero(crossings, axis=1) % 2 == 1
+
+
+def _segments_intersect(a1, a2, b1, b2):
+    """
+    Whether any segment a1[i]-a2[i] properly crosses any segment b1[j]-b2[j]
+    """
+    def orientation(p, q, s):
+        return np.sign((q[..., 0] - p[..., 0]) * (s[..., 1] - p[..., 1]) -
+                       (q[..., 1] - p[..., 1]) * (s[..., 0] - p[..., 0]))
+
+    a1, a2 = a1[:, None, :], a2[:, None, :]
+    b1, b2 = b1[None, :, :], b2[None, :, :]
+    crosses = (orientation(a1, a2, b1) * orientation(a1, a2, b2) < 0) & \
+        (orientation(b1, b2, a1) * orientation(b1, b2, a2) < 0)
+    return bool(crosses.any())
+
+
+def polygons_intersect(polygon_a, polygon_b):
+    """
+    Whether two lat/lon polygons overlap
+    """
+    a = np.asarray(polygon_a, dtype=np.float64)
+    b = np.asarray(polygon_b, dtype=np.float64)
+    if points_in_polygon(a[:, 0], a[:, 1], b).any() or \
+       points_in_polygon(b[:, 0], b[:, 1], a).any():
+        return True
+    return _segments_intersect(a, np.roll(a, -1, axis=0),
+                               b, np.roll(b, -1, axis=0))
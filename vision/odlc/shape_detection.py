@@ -6,15 +6,15 @@ import json
 
 import cv2
 import numpy as np
-import redis
 
 from PIL import Image, ImageFilter
 from scipy import interpolate
 
 import util
+from model import store
 from odlc.segmentation import get_text_and_shape_mask
 
-r = redis.Redis(host='redis', port=6379, db=0)
+r = store.connect()
 granularity = int(os.environ.get('POLAR_SHAPE_GRANULARITY'))
 CONVEX_THRESHOLD = float(os.environ.get('CONCAVE_SHAPE_AREA_RATIO_THRESHOLD'))
 
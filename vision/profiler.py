@@ -0,0 +1,177 @@
+"""
+On-demand profiling of the image processing worker
+
+A profiling session covers the next N images and/or a time window, and is
+started with POST /profile or at startup with PROFILE_IMAGES/PROFILE_SECONDS.
+Two modes are available:
+    cprofile - deterministic cProfile of the worker, written as a .prof
+               file (load with pstats or snakeviz) plus a text summary
+    sample   - a background thread samples the worker's stack every
+               PROFILE_SAMPLE_INTERVAL seconds and writes collapsed stacks
+               (.folded) for flamegraph.pl or speedscope
+
+When no session is active the worker only checks profiler.active.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import time
+from collections import Counter
+from threading import Lock, Thread, get_ident
+
+import util
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', './profiles')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')
+PROFILE_IMAGES = int(os.environ.get('PROFILE_IMAGES', '0'))
+PROFILE_SECONDS = float(os.environ.get('PROFILE_SECONDS', '0'))
+SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+MODES = ('cprofile', 'sample')
+
+
+class Profiler:
+    """
+    Profiles the thread that calls begin_image/end_image
+    """
+
+    def __init__(self, directory=PROFILE_DIR, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.lock = Lock()
+        self.active = False
+        self.mode = None
+        self.remaining = None       # images left, None for no limit
+        self.deadline = None        # time.time() to stop, None for no limit
+        self.name = None
+        self.sessions = 0
+        self.images = 0
+        self.profile = None
+        self.samples = Counter()
+        self.in_image = False
+        self.thread_id = None
+        self.files = []
+
+    def start(self, mode=None, images=None, seconds=None):
+        """
+        Profile the next images images and/or for seconds seconds
+        """
+        mode = mode or PROFILE_MODE
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiling mode {mode}')
+        if not images and not seconds:
+            raise ValueError('Give a number of images or seconds')
+        with self.lock:
+            if self.active:
+                raise ValueError('A profiling session is already running')
+            self.mode = mode
+            self.remaining = images or None
+            self.deadline = time.time() + seconds if seconds else None
+            self.sessions += 1
+            self.name = f'{time.strftime("%Y%m%d-%H%M%S")}-{self.sessions}'
+            self.images = 0
+            self.samples = Counter()
+            self.active = True
+            if mode == 'cprofile':
+                self.profile = cProfile.Profile()
+            else:
+                Thread(target=self._sample, args=(self.name, ),
+                       daemon=True).start()
+        util.info(f'Profiling ({mode}) started: {images or "-"} images, '
+                  f'{seconds or "-"} seconds')
+
+    def _expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def begin_image(self):
+        if not self.active:
+            return
+        if self._expired():
+            self.finish()
+            return
+        self.thread_id = get_ident()
+        self.in_image = True
+        if self.profile is not None:
+            self.profile.enable()
+
+    def end_image(self):
+        if not self.in_image:
+            return
+        if self.profile is not None:
+            self.profile.disable()
+        self.in_image = False
+        self.images += 1
+        if self.remaining is not None:
+            self.remaining -= 1
+        if self.remaining == 0 or self._expired():
+            self.finish()
+
+    def _sample(self, name):
+        # Only samples while the worker is inside an image, so idle time
+        # waiting on the queue doesn't swamp the profile
+        # pylint: disable=protected-access
+        current_frames = sys._current_frames
+        while self.active and self.name == name:
+            if self._expired() and not self.in_image:
+                self.finish()
+                return
+            frame = current_frames().get(self.thread_id)
+            if self.in_image and frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:'
+                                 f'{code.co_name}')
+                    frame = frame.f_back
+                with self.lock:
+                    self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def finish(self):
+        """
+        End the session and write its results
+        """
+        with self.lock:
+            if not self.active:
+                return
+            self.active = False
+            self.in_image = False
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory,
+                                f'{self.name}-{self.mode}-{self.images}')
+            if self.profile is not None:
+                self.profile.dump_stats(f'{base}.prof')
+                summary = io.StringIO()
+                stats = pstats.Stats(self.profile, stream=summary)
+                stats.sort_stats('cumulative').print_stats(50)
+                with open(f'{base}.txt', 'w') as fp:
+                    fp.write(summary.getvalue())
+                self.files += [f'{base}.prof', f'{base}.txt']
+                self.profile = None
+            else:
+                with open(f'{base}.folded', 'w') as fp:
+                    for stack, count in self.samples.most_common():
+                        fp.write(f'{stack} {count}\n')
+                self.files.append(f'{base}.folded')
+        util.info(f'Profiling finished after {self.images} images, '
+                  f'written to {base}')
+
+    def status(self):
+        if self.active and self._expired() and not self.in_image:
+            self.finish()
+        return {
+            'active': self.active,
+            'mode': self.mode,
+            'images': self.images,
+            'remaining_images': self.remaining,
+            'remaining_seconds': max(0.0, self.deadline - time.time())
+            if self.deadline is not None else None,
+            'files': self.files,
+        }
+
+
+profiler = Profiler()
+if PROFILE_IMAGES or PROFILE_SECONDS:
+    profiler.start(PROFILE_MODE, PROFILE_IMAGES, PROFILE_SECONDS)
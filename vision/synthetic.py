@@ -0,0 +1,347 @@
+"""
+Programmatic synthetic target image generator
+
+Composites alphanumeric targets (shapes from odlc/shape_reference, a
+character and two colors named in color_detection) onto background imagery
+at a given altitude/GSD, rotation and blur. Every frame comes with ground
+truth: target class, pixel bounding box and geotagged coordinates.
+
+Frames can be written to a directory (with ground_truth.json), streamed
+into the offline benchmark, or posted to a running server's /odlc endpoint
+the same way flight/src/image_wrapper does.
+
+Examples:
+    python3 synthetic.py --count 1000 --output images/synthetic
+    python3 synthetic.py --count 200 --benchmark
+    python3 synthetic.py --count 50 --post http://localhost:8003
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# Imported first for its environment defaults (camera geometry etc.)
+import benchmark
+from odlc import camera, gps
+from odlc.color_detection import COLOR_RANGES
+
+SHAPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'odlc', 'shape_reference')
+SHAPES = sorted(name[:-4] for name in os.listdir(SHAPE_DIR)
+                if name.endswith('.png'))
+TEXTS = [chr(c) for c in range(ord('A'), ord('Z') + 1)] + \
+    [str(i) for i in range(10)]
+
+
+def _hue_color(hue):
+    hsv = np.uint8([[[hue, 220, 200]]])
+    return tuple(int(c) for c in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0])
+
+
+# BGR color for every color name the classifier can return, red taking
+# its first (non-wrapping) hue range
+COLORS = {}
+for name, low, high in COLOR_RANGES:
+    COLORS.setdefault(name, _hue_color((low + high) / 2))
+COLORS.update({
+    'white': (245, 245, 245),
+    'black': (15, 15, 15),
+    'gray': (128, 128, 128),
+    'brown': (30, 70, 120),
+})
+
+
+def load_shape_masks():
+    """
+    Binary mask of each reference shape, cropped to the shape
+
+    The reference images don't agree on polarity or transparency, so the
+    background is taken to be the most common corner (gray, alpha) pair
+    """
+    masks = {}
+    for name in SHAPES:
+        img = cv2.imread(os.path.join(SHAPE_DIR, f'{name}.png'),
+                         cv2.IMREAD_UNCHANGED)
+        gray = cv2.cvtColor(img[..., :3], cv2.COLOR_BGR2GRAY).astype(int)
+        alpha = img[..., 3].astype(int) if img.shape[2] == 4 else \
+            np.full(gray.shape, 255)
+
+        corners = [(gray[y, x], alpha[y, x]) for y in (0, -1)
+                   for x in (0, -1)]
+        bg_gray, bg_alpha = max(set(corners), key=corners.count)
+        mask = np.uint8((np.abs(gray - bg_gray) +
+                         np.abs(alpha - bg_alpha)) > 128)
+
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_SIMPLE)
+        largest = max(contours, key=cv2.contourArea)
+        x, y, w, h = cv2.boundingRect(largest)
+        filled = cv2.drawContours(np.zeros_like(mask), [largest], -1, 1, -1)
+        masks[name] = filled[y:y+h, x:x+w]
+    return masks
+
+
+def grass_background(width, height, rng):
+    """
+    Procedural grass-like texture, used when no background images are given
+    """
+    noise = rng.normal(0, 1, (height // 8 + 1, width // 8 + 1, 3))
+    noise = cv2.resize(noise, (width, height),
+                       interpolation=cv2.INTER_CUBIC)
+    base = np.array([50, 120, 70], np.float64)
+    texture = base + noise * np.array([8, 20, 12]) + \
+        rng.normal(0, 6, (height, width, 3))
+    return np.uint8(np.clip(texture, 0, 255))
+
+
+def render_target(mask, text, shape_color, text_color, size, rotation):
+    """
+    Render a target of the given pixel size, rotated by rotation degrees
+
+    Returns the BGR target and its alpha mask, both square
+    """
+    scale = size / max(mask.shape)
+    shape = cv2.resize(mask, None, fx=scale, fy=scale,
+                       interpolation=cv2.INTER_NEAREST)
+    side = int(math.ceil(size * 1.5))
+    alpha = np.zeros((side, side), np.uint8)
+    y0 = (side - shape.shape[0]) // 2
+    x0 = (side - shape.shape[1]) // 2
+    alpha[y0:y0+shape.shape[0], x0:x0+shape.shape[1]] = shape * 255
+
+    target = np.zeros((side, side, 3), np.uint8)
+    target[alpha > 0] = shape_color
+
+    # Center the character on the shape's centroid
+    moments = cv2.moments(alpha, binaryImage=True)
+    cx = moments['m10'] / moments['m00']
+    cy = moments['m01'] / moments['m00']
+    font = cv2.FONT_HERSHEY_DUPLEX
+    font_scale = size * 0.45 / 22.0
+    thickness = max(1, int(size * 0.08))
+    (tw, th), _ = cv2.getTextSize(text, font, font_scale, thickness)
+    cv2.putText(target, text, (int(cx - tw / 2), int(cy + th / 2)), font,
+                font_scale, text_color, thickness, cv2.LINE_AA)
+
+    rotation_matrix = cv2.getRotationMatrix2D((side / 2, side / 2),
+                                              rotation, 1.0)
+    target = cv2.warpAffine(target, rotation_matrix, (side, side))
+    alpha = cv2.warpAffine(alpha, rotation_matrix, (side, side))
+    return target, alpha
+
+
+class SyntheticGenerator:
+    """
+    Generates frames with randomly placed alphanumeric targets
+    """
+
+    def __init__(self, width=1080, height=1920, altitude=1200,
+                 target_size=24, backgrounds=None, targets_per_frame=(0, 2),
+                 max_blur=1.5, shapes=None, latitude=38.3144,
+                 longitude=-76.5452, spacing=100, seed=0):
+        self.width = width
+        self.height = height
+        self.altitude = altitude            # inches
+        self.target_size = target_size      # inches
+        self.targets_per_frame = targets_per_frame
+        self.max_blur = max_blur
+        self.latitude = latitude
+        self.longitude = longitude
+        self.spacing = spacing              # feet between frames
+        self.rng = np.random.default_rng(seed)
+        self.random = random.Random(seed)
+
+        self.masks = load_shape_masks()
+        self.shapes = shapes or SHAPES
+        self.backgrounds = []
+        for path in backgrounds or []:
+            img = cv2.imread(path)
+            if img is not None:
+                self.backgrounds.append(img)
+
+    @property
+    def gsd(self):
+        """Ground sample distance in inches per pixel"""
+        return gps.SENSOR_WIDTH * self.altitude / \
+            (gps.FOCAL_LENGTH * self.width)
+
+    def background(self):
+        if not self.backgrounds:
+            return grass_background(self.width, self.height, self.rng)
+        img = self.random.choice(self.backgrounds)
+        return cv2.resize(img, (self.width, self.height))
+
+    def telemetry(self, index):
+        """
+        Level flight due north, spacing feet between frames
+        """
+        return {
+            'altitude': self.altitude,
+            'latitude': math.radians(self.latitude) +
+            index * self.spacing * 12 / gps.EARTH_RADIUS,
+            'longitude': math.radians(self.longitude),
+            'heading': 0.0,
+        }
+
+    def frame(self, index):
+        """
+        Returns (image, telemetry, ground truth targets) for one frame
+        """
+        img = self.background()
+        telemetry = self.telemetry(index)
+        size = max(8, int(round(self.target_size / self.gsd)))
+
+        truth = []
+        count = self.random.randint(*self.targets_per_frame)
+        for _ in range(count):
+            shape = self.random.choice(self.shapes)
+            shape_color, text_color = self.random.sample(list(COLORS), 2)
+            text = self.random.choice(TEXTS)
+            rotation = self.random.uniform(0, 360)
+            target, alpha = render_target(self.masks[shape], text,
+                                          COLORS[shape_color],
+                                          COLORS[text_color], size, rotation)
+
+            side = target.shape[0]
+            if side >= min(self.width, self.height):
+                continue
+            x = self.random.randint(0, self.width - side)
+            y = self.random.randint(0, self.height - side)
+            region = img[y:y+side, x:x+side]
+            a = (alpha.astype(np.float32) / 255)[..., None]
+            region[:] = np.uint8(region * (1 - a) + target * a)
+
+            ys, xs = np.nonzero(alpha)
+            box = [int(x + xs.min()), int(y + ys.min()),
+                   int(x + xs.max()) + 1, int(y + ys.max()) + 1]
+            lat, lon = camera.geotag_pixels(
+                telemetry, self.width, self.height,
+                [(box[0] + box[2]) / 2], [(box[1] + box[3]) / 2])
+            truth.append({
+                'type': 'alphanumeric',
+                'class': {
+                    'shape': shape,
+                    'shape-color': shape_color,
+                    'text': text,
+                    'text-color': text_color,
+                },
+                'bbox': box,
+                'rotation': rotation,
+                'coords': [math.degrees(lat[0]), math.degrees(lon[0])],
+            })
+
+        blur = self.random.uniform(0, self.max_blur)
+        if blur > 0.1:
+            img = cv2.GaussianBlur(img, (0, 0), blur)
+        return img, telemetry, truth
+
+    def frames(self, count):
+        """
+        Yield (name, image, telemetry, ground truth) tuples
+        """
+        for i in range(count):
+            img, telemetry, truth = self.frame(i)
+            yield f'synthetic-{i:05d}.jpg', img, telemetry, truth
+
+
+def write_frames(generator, count, directory):
+    os.makedirs(directory, exist_ok=True)
+    ground_truth = {}
+    for name, img, telemetry, truth in generator.frames(count):
+        cv2.imwrite(os.path.join(directory, name), img)
+        ground_truth[name] = {'telemetry': telemetry, 'targets': truth}
+    with open(os.path.join(directory, 'ground_truth.json'), 'w') as fp:
+        json.dump(ground_truth, fp, indent=2)
+
+
+def post_frames(generator, count, url, rate):
+    """
+    Post telemetry then the frame for each synthetic frame, at rate frames
+    per second (0 for as fast as possible)
+    """
+    import requests
+
+    session = requests.Session()
+    for name, img, telemetry, _ in generator.frames(count):
+        start = time.time()
+        # /telemetry takes degrees and converts them to radians
+        update = dict(telemetry)
+        update['latitude'] = math.degrees(telemetry['latitude'])
+        update['longitude'] = math.degrees(telemetry['longitude'])
+        session.post(f'{url}/telemetry', json=update, timeout=5)
+        data = cv2.imencode('.jpg', img)[1].tobytes()
+        session.post(f'{url}/odlc', data=data, timeout=10,
+                     headers={'Content-Type': 'application/octet-stream'})
+        print(f'Posted {name}')
+        if rate > 0:
+            time.sleep(max(0.0, 1.0 / rate - (time.time() - start)))
+
+
+def add_arguments(parser):
+    parser.add_argument('--width', type=int, default=1080)
+    parser.add_argument('--height', type=int, default=1920)
+    parser.add_argument('--altitude', type=float, default=1200,
+                        help='Altitude in inches')
+    parser.add_argument('--target-size', type=float, default=24,
+                        help='Target size in inches')
+    parser.add_argument('--targets-per-frame', type=int, nargs=2,
+                        default=[0, 2], metavar=('MIN', 'MAX'))
+    parser.add_argument('--max-blur', type=float, default=1.5,
+                        help='Maximum Gaussian blur sigma in pixels')
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES)
+    parser.add_argument('--backgrounds', nargs='+',
+                        help='Background images (default: procedural grass)')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def make_generator(args):
+    return SyntheticGenerator(
+        width=args.width, height=args.height, altitude=args.altitude,
+        target_size=args.target_size, backgrounds=args.backgrounds,
+        targets_per_frame=tuple(args.targets_per_frame),
+        max_blur=args.max_blur, shapes=args.shapes, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic target frames with ground truth')
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--output', help='Directory to write frames to')
+    parser.add_argument('--post', metavar='URL',
+                        help='Post frames to a running vision server')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Frames per second when posting')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Stream frames into the offline benchmark')
+    add_arguments(parser)
+    args, remaining = parser.parse_known_args()
+
+    generator = make_generator(args)
+    if args.output:
+        write_frames(generator, args.count, args.output)
+    if args.post:
+        post_frames(generator, args.count, args.post, args.rate)
+    if args.benchmark:
+        bench_parser = argparse.ArgumentParser()
+        benchmark.add_arguments(bench_parser)
+        bench_args = bench_parser.parse_args(remaining)
+
+        def frames():
+            for name, img, telemetry, _ in make_generator(args).frames(
+                    args.count):
+                yield name, img, telemetry
+
+        report = benchmark.run(frames, bench_args)
+        report['synthetic'] = vars(args)
+        sys.exit(benchmark.report_results(report, bench_args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,32 @@
+import json
+import math
+import os
+import tempfile
 import unittest
 from parameterized import parameterized
 
 import cv2
+import numpy as np
 import requests
-
+from pymavlink import mavutil
+
+from model import drone
+from odlc import camera
+import latency
+import mavlink_listener
+import memory
+import profiler
+import util
 from odlc import color_detection
+from odlc import gps
 from odlc import inference
 from odlc import shape_detection
 from odlc import MobilenetWrapper
+from odlc import coverage
+from odlc import detections
+from odlc import quality
+from odlc import saliency
+from odlc import search_area
 
 
 class AlphanumericModelTests(unittest.TestCase):
@@ -150,6 +169,530 @@ class ShapeClassificationTests(unittest.TestCase):
         self.assertEqual(predictions[0][0], target_shape)
 
 
+class GeotagTests(unittest.TestCase):
+    def test_batch_matches_scalar(self):
+        xs = np.array([0, 540, 1000, 77])
+        ys = np.array([0, 960, 100, 1900])
+        lats, lons = gps.tag_batch(1200, 0.6687, -1.3360, 0.7, 1080, 1920,
+                                   xs, ys, 2.0, 1.0)
+        for i in range(len(xs)):
+            lat, lon = gps.tag(1200, 0.6687, -1.3360, 0.7, 2.0, 1.0,
+                               1080, 1920, xs[i], ys[i])
+            self.assertAlmostEqual(lats[i], lat, places=12)
+            self.assertAlmostEqual(lons[i], lon, places=12)
+
+    def test_image_center(self):
+        lats, lons = gps.tag_batch(1200, 0.6687, -1.3360, 0.7, 1080, 1920,
+                                   [540], [960])
+        self.assertAlmostEqual(lats[0], 0.6687, places=12)
+        self.assertAlmostEqual(lons[0], -1.3360, places=12)
+
+
+class CameraModelTests(unittest.TestCase):
+    xs = np.array([0, 540, 1000, 77, 1080])
+    ys = np.array([0, 960, 100, 1900, 1920])
+
+    def test_nadir_matches_gps_tag(self):
+        model = camera.CameraModel(2.0, 1.0, 1080, 1920, (0, 0, 0, 0, 0))
+        lats, lons = model.geotag(1200, 0.6687, -1.3360, 0, 0, 0.7,
+                                  self.xs, self.ys)
+        expected = gps.tag_batch(1200, 0.6687, -1.3360, 0.7, 1080, 1920,
+                                 self.xs, self.ys, 2.0, 1.0)
+        np.testing.assert_allclose(lats, expected[0], rtol=0, atol=1e-12)
+        np.testing.assert_allclose(lons, expected[1], rtol=0, atol=1e-12)
+
+    def test_attitude_shifts_center(self):
+        model = camera.CameraModel(2.0, 1.0, 1080, 1920, (0, 0, 0, 0, 0))
+        # Rolling right points the camera left, pitching up points it ahead
+        north, east = model.ground_offsets(1200, 0.1, 0, 0, [540], [960])
+        self.assertAlmostEqual(north[0], 0)
+        self.assertAlmostEqual(east[0], -1200 * np.tan(0.1))
+        north, east = model.ground_offsets(1200, 0, 0.1, 0, [540], [960])
+        self.assertAlmostEqual(north[0], 1200 * np.tan(0.1))
+        self.assertAlmostEqual(east[0], 0)
+
+    def test_horizon(self):
+        model = camera.CameraModel(2.0, 1.0, 1080, 1920, (0, 0, 0, 0, 0))
+        north, _ = model.ground_offsets(1200, 0, 1.5, 0, [540], [1920])
+        self.assertTrue(np.isnan(north[0]))
+
+    def test_distortion_table(self):
+        k = (-0.1, 0.01, 0, 0, 0)
+        model = camera.CameraModel(2.0, 1.0, 1080, 1920, k, grid_step=8)
+        xs = np.array([13.0, 700.5, 1079.0])
+        ys = np.array([1.0, 333.3, 1900.0])
+        f = 1080 / 2.0
+        exact = cv2.undistortPoints(
+            np.stack([xs, ys], axis=1).reshape(-1, 1, 2),
+            np.array([[f, 0, 540], [0, f, 960], [0, 0, 1]]),
+            np.array(k)).reshape(-1, 2)
+        np.testing.assert_allclose(model.normalized_rays(xs, ys), exact,
+                                   atol=1e-3)
+
+
+class SaliencyTests(unittest.TestCase):
+    def setUp(self):
+        self.background = np.full((600, 800, 3), (40, 120, 60), np.uint8)
+
+    def test_empty_frame_skipped(self):
+        scores = saliency.score_tiles(self.background)
+        self.assertIsNone(saliency.region_from_scores(
+            scores, self.background.shape, 0.3, 'frame'))
+
+    def test_target_tile_forwarded(self):
+        img = self.background.copy()
+        cv2.circle(img, (700, 100), 12, (30, 30, 220), -1)
+        scores = saliency.score_tiles(img)
+        self.assertGreater(scores[0, 3], 0.3)
+
+        region = saliency.region_from_scores(scores, img.shape, 0.3, 'tile',
+                                             padding=0)
+        self.assertEqual(region, (600, 0, 800, 150))
+
+    def test_channel_layouts(self):
+        img = self.background.copy()
+        cv2.circle(img, (700, 100), 12, (220, 220, 220), -1)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        bgra = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+        for frame in (gray, gray[:, :, np.newaxis], bgra):
+            scores = saliency.score_tiles(frame)
+            self.assertEqual(scores.shape, (4, 4))
+            self.assertGreater(scores[0, 3], 0.3)
+
+
+class QualityTests(unittest.TestCase):
+    def setUp(self):
+        self.img = cv2.imread('/app/images/test/alphanumeric-model-test1.jpg')
+
+    def test_sharp_frame_passes(self):
+        scores = quality.score(self.img)
+        self.assertFalse(quality.is_low_quality(scores))
+        self.assertEqual(quality.weight(scores), 1.0)
+
+    def test_blurred_frame_fails(self):
+        blurred = cv2.GaussianBlur(self.img, (51, 51), 0)
+        scores = quality.score(blurred)
+        self.assertLess(scores['sharpness'], quality.MIN_SHARPNESS)
+        self.assertTrue(quality.is_low_quality(scores))
+        self.assertLess(quality.weight(scores), 1.0)
+
+    def test_overexposed_frame_fails(self):
+        scores = quality.score(cv2.convertScaleAbs(self.img, alpha=4.0))
+        self.assertGreater(scores['highlights'], quality.MAX_CLIPPED)
+        self.assertTrue(quality.is_low_quality(scores))
+
+    def test_channel_layouts(self):
+        scores = quality.score(self.img)
+        gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+        bgra = cv2.cvtColor(self.img, cv2.COLOR_BGR2BGRA)
+        for img in (gray, gray[:, :, np.newaxis], bgra):
+            self.assertAlmostEqual(quality.score(img)['sharpness'],
+                                   scores['sharpness'], places=6)
+
+
+class CoverageTests(unittest.TestCase):
+    telemetry = {
+        'altitude': 1200,
+        'latitude': 0.6687,
+        'longitude': -1.3360,
+        'heading': 0.0
+    }
+
+    def setUp(self):
+        self.raster = coverage.CoverageRaster()
+
+    def test_footprint_centered_on_drone(self):
+        polygon = coverage.footprint(self.telemetry, 1080, 1920)
+        self.assertEqual(len(polygon), 4)
+        center = np.mean(polygon, axis=0)
+        self.assertAlmostEqual(center[0], math.degrees(0.6687), places=6)
+        self.assertAlmostEqual(center[1], math.degrees(-1.3360), places=6)
+
+    def test_revisits(self):
+        polygon = coverage.footprint(self.telemetry, 1080, 1920)
+        self.assertEqual(self.raster.new_fraction(polygon), 1.0)
+        self.raster.add(polygon)
+        self.assertEqual(self.raster.new_fraction(polygon), 0.0)
+        self.assertEqual(self.raster.new_fraction(polygon, 2), 1.0)
+        self.raster.add(polygon)
+        self.assertEqual(self.raster.new_fraction(polygon, 2), 0.0)
+
+    def test_partial_overlap(self):
+        self.raster.add(coverage.footprint(self.telemetry, 1080, 1920))
+        shifted = dict(self.telemetry)
+        shifted['latitude'] += 30 * 12 / gps.EARTH_RADIUS
+        fraction = self.raster.new_fraction(
+            coverage.footprint(shifted, 1080, 1920))
+        self.assertGreater(fraction, 0.0)
+        self.assertLess(fraction, 1.0)
+
+
+class SearchAreaTests(unittest.TestCase):
+    area = [[38.3173, -76.5562], [38.3159, -76.5566], [38.3133, -76.5411],
+            [38.3153, -76.5405], [38.3186, -76.5454], [38.3173, -76.5562]]
+
+    def test_points_in_polygon(self):
+        inside = search_area.points_in_polygon([38.3160, 38.3100, 38.3150],
+                                               [-76.5500, -76.5500, -76.5300],
+                                               self.area)
+        self.assertEqual(list(inside), [True, False, False])
+
+    def test_polygons_intersect(self):
+        overlapping = [[38.3150, -76.5420], [38.3150, -76.5390],
+                       [38.3140, -76.5390], [38.3140, -76.5420]]
+        disjoint = [[38.3000, -76.5000], [38.3000, -76.4990],
+                    [38.2990, -76.4990], [38.2990, -76.5000]]
+        self.assertTrue(search_area.polygons_intersect(overlapping,
+                                                       self.area))
+        self.assertFalse(search_area.polygons_intersect(disjoint, self.area))
+
+
+class DebugImageWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.img = np.random.randint(0, 255, (64, 64, 3), np.uint8)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_quota_evicts_oldest(self):
+        size = len(cv2.imencode('.png', self.img)[1])
+        writer = util.DebugImageWriter(queue_size=16, sample_rate=1.0,
+                                       quota=size * 2.5)
+        for i in range(5):
+            writer.submit(self.img, f'{self.directory.name}/{i}.png')
+        writer.queue.join()
+
+        self.assertEqual(writer.written, 5)
+        self.assertEqual(writer.evicted, 3)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['3.png', '4.png'])
+
+    def test_full_queue_drops(self):
+        writer = util.DebugImageWriter(queue_size=2, sample_rate=1.0)
+        writer.thread = True  # Never start the background thread
+        for i in range(3):
+            writer.submit(self.img, f'{self.directory.name}/{i}.png')
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(writer.queue.qsize(), 2)
+
+    def test_clear(self):
+        writer = util.DebugImageWriter(queue_size=4, sample_rate=1.0)
+        writer.thread = True
+        for i in range(3):
+            writer.submit(self.img, f'{self.directory.name}/{i}.png')
+        self.assertEqual(writer.queued_bytes(), 3 * self.img.nbytes)
+        self.assertEqual(writer.clear(), 3)
+        self.assertEqual(writer.queued_bytes(), 0)
+        writer.queue.join()     # Nothing left unfinished
+
+        writer.paused = True
+        writer.submit(self.img, f'{self.directory.name}/3.png')
+        self.assertEqual(writer.queue.qsize(), 0)
+        self.assertEqual(writer.dropped, 4)
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def work(self, prof, images):
+        for _ in range(images):
+            prof.begin_image()
+            sum(math.sqrt(i) for i in range(200000))
+            prof.end_image()
+
+    def test_cprofile_images(self):
+        prof = profiler.Profiler(directory=self.directory.name)
+        prof.start('cprofile', images=2)
+        self.work(prof, 3)
+
+        self.assertFalse(prof.active)
+        self.assertEqual(prof.images, 2)
+        self.assertEqual(len(prof.files), 2)
+        with open(prof.files[1]) as fp:
+            self.assertIn('math.sqrt', fp.read())
+
+    def test_sample_window(self):
+        prof = profiler.Profiler(directory=self.directory.name,
+                                 interval=0.001)
+        prof.start('sample', seconds=0.5)
+        while prof.active:
+            self.work(prof, 1)
+
+        self.assertEqual(len(prof.files), 1)
+        with open(prof.files[0]) as fp:
+            stacks = fp.read().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(any('test.py:work' in s for s in stacks))
+
+    def test_one_session_at_a_time(self):
+        prof = profiler.Profiler(directory=self.directory.name)
+        prof.start('cprofile', images=1)
+        with self.assertRaises(ValueError):
+            prof.start('cprofile', images=1)
+        with self.assertRaises(ValueError):
+            profiler.Profiler().start('cprofile')
+
+
+class MemoryTests(unittest.TestCase):
+    def test_rss(self):
+        self.assertGreater(memory.rss_bytes(), 0)
+        self.assertGreaterEqual(memory.peak_rss_bytes(),
+                                memory.rss_bytes() // 2)
+
+    def test_soft_limit(self):
+        rss = memory.rss_bytes()
+        monitor = memory.MemoryMonitor(soft_limit=rss / 2, resume=0.9)
+        self.assertTrue(monitor.record_image())
+        self.assertTrue(monitor.shedding)
+        # Only reported once while still over the limit
+        self.assertFalse(monitor.record_image())
+        self.assertEqual(monitor.shed_events, 1)
+
+        monitor.soft_limit = rss * 10
+        monitor.record_image()
+        self.assertFalse(monitor.shedding)
+
+    def test_disabled(self):
+        monitor = memory.MemoryMonitor(soft_limit=0)
+        for _ in range(3):
+            self.assertFalse(monitor.record_image())
+        self.assertEqual(monitor.status()['images'], 3)
+
+    def test_growth(self):
+        monitor = memory.MemoryMonitor(soft_limit=0)
+        for i in range(1, 11):
+            monitor.samples.append((i, 1000 + 50 * i))
+        self.assertAlmostEqual(monitor.growth(), 50)
+
+    def test_top_allocators(self):
+        self.assertIsNone(memory.top_allocators())
+        memory.start_tracing(1)
+        try:
+            data = [bytearray(1024) for _ in range(1000)]
+            top = memory.top_allocators(5)
+        finally:
+            memory.stop_tracing()
+        self.assertGreater(top['traced'], len(data) * 1024)
+        self.assertIn('test.py', top['top'][0]['location'])
+
+
+class LatencyTests(unittest.TestCase):
+    def test_intervals(self):
+        tracker = latency.LatencyTracker(log_every=0)
+        for i in range(10):
+            tracker.record({'trigger': i, 'capture': i + 0.1,
+                            'download': i + 0.5}, i + 0.75, i + 1.75)
+        intervals = tracker.status()['intervals']
+        self.assertEqual(tracker.status()['frames'], 10)
+        self.assertAlmostEqual(intervals['trigger->capture']['p50'], 0.1)
+        self.assertAlmostEqual(intervals['download->received']['mean'], 0.25)
+        self.assertAlmostEqual(intervals['received->processed']['max'], 1)
+        self.assertAlmostEqual(intervals['total']['p90'], 1.75)
+
+    def test_missing_capture(self):
+        tracker = latency.LatencyTracker(log_every=0)
+        tracker.record({'trigger': 0, 'capture': None, 'download': 1}, 2, 3)
+        intervals = tracker.status()['intervals']
+        self.assertNotIn('trigger->capture', intervals)
+        self.assertAlmostEqual(intervals['trigger->download']['p50'], 1)
+
+
+class MavlinkListenerTests(unittest.TestCase):
+    mav = mavutil.mavlink.MAVLink(None)
+
+    def test_position(self):
+        listener = mavlink_listener.MavlinkListener(url='')
+        listener.handle(self.mav.attitude_encode(0, 0.1, -0.05, 1.0, 0, 0,
+                                                 0))
+        listener.handle(self.mav.global_position_int_encode(
+            0, 383143000, -765440000, 40000, 30000, 0, 0, 0, 9000))
+        telemetry = drone.get_telemetry()
+        self.assertAlmostEqual(telemetry['latitude'],
+                               math.radians(38.3143))
+        self.assertAlmostEqual(telemetry['longitude'],
+                               math.radians(-76.544))
+        self.assertAlmostEqual(telemetry['altitude'], 30 * 39.3701)
+        self.assertAlmostEqual(telemetry['heading'], math.pi / 2)
+        self.assertAlmostEqual(telemetry['roll'], 0.1)
+        self.assertAlmostEqual(telemetry['pitch'], -0.05)
+
+        # Heading falls back on yaw when the autopilot doesn't know it
+        listener.handle(self.mav.global_position_int_encode(
+            0, 383143000, -765440000, 40000, 30000, 0, 0, 0, 65535))
+        self.assertAlmostEqual(drone.get_telemetry()['heading'], 1.0)
+
+    def test_camera_feedback(self):
+        listener = mavlink_listener.MavlinkListener(url='')
+        listener.handle(self.mav.camera_feedback_encode(
+            0, 1, 0, 7, 383143000, -765440000, 35, 30, 2, 1, 90, 0, 0))
+        pose = drone.get_capture_pose(7)
+        self.assertAlmostEqual(pose['altitude'], 30 * 39.3701)
+        self.assertAlmostEqual(pose['heading'], math.pi / 2)
+        self.assertAlmostEqual(pose['roll'], math.radians(2))
+        self.assertIsNone(drone.get_capture_pose(6))
+        self.assertEqual(listener.status()['messages']['CAMERA_FEEDBACK'],
+                         1)
+
+    def test_older_position_ignored(self):
+        listener = mavlink_listener.MavlinkListener(url='')
+        drone.update_telemetry({'altitude': 0, 'latitude': 0,
+                                'longitude': 0, 'heading': 0,
+                                'timestamp': 4e9})
+        listener.handle(self.mav.global_position_int_encode(
+            0, 383143000, -765440000, 40000, 30000, 0, 0, 0, 9000))
+        self.assertEqual(drone.get_telemetry()['latitude'], 0)
+        drone.update_telemetry({'altitude': 0, 'latitude': 0,
+                                'longitude': 0, 'heading': 0,
+                                'timestamp': 0})
+
+
+class DetectionRecordTests(unittest.TestCase):
+    target = {'type': 'alphanumeric',
+              'class': {'shape': 'circle', 'shape-color': 'red',
+                        'text-color': 'blue', 'text': 'A'}}
+
+    def detection(self, count=1):
+        d = detections.Detection('alphanumeric', [38.0, -76.0], count)
+        for _ in range(count):
+            d.votes += detections.observation_votes(
+                'blue', 'red', [('circle', 0.9), ('square', 0.5)],
+                [('A', 80.0), ('B', 10.0)])
+        return d
+
+    def test_observation_votes(self):
+        votes = detections.observation_votes(
+            'none', 'red', [('circle', 0.5)], [('A', 80.6)], weight=0.5)
+        class_votes = detections.Detection(
+            'alphanumeric', [0, 0], votes=votes).class_votes()
+        self.assertEqual(class_votes['text-color'], {})
+        self.assertEqual(class_votes['shape-color'], {'red': 0.5})
+        self.assertEqual(class_votes['shape'], {'circle': 0.25})
+        self.assertEqual(class_votes['text'], {'A': 40.0})
+
+    def test_similarity(self):
+        other = dict(self.target, **{'class': dict(self.target['class'],
+                                                   shape='square',
+                                                   text='Z')})
+        similarity = detections.similarity_matrix(
+            [self.target, other], [self.detection(2)])
+        # circle 1.8, A 1.6, and one vote per color per observation
+        self.assertAlmostEqual(similarity[0, 0],
+                               0.25 * (1.8 + 1.6 + 1 + 1), places=5)
+        # square is ranked second and Z has no votes
+        self.assertAlmostEqual(similarity[1, 0],
+                               0.25 * (np.exp(-0.7) * 1.0 + 1 + 1),
+                               places=5)
+        self.assertEqual(detections.similarity_matrix([], []).shape, (0, 0))
+
+    def test_round_trip(self):
+        stored = [self.detection(3),
+                  detections.Detection('emergent', [38.5, -76.5], 2)]
+        loaded = detections.loads(detections.dumps(stored))
+        self.assertEqual([d.to_dict() for d in loaded],
+                         [d.to_dict() for d in stored])
+        self.assertEqual(detections.loads(detections.dumps([])), [])
+
+    def test_welford(self):
+        rng = np.random.default_rng(0)
+        points = [38.0, -76.0] + rng.normal(0, 1e-5, (50, 2))
+        d = detections.Detection('emergent', list(points[0]))
+        for point in points[1:]:
+            d.observe(list(point))
+
+        self.assertEqual(d.count, 50)
+        np.testing.assert_allclose(d.coords, points.mean(axis=0),
+                                   rtol=0, atol=1e-10)
+        offsets = detections.local_offsets(d.coords, points)
+        np.testing.assert_allclose(d.covariance(),
+                                   np.cov(offsets, rowvar=False), rtol=1e-3)
+
+    def test_match(self):
+        feet = 1 / coverage.FEET_PER_DEGREE
+        stored = [detections.Detection('emergent', [38.0, -76.0]),
+                  detections.Detection('alphanumeric', [38.0, -76.0])]
+        self.assertEqual(detections.match(
+            stored, 'alphanumeric', [38.0 + 10 * feet, -76.0], 15, 3), 1)
+        self.assertIsNone(detections.match(
+            stored, 'alphanumeric', [38.0 + 20 * feet, -76.0], 15, 3))
+
+        # Observations spread out north-south widen the gate that way only
+        for north in [-20, 20, -20, 20]:
+            stored[1].observe([38.0 + north * feet, -76.0])
+        self.assertEqual(detections.match(
+            stored, 'alphanumeric', [38.0 + 40 * feet, -76.0], 15, 3), 1)
+        east = 40 * feet / math.cos(math.radians(38.0))
+        self.assertIsNone(detections.match(
+            stored, 'alphanumeric', [38.0, -76.0 + east], 15, 3))
+
+
+class ObservationClusterTests(unittest.TestCase):
+    def observations(self, rng, centers, per_center):
+        feet = 1 / coverage.FEET_PER_DEGREE
+        observed = []
+        for i, (north, east) in enumerate(centers):
+            for _ in range(per_center):
+                d = detections.Detection('alphanumeric', [0, 0])
+                d.votes = detections.observation_votes(
+                    'red', 'blue', [(detections.SHAPES[i], 1.0)], [])
+                dn, de = rng.normal(0, 2, 2)
+                coords = [38.0 + (north + dn) * feet,
+                          -76.0 + (east + de) * feet /
+                          math.cos(math.radians(38.0))]
+                observed.append((d, coords))
+        return observed
+
+    def test_log_round_trip(self):
+        observed = self.observations(np.random.default_rng(0),
+                                     [(0, 0)], 3)
+        log = detections.unpack_observations(
+            detections.pack_observations(7, observed))
+        self.assertEqual(len(log), 3)
+        self.assertTrue((log['frame'] == 7).all())
+        np.testing.assert_allclose(log['coords'],
+                                   [c for _, c in observed])
+        self.assertEqual(len(detections.unpack_observations(b'')), 0)
+
+    def test_cluster(self):
+        rng = np.random.default_rng(1)
+        observed = self.observations(rng, [(0, 0), (60, 0)], 10)
+        rng.shuffle(observed)
+        log = detections.unpack_observations(
+            detections.pack_observations(1, observed))
+        clustered = detections.cluster(log, eps=15)
+
+        self.assertEqual(len(clustered), 2)
+        clustered.sort(key=lambda d: d.coords[0])
+        for d, shape in zip(clustered, detections.SHAPES):
+            self.assertEqual(d.count, 10)
+            self.assertEqual(d.class_votes()['shape'], {shape: 10.0})
+            self.assertLess(max(d.stdev()), 4)
+
+        # Same statistics as merging the observations one at a time
+        first = [c for d, c in observed if d.votes[
+            detections.INDEX['shape']['circle']]]
+        merged = detections.Detection('alphanumeric', first[0])
+        for coords in first[1:]:
+            merged.observe(coords)
+        np.testing.assert_allclose(clustered[0].coords, merged.coords)
+        np.testing.assert_allclose(clustered[0].covariance(),
+                                   merged.covariance(), rtol=1e-6)
+
+    def test_noise_kept(self):
+        rng = np.random.default_rng(2)
+        observed = self.observations(rng, [(0, 0)], 5) + \
+            self.observations(rng, [(200, 0)], 1)
+        log = detections.unpack_observations(
+            detections.pack_observations(1, observed))
+        counts = sorted(d.count for d in
+                        detections.cluster(log, eps=15, min_samples=3))
+        self.assertEqual(counts, [1, 5])
+
+
 class IntegrationTests(unittest.TestCase):
     paths = [
         ('/app/images/test/alphanumeric-model-test2.jpg', 38.31442311312976,
@@ -229,6 +772,24 @@ class IntegrationTests(unittest.TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def test_telemetry_batch(self):
+        samples = [{
+            "altitude": 1002,
+            "latitude": 0.10,
+            "longitude": 0.80 + i * 1e-6,
+            "heading": 1.50,
+            "timestamp": 1700000000.0 + i * 0.05
+        } for i in range(5)]
+
+        response = requests.post('http://localhost:8003/telemetry/batch',
+                                 json=samples)
+        self.assertEqual(response.status_code, 200)
+
+        del samples[0]['timestamp']
+        response = requests.post('http://localhost:8003/telemetry/batch',
+                                 json=samples)
+        self.assertEqual(response.status_code, 400)
+
     def test_odlc_queueing(self):
         for (p, lat, lon) in self.paths:
             with open(p, 'rb') as im:
@@ -251,6 +812,51 @@ class IntegrationTests(unittest.TestCase):
                                                   'application/octet-stream'})
                 self.assertEqual(response.status_code, 200)
 
+    def test_odlc_capture_telemetry(self):
+        p, lat, lon = self.paths[0]
+        with open(p, 'rb') as im:
+            data = im.read()
+        telemetry = {
+            "altitude": 1002,
+            "latitude": lat,
+            "longitude": lon,
+            "heading": 1.50,
+            "timestamp": 1700000000.0
+        }
+        response = requests.post("http://localhost:8003/odlc", data=data,
+                                 headers={'Content-Type':
+                                          'application/octet-stream',
+                                          'X-Capture-Telemetry':
+                                          json.dumps(telemetry)})
+        self.assertEqual(response.status_code, 200)
+
+        response = requests.post("http://localhost:8003/odlc", data=data,
+                                 headers={'Content-Type':
+                                          'application/octet-stream',
+                                          'X-Capture-Telemetry':
+                                          json.dumps({"altitude": 1002})})
+        self.assertEqual(response.status_code, 400)
+
+    def test_odlc_capture_index(self):
+        # Frames with only a capture index are accepted whether or not any
+        # telemetry has been posted; their pose is looked up when processed
+        p, _, _ = self.paths[0]
+        with open(p, 'rb') as im:
+            data = im.read()
+        for index, status in (('12', 200), ('twelve', 400)):
+            response = requests.post("http://localhost:8003/odlc",
+                                     data=data,
+                                     headers={'Content-Type':
+                                              'application/octet-stream',
+                                              'X-Capture-Index': index})
+            self.assertEqual(response.status_code, status)
+
+    def test_memory_limit(self):
+        for limit, status in (('5', 200), ('abc', 400), ('-1', 400)):
+            response = requests.get('http://localhost:8003/memory',
+                                    params={'limit': limit})
+            self.assertEqual(response.status_code, status)
+
     # def test_odlc_retrieval(self):
     #     response = requests.get('http://localhost:8003/odlc')
     #     self.assertEqual(response.status_code, 200)
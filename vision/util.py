@@ -1,10 +1,22 @@
 import sys
 import traceback
 import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from queue import Queue, Full
+from threading import Thread, Lock
 
 import cv2
 
 debugging = (int(os.environ.get('DEBUG')) == 1)
+# Fraction of debug images that get written
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', '1.0'))
+# Debug images waiting to be written before new ones are dropped
+DEBUG_QUEUE_SIZE = int(os.environ.get('DEBUG_QUEUE_SIZE', '64'))
+# Disk space debug images may use before the oldest ones are deleted
+DEBUG_DISK_QUOTA = float(os.environ.get('DEBUG_DISK_QUOTA_MB', '500')) * 2**20
 
 
 def info(message):
@@ -17,14 +29,150 @@ def error(message):
     sys.stdout.flush()
 
 
+# Per-stage timings in seconds, only recorded once a tool sets this to {}
+stage_times = None
+
+
+@contextmanager
+def timed(stage):
+    """
+    Record how long the enclosed block takes under stage_times[stage]
+    """
+    if stage_times is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times.setdefault(stage, []).append(time.perf_counter() - start)
+
+
 def debug_info(message):
     if debugging:
         info(message)
 
 
+class DebugImageWriter:
+    """
+    Writes debug images from a background thread, so encoding and disk I/O
+    stay off the image processing path
+
+    Images are sampled at sample_rate, dropped (never blocking the caller)
+    when the queue is full, and the oldest images written are deleted once
+    their total size exceeds quota bytes.
+    """
+
+    def __init__(self, queue_size=DEBUG_QUEUE_SIZE,
+                 sample_rate=DEBUG_SAMPLE_RATE, quota=DEBUG_DISK_QUOTA):
+        self.queue = Queue(maxsize=queue_size)
+        self.sample_rate = sample_rate
+        self.quota = quota
+        self.files = deque()    # (path, size), oldest first
+        self.directories = set()
+        self.disk_usage = 0
+        self.written = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.paused = False     # Set while the server is shedding memory
+        self.lock = Lock()
+        self.thread = None
+
+    def submit(self, img, path):
+        if self.paused:
+            self.dropped += 1
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        # Don't keep a whole frame alive for the sake of a crop of it
+        if img.base is not None:
+            img = img.copy()
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((img, path))
+        except Full:
+            self.dropped += 1
+
+    def _track_directory(self, directory):
+        """
+        Account for images already on disk from previous runs
+        """
+        self.directories.add(directory)
+        existing = []
+        for name in os.listdir(directory):
+            file_path = os.path.join(directory, name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                existing.append((stat.st_mtime, file_path, stat.st_size))
+        for _, file_path, size in sorted(existing):
+            self.files.append((file_path, size))
+            self.disk_usage += size
+
+    def _run(self):
+        while True:
+            img, path = self.queue.get()
+            try:
+                directory = os.path.dirname(path) or '.'
+                if directory not in self.directories:
+                    self._track_directory(directory)
+
+                cv2.imwrite(path, img)
+                size = os.path.getsize(path)
+                self.files.append((path, size))
+                self.disk_usage += size
+                self.written += 1
+
+                # Evict oldest first until we're back under quota
+                while self.disk_usage > self.quota and self.files:
+                    old_path, old_size = self.files.popleft()
+                    self.disk_usage -= old_size
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+                    self.evicted += 1
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+            self.queue.task_done()
+
+    def queued_bytes(self):
+        with self.queue.mutex:
+            return sum(img.nbytes for img, _ in self.queue.queue)
+
+    def clear(self):
+        """
+        Drop every image waiting to be written
+        """
+        with self.queue.mutex:
+            cleared = len(self.queue.queue)
+            self.queue.queue.clear()
+            self.queue.unfinished_tasks -= cleared
+            if self.queue.unfinished_tasks == 0:
+                self.queue.all_tasks_done.notify_all()
+            self.queue.not_full.notify_all()
+        self.dropped += cleared
+        return cleared
+
+    def status(self):
+        return {
+            'queued': self.queue.qsize(),
+            'queued_bytes': self.queued_bytes(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'evicted': self.evicted,
+            'disk_usage': self.disk_usage,
+        }
+
+
+debug_writer = DebugImageWriter()
+
+
 def debug_imwrite(img, path):
     if debugging:
-        cv2.imwrite(path, img)
+        debug_writer.submit(img, path)
 
 
 def safe_function_call(func, default, *args):